@@ -0,0 +1,106 @@
+"""
+Microbenchmark of hand scoring: the previous Counter walk of Player.get_hand_value
+against the lookup tables in game.models.hand, scalar and batched.
+
+Run from the project root:
+    python -m benchmarks.hand_value
+"""
+import timeit
+from collections import Counter
+
+import numpy as np
+
+from game.models import hand as hand_lookup
+from game.models.constant import Card
+
+
+def legacy_hand_value(hand: Counter) -> int:
+    """
+    Player.get_hand_value before the lookup tables, kept as the reference implementation
+    """
+    def get_value_with_aces(hand):
+        total_cards = sum(hand.values())
+        if total_cards == 2 and hand[Card.ace] == 2:
+            return 21
+        elif total_cards == 2 and hand[Card.ace] == 1 and (hand[Card.jack] == 1 or
+                                                           hand[Card.queen] == 1 or
+                                                           hand[Card.king] == 1 or
+                                                           hand[Card.ten] == 1):
+            return 21
+        else:
+            hand_value = 0
+            for card, count in hand.items():
+                if card in [Card.jack, Card.queen, Card.king]:
+                    hand_value += 10 * count
+                else:
+                    hand_value += card * count
+            for i in range(hand[Card.ace]):
+                if hand_value + 10 <= 21:
+                    hand_value += 10
+            return hand_value
+    hand_value = 0
+    if Card.ace not in hand:
+        for card, count in hand.items():
+            if card in [Card.jack, Card.queen, Card.king]:
+                hand_value += 10 * count
+            else:
+                hand_value += card * count
+        return hand_value
+    else:
+        return get_value_with_aces(hand)
+
+
+def random_hands(num_hands: int, seed: int = 0) -> np.ndarray:
+    """
+    Rank count vectors of hands with 1 to 8 cards
+    """
+    rng = np.random.default_rng(seed)
+    num_cards = rng.integers(1, 9, size=num_hands)
+    cards = rng.integers(0, len(Card), size=(num_hands, 8))
+    counts = np.zeros((num_hands, len(Card)), dtype=np.int64)
+    for i in range(8):
+        rows = np.flatnonzero(num_cards > i)
+        np.add.at(counts, (rows, cards[rows, i]), 1)
+    return counts
+
+
+def to_counter(counts: np.ndarray) -> Counter:
+    return Counter({card: int(n) for card, n in zip(Card, counts) if n})
+
+
+def main(num_hands: int = 100_000) -> None:
+    counts = random_hands(num_hands)
+    counters = [to_counter(row) for row in counts]
+    hard_totals, num_aces, num_cards = hand_lookup.hand_summary(counts)
+    summaries = list(zip(hard_totals.tolist(), num_aces.tolist(), num_cards.tolist()))
+
+    expected = np.array([legacy_hand_value(c) for c in counters])
+    scalar = np.array([hand_lookup.get_hand_value(*s) for s in summaries])
+    batched = hand_lookup.batch_hand_values(hard_totals, num_aces, num_cards)
+    assert (expected == scalar).all() and (expected == batched).all(), "lookup table disagrees with legacy scoring"
+
+    timings = {
+        "legacy Counter walk": timeit.timeit(
+            lambda: [legacy_hand_value(c) for c in counters], number=3
+        ) / 3,
+        "table lookup (scalar)": timeit.timeit(
+            lambda: [hand_lookup.get_hand_value(*s) for s in summaries], number=3
+        ) / 3,
+        "table lookup (batched)": timeit.timeit(
+            lambda: hand_lookup.batch_hand_values(hard_totals, num_aces, num_cards), number=3
+        ) / 3,
+        "table lookup (batched, from counts)": timeit.timeit(
+            lambda: hand_lookup.batch_count_values(counts), number=3
+        ) / 3,
+    }
+    baseline = timings["legacy Counter walk"]
+    print(f"{num_hands} hands, all implementations agree")
+    for name, seconds in timings.items():
+        print(
+            f"{name:<40}{seconds / num_hands * 1e9:>10.1f} ns/hand"
+            f"{baseline / seconds:>10.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Import time and memory of the game and training modules, each imported in a fresh interpreter.
+Also reports whether importing the module loaded torch, which no game module except
+game.models.torch_adapter should do.
+
+Run from the project root:
+    python -m benchmarks.imports
+    python -m benchmarks.imports --repeat 5 --check
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+# modules allowed to load torch
+TORCH_MODULES = ("game.models.torch_adapter", "training.")
+
+# runs in the child interpreter, prints the measurements as json
+PROBE = """
+import importlib, json, resource, sys, time
+
+def rss_mb():
+    # ru_maxrss is in kilobytes on linux and bytes on macos, imports only grow memory so the peak is current
+    scale = 1 / 1024 / 1024 if sys.platform == "darwin" else 1 / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+before = rss_mb()
+start = time.perf_counter()
+if sys.argv[1]:
+    importlib.import_module(sys.argv[1])
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "rss_mb": rss_mb(), "rss_delta_mb": rss_mb() - before, "torch": "torch" in sys.modules}))
+"""
+
+
+def default_modules() -> List[str]:
+    modules = ["game.api", "game.vector_api", "game.table_api", "game.probability"]
+    modules += sorted(f"game.models.{path.stem}" for path in (ROOT / "game" / "models").glob("*.py"))
+    modules += ["training.lookup_table", "training.registry", "training.agent"]
+    return modules
+
+
+def measure(module: str, repeat: int) -> Dict[str, float]:
+    """
+    Median over repeat fresh interpreters, an empty module name measures the bare interpreter
+    """
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE, module], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout
+        runs.append(json.loads(output))
+    return {
+        "seconds": statistics.median(run["seconds"] for run in runs),
+        "rss_mb": statistics.median(run["rss_mb"] for run in runs),
+        "rss_delta_mb": statistics.median(run["rss_delta_mb"] for run in runs),
+        "torch": any(run["torch"] for run in runs),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("modules", nargs="*", help="defaults to game.api, game.models.* and training.agent")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    parser.add_argument("--check", action="store_true", help="fail if a game module loads torch")
+    args = parser.parse_args()
+
+    modules = args.modules or default_modules()
+    results = {"(interpreter)": measure("", args.repeat)}
+    for module in modules:
+        try:
+            results[module] = measure(module, args.repeat)
+        except subprocess.CalledProcessError as e:
+            # e.g. an optional dependency such as pydantic is not installed
+            print(f"{module}: import failed\n{e.stderr.strip().splitlines()[-1]}", file=sys.stderr)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'module':<32}{'import ms':>12}{'RSS MB':>10}{'+RSS MB':>10}{'torch':>8}")
+        for module, result in results.items():
+            print(
+                f"{module:<32}{result['seconds'] * 1e3:>12.1f}{result['rss_mb']:>10.1f}"
+                f"{result['rss_delta_mb']:>10.1f}{'yes' if result['torch'] else 'no':>8}"
+            )
+
+    if args.check:
+        offenders = [
+            module
+            for module, result in results.items()
+            if result["torch"] and not module.startswith(TORCH_MODULES)
+        ]
+        if offenders:
+            sys.exit(f"torch is loaded by: {', '.join(offenders)}")
+
+
+if __name__ == "__main__":
+    main()
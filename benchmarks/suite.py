@@ -0,0 +1,378 @@
+"""
+Benchmark suite of the game engine, featurization, the probability engine, inference and the DQN train step
+
+Every workload is seeded, so two runs time the same hands, states and batches.
+Results are written as json and can be compared against an earlier run, e.g. on another commit:
+
+Run from the project root:
+    python -m benchmarks.suite --output before.json
+    python -m benchmarks.suite --output after.json --compare before.json
+    python -m benchmarks.suite --quick --filter deck_shuffle
+"""
+import argparse
+import itertools
+import json
+import platform
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from benchmarks.timing import measure
+from game.api import BlackjackWrapper
+from game.probability import ProbabilityEngine
+from game.models.deck import Deck
+from game.models.player import Player
+from game.models.constant import PlayerType
+from game.table_api import BlackjackTable
+from game.vector_api import VectorBlackjackEnv
+
+DECK_NUMS = (1, 2, 4, 8, 16)
+NUM_ENVS = (1, 64, 1024)
+NUM_SEATS = (1, 3, 7)
+BATCH_SIZES = (1, 32, 512, 4096)
+TRAIN_BATCH_SIZES = (64, 512, 2048)
+BET_CHOICES = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+
+
+class Suite:
+    def __init__(self, seed: int = 0, quick: bool = False, name_filter: Optional[str] = None):
+        self.seed = seed
+        # fewer samples, for a smoke run
+        self.scale = 0.1 if quick else 1.0
+        self.name_filter = name_filter
+        self.results: Dict[str, dict] = {}
+
+    def rng(self) -> np.random.Generator:
+        return np.random.default_rng(self.seed)
+
+    def wanted(self, name: str) -> bool:
+        return self.name_filter is None or self.name_filter in name
+
+    def run(self, name: str, unit: str, fn: Callable[[], object], repeat: int = 200, **kwargs) -> None:
+        """
+        Times fn and stores the result under name, params are given as name[key=value,...]
+        """
+        result = measure(fn, repeat=max(int(repeat * self.scale), 5), **kwargs)
+        result["unit"] = unit
+        self.results[name] = result
+        print(f"{name:<44}{result['p50_ns'] / 1e3:>12.2f}{result['p99_ns'] / 1e3:>12.2f}{result['per_second']:>16,.0f} {unit}/s")
+
+
+def _play_hand(wrapper: BlackjackWrapper) -> BlackjackWrapper:
+    """
+    One full hand hitting below 17, as a fixed seeded workload
+    """
+    wrapper = wrapper.reset()
+    outcome = wrapper.bet_step(0.2)
+    for _ in range(9):
+        if outcome.terminated:
+            break
+        outcome = wrapper.card_step(take_card=wrapper.player.get_hand_value() < 17)
+    return wrapper
+
+
+def _sample_states(seed: int, num_states: int, deck_nums: int = 8) -> list:
+    wrapper = BlackjackWrapper(10000, deck_nums, rng=np.random.default_rng(seed))
+    states = []
+    while len(states) < num_states:
+        wrapper = wrapper.reset()
+        outcome = wrapper.bet_step(0.2)
+        states.append(outcome.new_state)
+        while not outcome.terminated and len(states) < num_states:
+            outcome = wrapper.card_step(take_card=wrapper.player.get_hand_value() < 16)
+            states.append(outcome.new_state)
+    return states
+
+
+def bench_wrapper(suite: Suite) -> None:
+    for deck_nums in DECK_NUMS:
+        name = f"wrapper_hand[deck_nums={deck_nums}]"
+        if suite.wanted(name):
+            holder = [BlackjackWrapper(10000, deck_nums, rng=suite.rng())]
+
+            def hand():
+                holder[0] = _play_hand(holder[0])
+
+            suite.run(name, "hands", hand, repeat=2000)
+
+    wrapper = BlackjackWrapper(10000, 8, rng=suite.rng())
+    holder = [wrapper]
+
+    def before_bet():
+        holder[0] = holder[0].reset()
+
+    if suite.wanted("wrapper_bet_step"):
+        suite.run("wrapper_bet_step", "steps", lambda: holder[0].bet_step(0.2), repeat=2000, setup=before_bet)
+
+    def before_card(min_value: int):
+        # a hand still in play with at least min_value, so that standing is a valid action
+        while True:
+            holder[0] = holder[0].reset()
+            outcome = holder[0].bet_step(0.2)
+            while not outcome.terminated and holder[0].player.get_hand_value() < min_value:
+                outcome = holder[0].card_step(take_card=True)
+            if not outcome.terminated:
+                return
+
+    if suite.wanted("wrapper_card_step_hit"):
+        suite.run(
+            "wrapper_card_step_hit",
+            "steps",
+            lambda: holder[0].card_step(take_card=True),
+            repeat=2000,
+            setup=lambda: before_card(0),
+        )
+    if suite.wanted("wrapper_card_step_stand"):
+        suite.run(
+            "wrapper_card_step_stand",
+            "steps",
+            lambda: holder[0].card_step(take_card=False),
+            repeat=2000,
+            setup=lambda: before_card(16),
+        )
+
+
+def bench_vector_env(suite: Suite) -> None:
+    for num_envs in NUM_ENVS:
+        name = f"vector_env_round[num_envs={num_envs}]"
+        if not suite.wanted(name):
+            continue
+        env = VectorBlackjackEnv(num_envs, 10000, 8, seed=suite.seed)
+
+        def play_round():
+            env.reset()
+            outcome = env.bet_step(0.2)
+            for _ in range(9):
+                if outcome.terminated.all():
+                    break
+                outcome = env.card_step(outcome.new_state.hand.sum(axis=1) < 3)
+
+        suite.run(name, "hands", play_round, repeat=max(200, 20000 // num_envs), items=num_envs)
+
+
+def bench_table(suite: Suite) -> None:
+    for num_seats in NUM_SEATS:
+        name = f"table_round[num_seats={num_seats}]"
+        if not suite.wanted(name):
+            continue
+        table = BlackjackTable(num_seats, 10000, 8, rng=suite.rng())
+
+        def play_round():
+            table.reset()
+            outcome = table.bet_step(0.2)
+            for _ in range(9):
+                if outcome.terminated.all():
+                    break
+                outcome = table.card_step(outcome.new_state.hand.sum(axis=1) < 3)
+
+        suite.run(name, "hands", play_round, repeat=2000, items=num_seats)
+
+
+def bench_hand_value(suite: Suite) -> None:
+    if not suite.wanted("player_get_hand_value"):
+        return
+    rng = suite.rng()
+    players = []
+    for _ in range(1000):
+        player = Player(player_type=PlayerType.player)
+        player.add_cards(rng.integers(1, 14, size=rng.integers(2, 6)))
+        players.append(player)
+
+    def values():
+        for player in players:
+            player.get_hand_value()
+
+    suite.run("player_get_hand_value", "hands", values, items=len(players))
+
+
+def bench_deck(suite: Suite) -> None:
+    for deck_nums in DECK_NUMS:
+        name = f"deck_shuffle[deck_nums={deck_nums}]"
+        if suite.wanted(name):
+            deck = Deck(deck_nums, rng=suite.rng())
+            suite.run(name, "cards", deck.shuffle, repeat=2000, items=deck.size)
+
+
+def bench_flatten(suite: Suite) -> None:
+    states = _sample_states(suite.seed, 256)
+    if suite.wanted("game_state_flatten"):
+        suite.run(
+            "game_state_flatten",
+            "states",
+            lambda: [state.flatten(step_num=0.1) for state in states],
+            items=len(states),
+        )
+    if suite.wanted("game_state_torch_flatten"):
+        suite.run(
+            "game_state_torch_flatten",
+            "states",
+            lambda: [state.torch_flatten("cpu", step_num=0.1) for state in states],
+            items=len(states),
+        )
+
+
+def bench_probability(suite: Suite) -> None:
+    for deck_nums in (1, 8):
+        states = _sample_states(suite.seed, 64, deck_nums)
+        name = f"probability_cold[deck_nums={deck_nums}]"
+        if suite.wanted(name):
+            # a new engine for every state, as in a game where every state has a new composition
+            holder = [None, itertools.cycle(states)]
+
+            def new_engine():
+                holder[0] = (ProbabilityEngine(), next(holder[1]))
+
+            suite.run(
+                name, "states", lambda: holder[0][0].evaluate_state(holder[0][1]), repeat=50, setup=new_engine
+            )
+        name = f"probability_warm[deck_nums={deck_nums}]"
+        if suite.wanted(name):
+            engine = ProbabilityEngine()
+            engine.evaluate_state(states[0])
+            suite.run(name, "states", lambda: engine.evaluate_state(states[0]), repeat=2000)
+
+
+def _dqn(seed: int, in_features: int):
+    import torch
+
+    from training.agent import BlackjackDQN
+
+    torch.manual_seed(seed)
+    return BlackjackDQN(in_features, BET_CHOICES, [True, False], epsilon=0.9, min_epsilon=0.05)
+
+
+def bench_dqn(suite: Suite) -> None:
+    import torch
+    from torch import optim
+
+    from game.models.model import GameState
+    from training.dqn import train
+    from training.replay_buffer import ReplayBuffer
+
+    state_size = GameState.get_state_size(add_steps=True)
+    model = _dqn(suite.seed, state_size).eval()
+    rng = suite.rng()
+    for batch_size in BATCH_SIZES:
+        name = f"dqn_forward[batch_size={batch_size}]"
+        if suite.wanted(name):
+            states = torch.from_numpy(rng.random((batch_size, state_size), dtype=np.float32))
+
+            def forward():
+                with torch.no_grad():
+                    model(states)
+
+            suite.run(name, "states", forward, items=batch_size)
+
+    for batch_size in TRAIN_BATCH_SIZES:
+        name = f"dqn_train_step[batch_size={batch_size}]"
+        if not suite.wanted(name):
+            continue
+        dqn_model = _dqn(suite.seed, state_size).train()
+        target_model = _dqn(suite.seed, state_size)
+        optimizer = optim.Adam(dqn_model.parameters(), lr=1e-2)
+        num_actions = len(BET_CHOICES) + 2
+        capacity = 10000
+        replay_buffer = ReplayBuffer(capacity, state_size, num_actions, seed=suite.seed)
+        actions = rng.integers(0, num_actions, size=capacity)
+        replay_buffer.push_batch(
+            rng.random((capacity, state_size), dtype=np.float32),
+            actions,
+            rng.random((capacity, state_size), dtype=np.float32),
+            rng.normal(size=capacity),
+            np.where(actions[:, None] < len(BET_CHOICES), dqn_model.bet_mask.numpy(), dqn_model.card_mask.numpy()),
+            rng.random(capacity) < 0.3,
+        )
+        suite.run(
+            name,
+            "samples",
+            lambda: train(dqn_model, target_model, optimizer, replay_buffer, batch_size, gamma=0.9),
+            repeat=100,
+            items=batch_size,
+        )
+
+
+BENCHMARKS = (
+    bench_wrapper,
+    bench_vector_env,
+    bench_table,
+    bench_hand_value,
+    bench_deck,
+    bench_flatten,
+    bench_probability,
+    bench_dqn,
+)
+
+
+def environment() -> dict:
+    info = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    try:
+        info["commit"] = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        info["commit"] = None
+    if "torch" in sys.modules:
+        torch = sys.modules["torch"]
+        info["torch"] = torch.__version__
+        info["torch_threads"] = torch.get_num_threads()
+    return info
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    """
+    Prints the change of the median latency against baseline, returns the names slower by more than threshold.
+    The median is used as single slow samples (scheduling, page faults) move the mean a lot.
+    """
+    regressions = []
+    print(f"\n{'benchmark':<44}{'p50 before':>12}{'p50 after':>12}{'change':>10}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]["p50_ns"], result["p50_ns"]
+        change = after / before - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<44}{before / 1e3:>12.2f}{after / 1e3:>12.2f}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--compare", help="json file of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--quick", action="store_true", help="10x fewer samples")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    suite = Suite(seed=args.seed, quick=args.quick, name_filter=args.filter)
+    print(f"{'benchmark':<44}{'p50 us':>12}{'p99 us':>12}{'throughput':>16}")
+    for benchmark in BENCHMARKS:
+        benchmark(suite)
+
+    report = {"environment": environment(), "seed": args.seed, "quick": args.quick, "results": suite.results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(suite.results, baseline, args.threshold)
+        if regressions and args.fail_on_regression:
+            sys.exit(f"{len(regressions)} benchmarks regressed by more than {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
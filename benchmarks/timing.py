@@ -0,0 +1,55 @@
+"""
+Timing helpers shared by the benchmarks
+"""
+import gc
+import time
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+PERCENTILES = (50, 90, 99)
+
+
+def measure(
+    fn: Callable[[], object],
+    repeat: int = 200,
+    warmup: int = 10,
+    inner: int = 1,
+    items: int = 1,
+    setup: Optional[Callable[[], object]] = None,
+) -> Dict[str, float]:
+    """
+    Latency percentiles of fn and throughput in items per second.
+    Each of the repeat samples times inner back to back calls, so that calls much shorter than the
+    timer resolution can still be measured, and is reported per call. items is the number of units of work
+    (hands, states, samples...) done by one call.
+    setup, if given, runs untimed before every sample, inner has to be 1 then.
+    """
+    if setup is not None and inner != 1:
+        raise ValueError("inner has to be 1 when setup is given")
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        fn()
+    samples = np.empty(repeat)
+    # garbage collection pauses would otherwise land in random samples
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter_ns()
+            for _ in range(inner):
+                fn()
+            samples[i] = (time.perf_counter_ns() - start) / inner
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    result = {f"p{p}_ns": float(np.percentile(samples, p)) for p in PERCENTILES}
+    result["mean_ns"] = float(samples.mean())
+    result["min_ns"] = float(samples.min())
+    result["per_second"] = items * 1e9 / result["mean_ns"]
+    result["calls"] = repeat * inner
+    return result
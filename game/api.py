@@ -1,9 +1,12 @@
 from collections import Counter
+from typing import Optional
 
+from game.models.counting import CardCounter
 from game.models.model import ActionOutcome, GameState
 from game.models.player import Player
 from game.models.deck import Deck
 from game.models.constant import Card, PlayerType
+from game.models.streams import HandStreams
 
 
 class BlackjackWrapper:
@@ -13,28 +16,88 @@ class BlackjackWrapper:
     Processes input from RL training process and returns output from blackjack game
     """
 
-    def __init__(self, initial_cash: int = 100, deck_nums: int = 4, min_bet: int = 10):
+    def __init__(
+        self,
+        initial_cash: int = 100,
+        deck_nums: int = 4,
+        min_bet: int = 10,
+        rng=None,
+        penetration: float = 0.5,
+        streams: Optional[HandStreams] = None,
+        hand_index: int = 0,
+    ):
         """
         Initialise the game.
+        rng and penetration are passed on to the deck, see Deck.
+        With streams instead of rng, the shoe of every hand is shuffled with the stream of that hand,
+        see game.models.streams, hand_index is the index of the first hand.
         """
+        if rng is not None and streams is not None:
+            raise ValueError("pass either rng or streams, not both")
         self.initial_cash: int = initial_cash
         self.max_attained_cash: int = initial_cash
         self.min_bet: int = min_bet
         self.remaining_cash: int = initial_cash
         self.player_bet_percent: float = 0
         self.deck_nums: int = deck_nums
+        self.rng = rng
+        self.penetration: float = penetration
+        self.streams = streams
+        # incremented by every reset
+        self.hand_index: int = hand_index
 
         self.dealer = Player(player_type=PlayerType.dealer)
         self.player = Player(player_type=PlayerType.player)
 
-        self.deck = Deck(deck_nums=self.deck_nums)
+        deck_rng = self.rng if streams is None else streams.generator
+        self.deck = Deck(deck_nums=self.deck_nums, rng=deck_rng, penetration=self.penetration)
         self.discarded: Counter[Card] = Counter()
+        # running counts over the cards the player has seen, see game.models.counting
+        self.counter = CardCounter(self.deck_nums)
 
-        self.deck.shuffle()
+        self._shuffle()
 
         # always starts with player turn
         self.turn = PlayerType.player
 
+    @classmethod
+    def replay_hand(
+        cls,
+        state: GameState,
+        streams: HandStreams,
+        hand_index: int,
+        min_bet: int = 10,
+        penetration: float = 0.5,
+        max_attained_cash: Optional[int] = None,
+    ) -> "BlackjackWrapper":
+        """
+        The game as reset left it before hand hand_index, without playing the earlier hands.
+        state is the state get_state returned then, the shoe follows from its discarded cards.
+        max_attained_cash only matters for the reward of running out of cash, it defaults to the remaining cash.
+        """
+        wrapper = cls(
+            initial_cash=state.initial_cash,
+            deck_nums=state.deck_nums,
+            min_bet=min_bet,
+            penetration=penetration,
+            streams=streams,
+            hand_index=hand_index,
+        )
+        wrapper.remaining_cash = state.remaining_cash
+        wrapper.max_attained_cash = max_attained_cash if max_attained_cash is not None else state.remaining_cash
+        wrapper.deck.set_remaining_counts([4 * state.deck_nums - state.discarded.get(card, 0) for card in Card])
+        wrapper.discarded = Counter(state.discarded)
+        wrapper.counter.start_round(wrapper.deck)
+        wrapper._shuffle()
+        return wrapper
+
+    def _shuffle(self) -> None:
+        if self.streams is not None:
+            # the shoe of the hand only depends on the cards left and the stream of the hand
+            self.deck.sort()
+            self.streams.hand(self.hand_index)
+        self.deck.shuffle()
+
     def reset(self) -> "BlackjackWrapper":
         """
         Next game reshuffles the deck and recollects discarded cards
@@ -42,22 +105,30 @@ class BlackjackWrapper:
         if self.remaining_cash < self.min_bet:
             # ran out of cash, restart entire game
             return BlackjackWrapper(
-                initial_cash=self.initial_cash, deck_nums=self.deck_nums
+                initial_cash=self.initial_cash,
+                deck_nums=self.deck_nums,
+                min_bet=self.min_bet,
+                rng=self.rng,
+                penetration=self.penetration,
+                streams=self.streams,
+                hand_index=self.hand_index + 1,
             )
 
-        dealer_discarded = self.dealer.reset_hand()
-        player_discarded = self.player.reset_hand()
-        for card, amount in dealer_discarded.items():
-            self.discarded[card] += amount
-        for card, amount in player_discarded.items():
-            self.discarded[card] += amount
+        self.hand_index += 1
+        self.dealer.reset_hand()
+        self.player.reset_hand()
 
-        if self.deck.get_remaining_cards() < self.deck_nums * len(Card) * 4 // 2:
-            # used more than half the deck, reset deck
-            self.discarded = Counter()
-            self.deck = Deck(deck_nums=self.deck_nums)
+        if self.deck.needs_reshuffle():
+            # used more than the penetration of the deck, recollect all cards
+            self.deck.restore()
 
-        self.deck.shuffle()
+        # every card dealt from the shoe has been discarded at this point
+        self.discarded = Counter(
+            {card: int(amount) for card, amount in zip(Card, self.deck.get_dealt_counts()) if amount}
+        )
+        self.counter.start_round(self.deck)
+
+        self._shuffle()
         self.player_bet_percent = 0
 
         # always starts with player turn
@@ -68,29 +139,34 @@ class BlackjackWrapper:
         """
         Returns state of player (not dealer!)
         """
+        # the hand is copied as the player keeps drawing into it,
+        # discarded is replaced rather than updated by reset so it can be shared.
+        # bet_percent may be given as a 1 element tensor or numpy value, the state always holds a float
         return GameState(
             deck_nums=self.deck_nums,
             initial_cash=self.initial_cash,
             turn=self.turn,
-            hand=self.player.hand,
+            hand=self.player.hand.copy(),
             discarded=self.discarded,
-            bet_percent=self.player_bet_percent,
+            bet_percent=float(self.player_bet_percent),
             remaining_cash=self.remaining_cash,
+            card_count=self.counter.snapshot(self.deck.get_remaining_cards()),
         )
 
     def bet_step(self, bet_percent: float) -> ActionOutcome:
         """
         Must call this first at the start of each round
         """
-        reward = 0
+        reward = 0.0
         game_terminated = False
         self.player_bet_percent = bet_percent
 
         # draw 2 cards for each player and dealer, sequence matters
-        self.player.draw(self.deck)
-        self.dealer.draw(self.deck)
-        self.player.draw(self.deck)
-        self.dealer.draw(self.deck)
+        cards = self.deck.draw_many(4).tolist()
+        self.player.add_cards(cards[0::2])
+        self.dealer.add_cards(cards[1::2])
+        self.counter.see(cards[0])
+        self.counter.see(cards[2])
 
         # Implement natural blackjack rules for the dealer
         # Case 1 - Both have natural blackjack
@@ -112,15 +188,7 @@ class BlackjackWrapper:
             ) / self.initial_cash
 
         return ActionOutcome(
-            new_state=GameState(
-                deck_nums=self.deck_nums,
-                initial_cash=self.initial_cash,
-                turn=self.turn,
-                hand=self.player.hand,
-                discarded=self.discarded,
-                bet_percent=self.player_bet_percent,
-                remaining_cash=self.remaining_cash,
-            ),
+            new_state=self.get_state(),
             reward=reward,
             terminated=game_terminated,
         )
@@ -133,7 +201,7 @@ class BlackjackWrapper:
         )
 
         if take_card:
-            self.player.draw(self.deck)
+            self.counter.see(self.player.draw(self.deck))
             if self.player.get_hand_value() > 21:
                 # bust, immediately lose
                 game_terminated = True
@@ -187,18 +255,10 @@ class BlackjackWrapper:
                 / self.initial_cash
             )
             if game_terminated
-            else 0
+            else 0.0
         )
         return ActionOutcome(
-            new_state=GameState(
-                deck_nums=self.deck_nums,
-                initial_cash=self.initial_cash,
-                turn=self.turn,
-                hand=self.player.hand,
-                discarded=self.discarded,
-                bet_percent=self.player_bet_percent,
-                remaining_cash=self.remaining_cash,
-            ),
+            new_state=self.get_state(),
             reward=reward,
             terminated=game_terminated,
         )
@@ -0,0 +1,473 @@
+"""
+Opt-in per stage timings of the game and the training loop
+
+Nothing is measured until enable() is called. enable() swaps the methods listed in TARGETS for timed
+wrappers and disable() puts the originals back, so when disabled the hot path runs the original code
+with no extra call or flag check. Blocks that are not a method of their own, such as the forward pass,
+backward pass and optimizer step of training.dqn.train, use stage(), which costs one flag check when disabled.
+
+Timings are inclusive: wrapper.bet_step also counts the wrapper.get_state and state.init calls it makes.
+
+    from game import instrumentation
+
+    instrumentation.enable()
+    with instrumentation.Exporter("stages.jsonl", summary_every=1000, profile_window=(5000, 5100)) as exporter:
+        for i_episode in range(num_eps):
+            ...
+            exporter.episode_end()
+
+    python -m game.instrumentation stages.jsonl
+"""
+import argparse
+import cProfile
+import functools
+import importlib
+import io
+import json
+import pstats
+import sys
+import time
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# (module, class.method, stage name)
+TARGETS: Tuple[Tuple[str, str, str], ...] = (
+    ("game.api", "BlackjackWrapper.reset", "wrapper.reset"),
+    ("game.api", "BlackjackWrapper.bet_step", "wrapper.bet_step"),
+    ("game.api", "BlackjackWrapper.card_step", "wrapper.card_step"),
+    ("game.api", "BlackjackWrapper.get_state", "wrapper.get_state"),
+    ("game.models.deck", "Deck.shuffle", "deck.shuffle"),
+    ("game.models.deck", "Deck.draw", "deck.draw"),
+    ("game.models.deck", "Deck.draw_many", "deck.draw_many"),
+    ("game.models.model", "GameState.__init__", "state.init"),
+    ("game.models.model", "GameState.flatten", "state.flatten"),
+    ("game.models.model", "GameState.torch_flatten", "state.torch_flatten"),
+    ("training.agent", "BlackjackDQN.get_bet_percent", "dqn.get_bet_percent"),
+    ("training.agent", "BlackjackDQN.get_card_action", "dqn.get_card_action"),
+    ("training.agent", "BlackjackDQN.get_bet_percents", "dqn.get_bet_percents"),
+    ("training.agent", "BlackjackDQN.get_card_actions", "dqn.get_card_actions"),
+    ("training.agent", "BlackjackPolicyModel.get_bet_percent", "policy.get_bet_percent"),
+    ("training.agent", "BlackjackPolicyModel.get_card_action", "policy.get_card_action"),
+    ("training.agent", "BlackjackPolicyModel.get_bet_percents", "policy.get_bet_percents"),
+    ("training.agent", "BlackjackPolicyModel.get_card_actions", "policy.get_card_actions"),
+    ("training.replay_buffer", "ReplayBuffer.push", "replay.push"),
+    ("training.replay_buffer", "ReplayBuffer.push_batch", "replay.push_batch"),
+    ("training.replay_buffer", "ReplayBuffer.sample", "replay.sample"),
+)
+
+# log linear histogram: every power of 2 is split into 2 ** SUB_BITS buckets, so a bucket is at most
+# 1 / 2 ** SUB_BITS of its value wide and percentiles are within about 6% of the exact value
+SUB_BITS = 3
+SUB_BUCKETS = 1 << SUB_BITS
+NUM_BUCKETS = (64 - SUB_BITS + 1) * SUB_BUCKETS
+
+
+def bucket_index(ns: int) -> int:
+    if ns < SUB_BUCKETS:
+        return ns
+    shift = ns.bit_length() - SUB_BITS - 1
+    return (shift + 1) * SUB_BUCKETS + (ns >> shift) - SUB_BUCKETS
+
+
+def bucket_bounds(idx: int) -> Tuple[int, int]:
+    """
+    [lower, upper) nanoseconds of a bucket
+    """
+    if idx < SUB_BUCKETS:
+        return idx, idx + 1
+    shift = idx // SUB_BUCKETS - 1
+    mantissa = idx % SUB_BUCKETS + SUB_BUCKETS
+    return mantissa << shift, (mantissa + 1) << shift
+
+
+class StageStats:
+    """
+    Call count, total time and latency histogram of one stage
+    """
+
+    __slots__ = ("count", "total_ns", "min_ns", "max_ns", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = 0
+        self.max_ns = 0
+        self.buckets = [0] * NUM_BUCKETS
+
+    def add(self, ns: int) -> None:
+        if self.count == 0 or ns < self.min_ns:
+            self.min_ns = ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+        self.count += 1
+        self.total_ns += ns
+        self.buckets[bucket_index(ns)] += 1
+
+    def merge(self, other: "StageStats") -> None:
+        if other.count == 0:
+            return
+        self.min_ns = other.min_ns if self.count == 0 else min(self.min_ns, other.min_ns)
+        self.max_ns = max(self.max_ns, other.max_ns)
+        self.count += other.count
+        self.total_ns += other.total_ns
+        for idx, amount in enumerate(other.buckets):
+            self.buckets[idx] += amount
+
+    def percentile(self, q: float) -> float:
+        """
+        Estimated from the histogram, interpolating linearly inside the bucket
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for idx, amount in enumerate(self.buckets):
+            if amount and seen + amount >= rank:
+                lower, upper = bucket_bounds(idx)
+                value = lower + (upper - lower) * (rank - seen) / amount
+                return float(min(max(value, self.min_ns), self.max_ns))
+            seen += amount
+        return float(self.max_ns)
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total_ns": self.total_ns,
+            "mean_ns": self.total_ns / self.count if self.count else 0.0,
+            "min_ns": self.min_ns,
+            "p50_ns": self.percentile(50),
+            "p90_ns": self.percentile(90),
+            "p99_ns": self.percentile(99),
+            "max_ns": self.max_ns,
+            # sparse, as {bucket index: count}
+            "buckets": {idx: amount for idx, amount in enumerate(self.buckets) if amount},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "StageStats":
+        stats = cls()
+        stats.count = data["count"]
+        stats.total_ns = data["total_ns"]
+        stats.min_ns = data["min_ns"]
+        stats.max_ns = data["max_ns"]
+        for idx, amount in data["buckets"].items():
+            stats.buckets[int(idx)] = amount
+        return stats
+
+
+class Recorder:
+    """
+    Stage timings and plain counters of this process
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, StageStats] = {}
+        self.counters: Dict[str, int] = {}
+
+    def stage_stats(self, name: str) -> StageStats:
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats()
+        return stats
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def reset(self) -> None:
+        # stats objects are cleared rather than replaced, as the wrappers hold on to them
+        for stats in self.stages.values():
+            stats.__init__()
+        self.counters.clear()
+
+    def snapshot(self) -> dict:
+        return {
+            "stages": {name: stats.to_dict() for name, stats in self.stages.items() if stats.count},
+            "counters": dict(self.counters),
+        }
+
+
+RECORDER = Recorder()
+_enabled = False
+# (owner class, attribute, original) of every patched method, to undo enable()
+_patched: List[Tuple[type, str, Callable]] = []
+
+
+class _Stage:
+    __slots__ = ("stats", "start")
+
+    def __init__(self, stats: StageStats):
+        self.stats = stats
+
+    def __enter__(self) -> "_Stage":
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stats.add(time.perf_counter_ns() - self.start)
+
+
+_NULL_STAGE = nullcontext()
+
+
+def stage(name: str):
+    """
+    Times a block as a stage:
+        with stage("dqn.train.backward"):
+            loss.backward()
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(RECORDER.stage_stats(name))
+
+
+def count(name: str, amount: int = 1) -> None:
+    if _enabled:
+        RECORDER.count(name, amount)
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def _timed(fn: Callable, stats: StageStats) -> Callable:
+    perf_counter_ns = time.perf_counter_ns
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = perf_counter_ns()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            stats.add(perf_counter_ns() - start)
+
+    return wrapper
+
+
+def enable(prefixes: Optional[Sequence[str]] = None) -> List[str]:
+    """
+    Starts recording the TARGETS stages whose name starts with one of prefixes (all by default),
+    returns the names of the instrumented stages.
+    Targets in modules that cannot be imported, e.g. training.agent without torch, are skipped.
+    """
+    global _enabled
+    disable()
+    prefixes = tuple(prefixes) if prefixes is not None else ("",)
+    names = []
+    for module_name, attribute, name in TARGETS:
+        if not name.startswith(prefixes):
+            continue
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        class_name, method_name = attribute.split(".")
+        owner = getattr(module, class_name)
+        original = owner.__dict__[method_name]
+        setattr(owner, method_name, _timed(original, RECORDER.stage_stats(name)))
+        _patched.append((owner, method_name, original))
+        names.append(name)
+    _enabled = True
+    return names
+
+
+def disable() -> None:
+    global _enabled
+    while _patched:
+        owner, method_name, original = _patched.pop()
+        setattr(owner, method_name, original)
+    _enabled = False
+
+
+def reset() -> None:
+    RECORDER.reset()
+
+
+def snapshot() -> dict:
+    return RECORDER.snapshot()
+
+
+class Exporter:
+    """
+    Called once per episode by the training loop. Every summary_every episodes (never if 0) it appends a summary
+    of the stages recorded since the previous one to path (json lines) and prints it, then starts a new interval.
+    If profile_window = (start, stop) is given, episodes start to stop - 1 are also profiled with cProfile,
+    or with the torch profiler if profiler="torch", and the profile is written next to path.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        summary_every: int = 1000,
+        profile_window: Optional[Tuple[int, int]] = None,
+        profiler: str = "cprofile",
+        profile_dir=None,
+        print_summary: bool = True,
+    ):
+        if profiler not in ("cprofile", "torch"):
+            raise ValueError(f"Unknown profiler {profiler}, expected cprofile or torch")
+        if profile_window is not None and not 0 <= profile_window[0] < profile_window[1]:
+            raise ValueError(f"Invalid profile window {profile_window}")
+        self.path = Path(path) if path is not None else None
+        self.summary_every = summary_every
+        self.profile_window = profile_window
+        self.profiler = profiler
+        if profile_dir is not None:
+            self.profile_dir = Path(profile_dir)
+        else:
+            self.profile_dir = self.path.parent if self.path is not None else Path(".")
+        self.print_summary = print_summary
+
+        self.episode = 0
+        self.interval_start_episode = 0
+        self.interval_start = time.perf_counter()
+        self._profile = None
+        self._profiled = False
+        self.profile_paths: List[Path] = []
+        RECORDER.reset()
+        if profile_window is not None and profile_window[0] == 0:
+            self._start_profile()
+
+    def episode_end(self, num_episodes: int = 1) -> None:
+        """
+        num_episodes > 1 for loops that finish several episodes at once, e.g. over VectorBlackjackEnv
+        """
+        self.episode += num_episodes
+        if self.profile_window is not None:
+            start, stop = self.profile_window
+            if self._profile is None and not self._profiled and self.episode >= start:
+                self._start_profile()
+            elif self._profile is not None and self.episode >= stop:
+                self._stop_profile()
+        if self.summary_every and self.episode - self.interval_start_episode >= self.summary_every:
+            self.export()
+
+    def export(self) -> dict:
+        """
+        Writes the summary of the current interval and starts a new one
+        """
+        now = time.perf_counter()
+        elapsed = now - self.interval_start
+        episodes = self.episode - self.interval_start_episode
+        summary = {
+            "episode": self.episode,
+            "episodes": episodes,
+            "seconds": elapsed,
+            "episodes_per_second": episodes / elapsed if elapsed else 0.0,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            **RECORDER.snapshot(),
+        }
+        if self.path is not None:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(summary) + "\n")
+        if self.print_summary:
+            print(format_summary(summary))
+        RECORDER.reset()
+        self.interval_start_episode = self.episode
+        self.interval_start = now
+        return summary
+
+    def _start_profile(self) -> None:
+        if self.profiler == "torch":
+            import torch
+
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._profile = torch.profiler.profile(activities=activities)
+            self._profile.__enter__()
+        else:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self._profile_start_episode = self.episode
+
+    def _stop_profile(self) -> None:
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        stem = self.profile_dir / f"profile_episodes_{self._profile_start_episode}_{self.episode}"
+        if self.profiler == "torch":
+            self._profile.__exit__(None, None, None)
+            trace_path = stem.with_suffix(".trace.json")
+            self._profile.export_chrome_trace(str(trace_path))
+            table = self._profile.key_averages().table(sort_by="self_cpu_time_total", row_limit=30)
+        else:
+            self._profile.disable()
+            trace_path = stem.with_suffix(".prof")
+            self._profile.dump_stats(trace_path)
+            out = io.StringIO()
+            pstats.Stats(self._profile, stream=out).sort_stats("cumulative").print_stats(30)
+            table = out.getvalue()
+        stem.with_suffix(".txt").write_text(table)
+        self.profile_paths += [trace_path, stem.with_suffix(".txt")]
+        self._profile = None
+        self._profiled = True
+        if self.print_summary:
+            print(f"profile of episodes {self._profile_start_episode} to {self.episode} written to {trace_path}")
+
+    def close(self) -> None:
+        if self._profile is not None:
+            self._stop_profile()
+        if self.summary_every and self.episode > self.interval_start_episode:
+            self.export()
+
+    def __enter__(self) -> "Exporter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def format_summary(summary: dict) -> str:
+    lines = [
+        f"episode {summary['episode']}: {summary['episodes']} episodes in {summary['seconds']:.2f}s"
+        f" ({summary['episodes_per_second']:.0f}/s)",
+        f"{'stage':<28}{'calls':>10}{'% time':>8}{'mean us':>10}{'p50 us':>10}{'p99 us':>10}{'max us':>10}",
+    ]
+    wall_ns = summary["seconds"] * 1e9
+    stages = sorted(summary["stages"].items(), key=lambda item: -item[1]["total_ns"])
+    for name, stats in stages:
+        share = stats["total_ns"] / wall_ns if wall_ns else 0.0
+        lines.append(
+            f"{name:<28}{stats['count']:>10}{share:>8.1%}{stats['mean_ns'] / 1e3:>10.1f}"
+            f"{stats['p50_ns'] / 1e3:>10.1f}{stats['p99_ns'] / 1e3:>10.1f}{stats['max_ns'] / 1e3:>10.1f}"
+        )
+    for name, amount in sorted(summary["counters"].items()):
+        lines.append(f"{name:<28}{amount:>10}")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Prints the summaries written by an Exporter")
+    parser.add_argument("path")
+    parser.add_argument("--total", action="store_true", help="merge all intervals into one summary")
+    args = parser.parse_args()
+
+    with open(args.path) as f:
+        summaries = [json.loads(line) for line in f if line.strip()]
+    if not summaries:
+        sys.exit(f"{args.path} has no summaries")
+    if args.total:
+        stages: Dict[str, StageStats] = {}
+        counters: Dict[str, int] = {}
+        for summary in summaries:
+            for name, data in summary["stages"].items():
+                stages.setdefault(name, StageStats()).merge(StageStats.from_dict(data))
+            for name, amount in summary["counters"].items():
+                counters[name] = counters.get(name, 0) + amount
+        episodes = sum(summary["episodes"] for summary in summaries)
+        seconds = sum(summary["seconds"] for summary in summaries)
+        summaries = [
+            {
+                "episode": summaries[-1]["episode"],
+                "episodes": episodes,
+                "seconds": seconds,
+                "episodes_per_second": episodes / seconds if seconds else 0.0,
+                "stages": {name: stats.to_dict() for name, stats in stages.items()},
+                "counters": counters,
+            }
+        ]
+    for summary in summaries:
+        print(format_summary(summary) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Card counting maintained incrementally by the environment
+
+Counts are over the cards the player has seen: every card dealt since the shoe was last restored
+and discarded at a reset (the `discarded` counts of GameState), plus the player's own hand.
+The dealer's cards of the current round are hidden from the player, they are counted at the next reset.
+
+Deck keeps the Hi-Lo and KO running counts of every dealt card, updated on each draw.
+At a reset all dealt cards are discarded, so the player's counts start from the deck's and
+CardCounter then adds every card dealt to the player, in O(1) per card.
+
+CardCount is the snapshot held by GameState.card_count. For VectorGameState its fields are arrays with
+one value (or row) per table. It is featurized by game.models.features as optional blocks, see COUNT_BLOCKS.
+"""
+from typing import NamedTuple, Tuple, Union
+
+import numpy as np
+
+from game.models.constant import Card
+
+NUM_RANKS = len(Card)
+CARDS_PER_DECK = NUM_RANKS * 4
+# weight of each rank, indexed by card - 1
+HI_LO_WEIGHTS = np.array([-1, 1, 1, 1, 1, 1, 0, 0, 0, -1, -1, -1, -1], dtype=np.int64)
+KO_WEIGHTS = np.array([-1, 1, 1, 1, 1, 1, 1, 0, 0, -1, -1, -1, -1], dtype=np.int64)
+_HI_LO_WEIGHTS = HI_LO_WEIGHTS.tolist()
+_KO_WEIGHTS = KO_WEIGHTS.tolist()
+# true counts never divide by less than half a deck
+MIN_DECKS = 0.5
+# running and true counts are divided by this in the features, to keep them close to the other features
+COUNT_SCALE = 10.0
+
+# feature blocks and their sizes:
+# hi_lo: running count, true count
+# ko: running count, true count
+# remaining: fraction of each rank among the cards the player has not seen
+HI_LO, KO, REMAINING = "hi_lo", "ko", "remaining"
+COUNT_BLOCKS = {HI_LO: 2, KO: 2, REMAINING: NUM_RANKS}
+
+
+def ko_initial_count(deck_nums: int) -> int:
+    """
+    KO is unbalanced, the running count starts at 4 - 4 * deck_nums so that it ends at +4 for a full shoe
+    """
+    return 4 - 4 * deck_nums
+
+
+def count_blocks_size(count_blocks=()) -> int:
+    for block in count_blocks:
+        if block not in COUNT_BLOCKS:
+            raise ValueError(f"unknown count block {block}, has to be one of {list(COUNT_BLOCKS)}")
+    return sum(COUNT_BLOCKS[block] for block in count_blocks)
+
+
+class CardCount(NamedTuple):
+    """
+    Counts over the cards the player has seen
+    """
+    hi_lo: Union[int, np.ndarray]
+    ko: Union[int, np.ndarray]
+    # cards of each rank the player has not seen, indexed by card - 1
+    unseen: Union[Tuple[int, ...], np.ndarray]
+    num_unseen: Union[int, np.ndarray]
+    # cards left in the shoe, Deck.get_remaining_cards
+    remaining_cards: Union[int, np.ndarray]
+
+    def decks_remaining(self):
+        return np.maximum(np.divide(self.remaining_cards, CARDS_PER_DECK), MIN_DECKS)
+
+    def true_count(self):
+        return np.divide(self.hi_lo, self.decks_remaining())
+
+    def ko_true_count(self):
+        return np.divide(self.ko, self.decks_remaining())
+
+
+class CardCounter:
+    """
+    Counts of one player over one shoe, start_round at every reset then see every card dealt to the player
+    """
+
+    def __init__(self, deck_nums: int):
+        self.deck_nums = deck_nums
+        self.hi_lo = 0
+        self.ko = ko_initial_count(deck_nums)
+        self.unseen = [4 * deck_nums] * NUM_RANKS
+        self.num_unseen = CARDS_PER_DECK * deck_nums
+
+    def start_round(self, deck) -> None:
+        """
+        Every card dealt from deck so far has been discarded and seen
+        """
+        self.hi_lo = deck.hi_lo_count
+        self.ko = deck.ko_count
+        self.unseen = deck.remaining_counts.tolist()
+        self.num_unseen = deck.get_remaining_cards()
+
+    def see(self, card: int) -> None:
+        idx = card - 1
+        self.hi_lo += _HI_LO_WEIGHTS[idx]
+        self.ko += _KO_WEIGHTS[idx]
+        self.unseen[idx] -= 1
+        self.num_unseen -= 1
+
+    def snapshot(self, remaining_cards: int) -> CardCount:
+        return CardCount(self.hi_lo, self.ko, tuple(self.unseen), self.num_unseen, remaining_cards)
+
+
+def write_count_blocks(card_count: CardCount, out: np.ndarray, count_blocks=()) -> np.ndarray:
+    """
+    Writes count_blocks, in the given order, into the last axis of out,
+    a 1D row for a single state or a (N, size) matrix for a batched CardCount
+    """
+    offset = 0
+    for block in count_blocks:
+        if block == HI_LO:
+            out[..., offset] = np.divide(card_count.hi_lo, COUNT_SCALE)
+            out[..., offset + 1] = card_count.true_count() / COUNT_SCALE
+        elif block == KO:
+            out[..., offset] = np.divide(card_count.ko, COUNT_SCALE)
+            out[..., offset + 1] = card_count.ko_true_count() / COUNT_SCALE
+        elif block == REMAINING:
+            num_unseen = np.maximum(card_count.num_unseen, 1)
+            np.divide(
+                card_count.unseen,
+                np.expand_dims(num_unseen, -1),
+                out=out[..., offset : offset + NUM_RANKS],
+            )
+        else:
+            raise ValueError(f"unknown count block {block}, has to be one of {list(COUNT_BLOCKS)}")
+        offset += COUNT_BLOCKS[block]
+    return out
@@ -1,27 +1,137 @@
 import numpy as np
 
 from game.models.constant import Card
+from game.models.counting import HI_LO_WEIGHTS, KO_WEIGHTS, ko_initial_count
+
+# Card member for each rank value, so drawing does not go through the Enum constructor
+CARDS = (None,) + tuple(Card)
+# count weights indexed by rank, as python ints for draw
+_HI_LO_WEIGHTS = (0,) + tuple(HI_LO_WEIGHTS.tolist())
+_KO_WEIGHTS = (0,) + tuple(KO_WEIGHTS.tolist())
 
 
 class Deck:
     """
     A Deck simulates the behaviour of a Deck. We allow multiple decks to be used, but at least 1 deck must be used.
+
+    The shoe is a fixed int8 array of card ranks, cards are drawn from the end of the first `cursor` entries.
+    remaining_counts[card - 1] is the number of cards of that rank still in the shoe.
+    hi_lo_count and ko_count are the running counts of every card dealt since the shoe was last restored,
+    see game.models.counting.
     """
 
-    def __init__(self, deck_nums: int):
+    def __init__(self, deck_nums: int, rng=None, penetration: float = 0.5):
+        """
+        rng is any object with a numpy-style shuffle method, e.g. a np.random.Generator
+        if not given, the global np.random state is used
+        penetration is the fraction of the shoe that is dealt before needs_reshuffle is True
+        """
         if deck_nums < 1:
             raise ValueError("deck_nums has to be >= 1")
+        if not 0 < penetration <= 1:
+            raise ValueError("penetration has to be in (0, 1]")
+
+        self.rng = rng if rng is not None else np.random
+        self.deck_nums = deck_nums
+        self.size = deck_nums * len(Card) * 4
+        self.reshuffle_at = int(self.size * (1 - penetration))
 
-        one_suit_of_cards = [card for card in Card]
-        one_deck_of_cards = one_suit_of_cards * 4
-        self.cards = one_deck_of_cards * deck_nums
+        one_suit_of_cards = np.arange(1, len(Card) + 1, dtype=np.int8)
+        self._ordered_cards = np.tile(one_suit_of_cards, 4 * deck_nums)
+        self._ranks = one_suit_of_cards
+        self.cards = self._ordered_cards.copy()
+        self.cursor = self.size
+        self.remaining_counts = np.full(len(Card), 4 * deck_nums, dtype=np.int64)
+        self.hi_lo_count = 0
+        self.ko_count = ko_initial_count(deck_nums)
         self.shuffle()
 
+    def __getstate__(self) -> dict:
+        # the global np.random module can not be pickled, its state has to be saved separately
+        state = self.__dict__.copy()
+        if state["rng"] is np.random:
+            state["rng"] = None
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        if self.rng is None:
+            self.rng = np.random
+
     def shuffle(self):
-        np.random.shuffle(self.cards)
+        """
+        Shuffles the cards that are still in the shoe
+        """
+        self.rng.shuffle(self.cards[: self.cursor])
+
+    def restore(self):
+        """
+        Puts every card back into the shoe, in place, and shuffles it.
+        Same as building a new Deck, without allocating a new shoe.
+        """
+        self.cards[:] = self._ordered_cards
+        self.cursor = self.size
+        self.remaining_counts[:] = 4 * self.deck_nums
+        self.hi_lo_count = 0
+        self.ko_count = ko_initial_count(self.deck_nums)
+        self.shuffle()
+
+    def sort(self):
+        """
+        Puts the cards still in the shoe in rank order, so the next shuffle only depends on
+        which cards are left and the rng, not on the order of earlier shuffles
+        """
+        self.cards[: self.cursor] = np.repeat(self._ranks, self.remaining_counts)
+
+    def set_remaining_counts(self, remaining_counts) -> None:
+        """
+        Leaves exactly remaining_counts[card - 1] cards of each rank in the shoe, in rank order,
+        as if the other cards had been dealt since the shoe was restored
+        """
+        remaining_counts = np.asarray(remaining_counts, dtype=np.int64)
+        if remaining_counts.shape != (len(Card),) or (remaining_counts < 0).any() or (
+            remaining_counts > 4 * self.deck_nums
+        ).any():
+            raise ValueError(f"remaining_counts has to be {len(Card)} counts from 0 to {4 * self.deck_nums}")
+        self.remaining_counts[:] = remaining_counts
+        self.cursor = int(remaining_counts.sum())
+        dealt = self.get_dealt_counts()
+        self.hi_lo_count = int(dealt @ HI_LO_WEIGHTS)
+        self.ko_count = ko_initial_count(self.deck_nums) + int(dealt @ KO_WEIGHTS)
+        self.sort()
 
-    def draw(self):
-        return self.cards.pop()
+    def needs_reshuffle(self) -> bool:
+        return self.cursor < self.reshuffle_at
+
+    def draw(self) -> Card:
+        if self.cursor == 0:
+            raise IndexError("draw from an empty deck")
+        self.cursor -= 1
+        card = self.cards[self.cursor]
+        self.remaining_counts[card - 1] -= 1
+        self.hi_lo_count += _HI_LO_WEIGHTS[card]
+        self.ko_count += _KO_WEIGHTS[card]
+        return CARDS[card]
+
+    def draw_many(self, k: int) -> np.ndarray:
+        """
+        Draws k cards at once, returned as ranks in the order k calls to draw would return them
+        """
+        if k > self.cursor:
+            raise IndexError("draw from an empty deck")
+        cards = self.cards[self.cursor - k : self.cursor][::-1].copy()
+        self.cursor -= k
+        self.remaining_counts -= np.bincount(cards, minlength=len(Card) + 1)[1:]
+        for card in cards.tolist():
+            self.hi_lo_count += _HI_LO_WEIGHTS[card]
+            self.ko_count += _KO_WEIGHTS[card]
+        return cards
 
     def get_remaining_cards(self) -> int:
-        return len(self.cards)
+        return self.cursor
+
+    def get_dealt_counts(self) -> np.ndarray:
+        """
+        Number of cards of each rank dealt since the shoe was last restored
+        """
+        return 4 * self.deck_nums - self.remaining_counts
@@ -0,0 +1,163 @@
+"""
+Featurization of GameState into preallocated buffers
+
+The layout is the one of GameState.flatten:
+    hand counts / deck_nums (13) | discarded counts / deck_nums (13) | bet percent | remaining cash / initial cash | [step num]
+but features are written in place into a row of an existing array, so no list, array or tensor
+is allocated per step.
+
+count_blocks optionally appends card counting blocks after these, in the given order,
+from the state's card_count, see game.models.counting.COUNT_BLOCKS.
+"""
+from typing import Optional, Sequence, Union
+
+import numpy as np
+
+from game.models.constant import Card
+from game.models.counting import count_blocks_size, write_count_blocks
+
+NUM_RANKS = len(Card)
+DISCARDED_OFFSET = NUM_RANKS
+BET_PERCENT_IDX = 2 * NUM_RANKS
+REMAINING_CASH_IDX = 2 * NUM_RANKS + 1
+STEP_NUM_IDX = 2 * NUM_RANKS + 2
+
+
+def feature_size(add_steps: bool = False, count_blocks: Sequence[str] = ()) -> int:
+    return STEP_NUM_IDX + (1 if add_steps else 0) + count_blocks_size(count_blocks)
+
+
+def _write_counts(card_count, out: np.ndarray, add_steps: bool, count_blocks: Sequence[str]) -> None:
+    if card_count is None:
+        raise ValueError("count_blocks need states with a card_count")
+    write_count_blocks(card_count, out[..., feature_size(add_steps) :], count_blocks)
+
+
+def write_features(
+    state,
+    out: np.ndarray,
+    include_discarded: bool = True,
+    step_num: Optional[float] = None,
+    count_blocks: Sequence[str] = (),
+) -> np.ndarray:
+    """
+    Writes the features of a single GameState into out, a 1D array of at least
+    feature_size(step_num is not None, count_blocks)
+    """
+    deck_nums = state.deck_nums
+    out.fill(0)
+    for card, amount in state.hand.items():
+        out[card - 1] = amount / deck_nums
+    if include_discarded:
+        for card, amount in state.discarded.items():
+            out[DISCARDED_OFFSET + card - 1] = amount / deck_nums
+    out[BET_PERCENT_IDX] = state.bet_percent or 0
+    out[REMAINING_CASH_IDX] = state.remaining_cash / state.initial_cash
+    if step_num is not None:
+        out[STEP_NUM_IDX] = step_num
+    if count_blocks:
+        _write_counts(state.card_count, out, step_num is not None, count_blocks)
+    return out
+
+
+def write_batch_features(
+    states,
+    out: np.ndarray,
+    include_discarded: bool = True,
+    step_num: Union[None, float, np.ndarray] = None,
+    count_blocks: Sequence[str] = (),
+) -> np.ndarray:
+    """
+    Writes the features of many states into the first len(states) rows of out.
+    states is either a VectorGameState, which is featurized with whole array operations,
+    or a sequence of GameState. step_num is a scalar or one value per state.
+    """
+    num_states = len(states)
+    rows = out[:num_states]
+    add_steps = step_num is not None
+    if isinstance(states, Sequence):
+        for idx, state in enumerate(states):
+            write_features(state, rows[idx], include_discarded=include_discarded)
+            if count_blocks:
+                _write_counts(state.card_count, rows[idx], add_steps, count_blocks)
+    else:
+        np.divide(states.hand, states.deck_nums, out=rows[:, :NUM_RANKS])
+        discarded = rows[:, DISCARDED_OFFSET : DISCARDED_OFFSET + NUM_RANKS]
+        if include_discarded:
+            np.divide(states.discarded, states.deck_nums, out=discarded)
+        else:
+            discarded.fill(0)
+        rows[:, BET_PERCENT_IDX] = states.bet_percent
+        np.divide(states.remaining_cash, states.initial_cash, out=rows[:, REMAINING_CASH_IDX])
+        if count_blocks:
+            _write_counts(states.card_count, rows, add_steps, count_blocks)
+    if add_steps:
+        rows[:, STEP_NUM_IDX] = step_num
+    return rows
+
+
+class FeatureBuffer:
+    """
+    Preallocated (num_rows, state_size) feature matrix, reused across steps.
+    With torch_tensor=True the storage is a torch tensor (pinned if pin_memory=True)
+    and array is a numpy view on it, so writing rows fills the tensor directly.
+    """
+
+    def __init__(
+        self,
+        num_rows: int,
+        add_steps: bool = False,
+        include_discarded: bool = True,
+        dtype=np.float32,
+        torch_tensor: bool = False,
+        pin_memory: bool = False,
+        count_blocks: Sequence[str] = (),
+    ):
+        self.add_steps = add_steps
+        self.include_discarded = include_discarded
+        self.count_blocks = tuple(count_blocks)
+        self.state_size = feature_size(add_steps, self.count_blocks)
+        self.tensor = None
+        if torch_tensor:
+            import torch
+
+            self.tensor = torch.zeros(
+                (num_rows, self.state_size),
+                dtype=torch.from_numpy(np.zeros(0, dtype=dtype)).dtype,
+                pin_memory=pin_memory,
+            )
+            self.array = self.tensor.numpy()
+        else:
+            self.array = np.zeros((num_rows, self.state_size), dtype=dtype)
+
+    def _check_step_num(self, step_num) -> None:
+        if self.add_steps and step_num is None:
+            raise ValueError("step_num is required when the buffer is built with add_steps=True")
+        if not self.add_steps and step_num is not None:
+            raise ValueError("step_num given but the buffer is built with add_steps=False")
+
+    def write(self, row: int, state, step_num: Optional[float] = None) -> np.ndarray:
+        """
+        Writes one state into the given row and returns that row
+        """
+        self._check_step_num(step_num)
+        return write_features(
+            state,
+            self.array[row],
+            include_discarded=self.include_discarded,
+            step_num=step_num,
+            count_blocks=self.count_blocks,
+        )
+
+    def write_batch(self, states, step_num: Union[None, float, np.ndarray] = None) -> np.ndarray:
+        """
+        Writes states into the first len(states) rows and returns those rows
+        """
+        self._check_step_num(step_num)
+        return write_batch_features(
+            states,
+            self.array,
+            include_discarded=self.include_discarded,
+            step_num=step_num,
+            count_blocks=self.count_blocks,
+        )
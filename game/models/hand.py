@@ -0,0 +1,112 @@
+"""
+Precomputed hand scoring
+
+A hand is summarised by (hard_total, num_aces, num_cards), where hard_total counts every ace as 1.
+That is enough to score it the same way Player used to walk its Counter:
+- at most one ace can ever be counted as 11, and only if the total stays <= 21
+- a 2 card hand of 2 aces is counted as 21
+Every hard total above 21 scores the same, so the tables are indexed by
+[min(hard_total, BUST_TOTAL), has_ace, is_two_cards].
+"""
+from typing import Tuple
+
+import numpy as np
+
+from game.models.constant import Card
+
+BUST_TOTAL = 22
+# value of each rank when an ace is counted as 1, indexed by card - 1
+RANK_VALUES = np.array([min(card, 10) for card in Card], dtype=np.int64)
+
+
+def _build_tables() -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    shape = (BUST_TOTAL + 1, 2, 2)
+    # amount added to hard_total to get the hand value
+    bonus = np.zeros(shape, dtype=np.int64)
+    soft = np.zeros(shape, dtype=bool)
+    bust = np.zeros(shape, dtype=bool)
+    natural = np.zeros(shape, dtype=bool)
+    for hard_total in range(BUST_TOTAL + 1):
+        for has_ace in (0, 1):
+            for two_cards in (0, 1):
+                idx = hard_total, has_ace, two_cards
+                if has_ace and two_cards and hard_total == 2:
+                    bonus[idx] = 19
+                elif has_ace and hard_total + 10 <= 21:
+                    bonus[idx] = 10
+                value = hard_total + bonus[idx]
+                soft[idx] = bonus[idx] > 0
+                bust[idx] = value > 21
+                natural[idx] = two_cards and value == 21
+    return bonus, soft, bust, natural
+
+
+ACE_BONUS, IS_SOFT, IS_BUST, IS_NATURAL = _build_tables()
+
+# flat python copies for scalar lookups, indexed by _table_idx
+_ACE_BONUS = ACE_BONUS.ravel().tolist()
+_IS_SOFT = IS_SOFT.ravel().tolist()
+_IS_BUST = IS_BUST.ravel().tolist()
+_IS_NATURAL = IS_NATURAL.ravel().tolist()
+
+
+def _table_idx(hard_total: int, num_aces: int, num_cards: int) -> int:
+    return (min(hard_total, BUST_TOTAL) * 2 + (num_aces > 0)) * 2 + (num_cards == 2)
+
+
+def get_hand_value(hard_total: int, num_aces: int, num_cards: int) -> int:
+    return hard_total + _ACE_BONUS[_table_idx(hard_total, num_aces, num_cards)]
+
+
+def is_soft(hard_total: int, num_aces: int, num_cards: int) -> bool:
+    return _IS_SOFT[_table_idx(hard_total, num_aces, num_cards)]
+
+
+def is_bust(hard_total: int, num_aces: int, num_cards: int) -> bool:
+    return _IS_BUST[_table_idx(hard_total, num_aces, num_cards)]
+
+
+def is_natural(hard_total: int, num_aces: int, num_cards: int) -> bool:
+    return _IS_NATURAL[_table_idx(hard_total, num_aces, num_cards)]
+
+
+def batch_table_idx(hard_totals: np.ndarray, num_aces: np.ndarray, num_cards: np.ndarray):
+    """
+    Integer index arrays into the tables, boolean arrays would be taken as masks
+    """
+    return (
+        np.minimum(hard_totals, BUST_TOTAL),
+        (num_aces > 0).astype(np.intp),
+        (num_cards == 2).astype(np.intp),
+    )
+
+
+def batch_hand_values(hard_totals: np.ndarray, num_aces: np.ndarray, num_cards: np.ndarray) -> np.ndarray:
+    """
+    Vectorized get_hand_value
+    """
+    return hard_totals + ACE_BONUS[batch_table_idx(hard_totals, num_aces, num_cards)]
+
+
+def batch_score_hands(
+    hard_totals: np.ndarray, num_aces: np.ndarray, num_cards: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns hand values and soft, bust and natural blackjack flags of a batch of hands
+    """
+    idx = batch_table_idx(hard_totals, num_aces, num_cards)
+    return hard_totals + ACE_BONUS[idx], IS_SOFT[idx], IS_BUST[idx], IS_NATURAL[idx]
+
+
+def hand_summary(counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    (hard_total, num_aces, num_cards) of rank count vectors, counts has shape (..., 13)
+    """
+    return counts @ RANK_VALUES, counts[..., Card.ace - 1], counts.sum(axis=-1)
+
+
+def batch_count_values(counts: np.ndarray) -> np.ndarray:
+    """
+    Hand values of rank count vectors, counts has shape (..., 13)
+    """
+    return batch_hand_values(*hand_summary(counts))
@@ -1,54 +1,110 @@
 from collections import Counter
-from typing import Optional, List
+from typing import TYPE_CHECKING, Optional, Sequence
 
 import numpy as np
-import torch
-from pydantic import BaseModel
 
 from game.models.constant import Card, PlayerType
+from game.models.counting import CardCount
+from game.models.features import feature_size, write_features
 
+if TYPE_CHECKING:
+    import torch
 
-class GameState(BaseModel):
-    deck_nums: int
-    initial_cash: int
-    turn: PlayerType
-    hand: Counter[Card]
-    discarded: Counter[Card]
-    bet_percent: Optional[float]  # % of my remaining cash I am betting
-    remaining_cash: int  # total cash I have left
+
+class GameState:
+    """
+    State of the player, returned by BlackjackWrapper on every step.
+    A plain slotted class so that no validation happens on the hot path,
+    see game.models.schema for the validated pydantic version.
+    """
+
+    __slots__ = (
+        "deck_nums",
+        "initial_cash",
+        "turn",
+        "hand",
+        "discarded",
+        "bet_percent",
+        "remaining_cash",
+        "card_count",
+    )
+
+    def __init__(
+        self,
+        deck_nums: int,
+        initial_cash: int,
+        turn: PlayerType,
+        hand: Counter[Card],
+        discarded: Counter[Card],
+        bet_percent: Optional[float],  # % of my remaining cash I am betting
+        remaining_cash: int,  # total cash I have left
+        card_count: Optional[CardCount] = None,  # counts over the cards I have seen, see game.models.counting
+    ):
+        self.deck_nums = deck_nums
+        self.initial_cash = initial_cash
+        self.turn = turn
+        self.hand = hand
+        self.discarded = discarded
+        self.bet_percent = bet_percent
+        self.remaining_cash = remaining_cash
+        self.card_count = card_count
+
+    def _fields(self) -> tuple:
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, GameState):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{field}={getattr(self, field)!r}" for field in self.__slots__)
+        return f"GameState({fields})"
 
     @staticmethod
-    def get_state_size(add_steps: bool = False) -> int:
-        # number of cards in hand + number of cards discarded + bet percent + remaining cash
-        return len(Card) * 2 + 2 + (1 if add_steps else 0)
+    def get_state_size(add_steps: bool = False, count_blocks: Sequence[str] = ()) -> int:
+        # number of cards in hand + number of cards discarded + bet percent + remaining cash + count blocks
+        return feature_size(add_steps=add_steps, count_blocks=count_blocks)
 
-    def flatten(self, include_discarded: bool = True, step_num: Optional[float] = None) -> np.ndarray:
+    def flatten(
+        self, include_discarded: bool = True, step_num: Optional[float] = None, count_blocks: Sequence[str] = ()
+    ) -> np.ndarray:
         """
         Flattens the response into a 1D numpy array. Used as input for backend ML training.
         """
-        output = []
-        for card in Card:
-            output.append(self.hand[card] / self.deck_nums if card in self.hand else 0)
-        for card in Card:
-            output.append(
-                self.discarded[card] / self.deck_nums
-                if include_discarded and card in self.discarded
-                else 0
-            )
-        output.append(self.bet_percent or 0)
-        output.append(self.remaining_cash / self.initial_cash)
-        if step_num is not None:
-            output.append(step_num)
-        return np.array(output)
-
-    def torch_flatten(self, device, include_discarded: bool = True, step_num: Optional[float] = None) -> torch.Tensor:
-        return torch.Tensor(self.flatten(include_discarded=include_discarded, step_num=step_num)).unsqueeze(0).to(device)
-
-
-class ActionOutcome(BaseModel):
-    new_state: GameState
-    # amount of cash won/loss
-    # should be int but left as float for convenience
-    reward: float
-    # single game has ended
-    terminated: bool
+        size = self.get_state_size(add_steps=step_num is not None, count_blocks=count_blocks)
+        return write_features(
+            self, np.zeros(size), include_discarded=include_discarded, step_num=step_num, count_blocks=count_blocks
+        )
+
+    def torch_flatten(self, device, include_discarded: bool = True, step_num: Optional[float] = None) -> "torch.Tensor":
+        """
+        Same as flatten as a (1, state_size) tensor, torch is only imported on the first call
+        """
+        from game.models.torch_adapter import state_to_tensor
+
+        return state_to_tensor(self, device, include_discarded=include_discarded, step_num=step_num)
+
+
+class ActionOutcome:
+    __slots__ = ("new_state", "reward", "terminated")
+
+    def __init__(self, new_state: GameState, reward: float, terminated: bool):
+        self.new_state = new_state
+        # amount of cash won/loss
+        # should be int but left as float for convenience
+        self.reward = reward
+        # single game has ended
+        self.terminated = terminated
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, ActionOutcome):
+            return NotImplemented
+        return (self.new_state, self.reward, self.terminated) == (
+            other.new_state,
+            other.reward,
+            other.terminated,
+        )
+
+    def __repr__(self) -> str:
+        return f"ActionOutcome(new_state={self.new_state!r}, reward={self.reward!r}, terminated={self.terminated!r})"
@@ -1,7 +1,11 @@
-from typing import List, Union
 from collections import Counter
 
+from game.models import hand as hand_lookup
 from game.models.constant import Card, PlayerType
+from game.models.deck import CARDS
+
+# value of each card when an ace is counted as 1, indexed by card
+_CARD_VALUES = [0] + hand_lookup.RANK_VALUES.tolist()
 
 
 class Player:
@@ -12,50 +16,40 @@ class Player:
     def __init__(self, player_type: PlayerType):
         self.player_type = player_type
         self.hand: Counter[Card] = Counter()
+        # compact summary of hand used for scoring, see game.models.hand
+        self.hard_total: int = 0
+        self.num_aces: int = 0
+        self.num_cards: int = 0
 
     def get_hand_value(self) -> int:
-        def get_value_with_aces(hand):
-            # This method deals with hands that have an ace.
-            # First case is where there are only 2 cards and they are both aces
-            total_cards = sum(hand.values())
-            if total_cards == 2 and hand[Card.ace] == 2:
-                return 21
-            # Second case is where there is only 1 ace and the other card is a 10 value card
-            elif total_cards == 2 and hand[Card.ace] == 1 and (hand[Card.jack] == 1 or
-                                                               hand[Card.queen] == 1 or
-                                                               hand[Card.king] == 1 or
-                                                               hand[Card.ten] == 1):
-                return 21
-            # Third case is where there are an arbitrary number of aces and arbitrary number of other cards
-            # In this case, there are 2 possibilities: The aces are either 1 or 11
-            # We will try to make the aces 11 first, and if the value of the hand is > 21, we will make the ace 1
-            else:
-                hand_value = 0
-                for card, count in hand.items():
-                    if card in [Card.jack, Card.queen, Card.king]:
-                        hand_value += 10 * count
-                    else:
-                        hand_value += card * count
-                # Now we will try to make the aces 11
-                for i in range(hand[Card.ace]):
-                    if hand_value + 10 <= 21:
-                        hand_value += 10
-                return hand_value
-        hand_value = 0
-        # Separate the ace cases from the rest of the cards
-        if Card.ace not in self.hand:
-            for card, count in self.hand.items():
-                if card in [Card.jack, Card.queen, Card.king]:
-                    hand_value += 10 * count
-                else:
-                    hand_value += card * count
-            return hand_value
-        else:
-            return get_value_with_aces(self.hand)
+        return hand_lookup.get_hand_value(self.hard_total, self.num_aces, self.num_cards)
 
-    def draw(self, deck) -> None:
-        card = deck.draw()
+    def is_soft(self) -> bool:
+        return hand_lookup.is_soft(self.hard_total, self.num_aces, self.num_cards)
+
+    def is_bust(self) -> bool:
+        return hand_lookup.is_bust(self.hard_total, self.num_aces, self.num_cards)
+
+    def is_natural(self) -> bool:
+        return hand_lookup.is_natural(self.hard_total, self.num_aces, self.num_cards)
+
+    def _add_card(self, card: Card) -> None:
         self.hand[card] += 1
+        self.hard_total += _CARD_VALUES[card]
+        self.num_aces += card == Card.ace
+        self.num_cards += 1
+
+    def draw(self, deck) -> Card:
+        card = deck.draw()
+        self._add_card(card)
+        return card
+
+    def add_cards(self, cards) -> None:
+        """
+        Adds cards given as ranks, e.g. from Deck.draw_many
+        """
+        for card in cards:
+            self._add_card(CARDS[card])
 
     def reset_hand(self) -> Counter[Card]:
         """
@@ -64,4 +58,7 @@ class Player:
 
         discarded = self.hand
         self.hand = Counter()
+        self.hard_total = 0
+        self.num_aces = 0
+        self.num_cards = 0
         return discarded
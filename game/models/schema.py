@@ -0,0 +1,53 @@
+"""
+Validated pydantic versions of the game models, for use at boundaries
+(serialization, requests from other services), not on the simulation hot path.
+"""
+from collections import Counter
+from typing import Optional
+
+from pydantic import BaseModel
+
+from game.models.constant import Card, PlayerType
+from game.models.model import ActionOutcome, GameState
+
+
+class GameStateSchema(BaseModel):
+    deck_nums: int
+    initial_cash: int
+    turn: PlayerType
+    hand: Counter[Card]
+    discarded: Counter[Card]
+    bet_percent: Optional[float]  # % of my remaining cash I am betting
+    remaining_cash: int  # total cash I have left
+
+    @classmethod
+    def from_state(cls, state: GameState) -> "GameStateSchema":
+        # card_count is derived from the shoe and not part of the schema
+        return cls(**{field: getattr(state, field) for field in cls.__fields__})
+
+    def to_state(self) -> GameState:
+        return GameState(**self.dict())
+
+
+class ActionOutcomeSchema(BaseModel):
+    new_state: GameStateSchema
+    # amount of cash won/loss
+    # should be int but left as float for convenience
+    reward: float
+    # single game has ended
+    terminated: bool
+
+    @classmethod
+    def from_outcome(cls, outcome: ActionOutcome) -> "ActionOutcomeSchema":
+        return cls(
+            new_state=GameStateSchema.from_state(outcome.new_state),
+            reward=outcome.reward,
+            terminated=outcome.terminated,
+        )
+
+    def to_outcome(self) -> ActionOutcome:
+        return ActionOutcome(
+            new_state=self.new_state.to_state(),
+            reward=self.reward,
+            terminated=self.terminated,
+        )
@@ -0,0 +1,63 @@
+"""
+Counter based random streams, one per table and hand
+
+Every table draws from a Philox generator keyed by (seed, table_id). Philox is counter based, so the
+stream of hand h starts at counter h and can be positioned in O(1) without drawing the streams of
+hands 0 to h - 1: two tables never share a stream and any hand can be replayed on its own, in another
+process or on another machine.
+
+The shoe of a hand is the composition left from earlier hands in rank order, shuffled with the stream of
+the hand, so it only depends on (seed, table_id, hand_index) and which cards are left, i.e. on the
+discarded counts of the GameState at the start of the hand, see BlackjackWrapper.replay_hand.
+
+    streams = HandStreams(seed, table_id)
+    game_wrapper = BlackjackWrapper(initial_cash, deck_nums, min_bet, streams=streams)
+"""
+from typing import List, Optional
+
+import numpy as np
+
+# counter word holding the hand index, Philox advances word 0 on every draw so hands never overlap
+HAND_WORD = 2
+
+
+def table_seed_sequence(seed: Optional[int], table_id: int) -> np.random.SeedSequence:
+    """
+    Same child as np.random.SeedSequence(seed).spawn(table_id + 1)[table_id], as make_table_rngs uses
+    """
+    return np.random.SeedSequence(seed, spawn_key=(table_id,))
+
+
+class HandStreams:
+    """
+    Random streams of the hands of one table, hand(h) returns the shared generator positioned at hand h
+    """
+
+    def __init__(self, seed: int, table_id: int = 0):
+        if seed is None:
+            raise ValueError("HandStreams need a seed to be reproducible")
+        self.seed = seed
+        self.table_id = table_id
+        self.key = table_seed_sequence(seed, table_id).generate_state(2, np.uint64)
+        self.generator = np.random.Generator(np.random.Philox(key=self.key))
+        self._counter = np.zeros(4, dtype=np.uint64)
+        self._buffer = np.zeros(4, dtype=np.uint64)
+
+    def hand(self, hand_index: int) -> np.random.Generator:
+        """
+        Positions the generator at the start of the stream of hand_index, without drawing anything
+        """
+        self._counter[HAND_WORD] = hand_index
+        self.generator.bit_generator.state = {
+            "bit_generator": "Philox",
+            "state": {"counter": self._counter, "key": self.key},
+            "buffer": self._buffer,
+            "buffer_pos": 4,
+            "has_uint32": 0,
+            "uinteger": 0,
+        }
+        return self.generator
+
+
+def make_hand_streams(seed: int, num_tables: int) -> List[HandStreams]:
+    return [HandStreams(seed, table_id) for table_id in range(num_tables)]
@@ -0,0 +1,18 @@
+"""
+Conversion of game states to torch tensors
+
+Only this module imports torch, the rest of the game package works without it.
+It is loaded lazily by GameState.torch_flatten, or imported directly by training code.
+"""
+from typing import Optional
+
+import torch
+
+
+def state_to_tensor(
+    state, device=None, include_discarded: bool = True, step_num: Optional[float] = None
+) -> torch.Tensor:
+    """
+    Features of a single GameState as a (1, state_size) tensor
+    """
+    return torch.Tensor(state.flatten(include_discarded=include_discarded, step_num=step_num)).unsqueeze(0).to(device)
@@ -0,0 +1,252 @@
+"""
+Exact outcome probabilities under the rules of BlackjackWrapper
+
+Given the cards the player has not seen (the shoe composition, which follows from `discarded` and the hand
+in GameState), computes
+- the distribution of the dealer's final total (17, 18, 19, 20, 21, bust)
+- the player's exact expected value of standing and of hitting, in units of the bet
+
+Conditioning follows the game:
+- the dealer's 2 cards are dealt before the player acts, the player never sees them.
+  upcard can be given if known, otherwise both cards are unknown cards from the shoe.
+- the player only acts if the dealer has no natural blackjack, the dealer distribution is conditioned on that.
+- standing on 21 with exactly 2 distinct ranks in hand pays 2 times the bet without the dealer playing,
+  as BlackjackWrapper.card_step does.
+- the player may only stand from min_stand_value (16) on, BlackjackWrapper rejects earlier stands.
+
+The dealer is played out exactly once per query, on the shoe at decision time. The player's later hits are
+drawn from that shoe with exact removal of the player's own cards, but the dealer's distribution does not
+see them being removed, nor do the hit cards see the dealer's hidden cards. Stand EVs are exact, hit EVs
+are off by O(1 / shoe size): at most 0.005 bets on 1 deck, and smaller on bigger shoes. Playing the dealer
+again on every pool the player can reach would make a single query take seconds to minutes on 8 decks.
+
+Results are memoized with LRU caches, keyed on the composition. In a game nearly every state has a new
+composition: a cold query takes 10 to 40 ms (mostly the dealer recursion), a repeated one about 30 us,
+see probability_cold / probability_warm in benchmarks.suite.
+"""
+from collections import Counter
+from functools import lru_cache
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from game.models import hand as hand_lookup
+from game.models.constant import Card
+
+# final dealer totals, DEALER_OUTCOMES[-1] is a bust
+DEALER_OUTCOMES = (17, 18, 19, 20, 21, 22)
+NUM_RANKS = len(Card)
+# the dealer only needs card values, tens, jacks, queens and kings are merged into one class
+NUM_VALUES = 10
+RANK_TO_VALUE_IDX = tuple(min(card, 10) - 1 for card in Card)
+_ACE = 0
+
+Pool = Tuple[int, ...]
+
+
+def shoe_from_state(state) -> np.ndarray:
+    """
+    Rank counts of the cards the player has not seen, indexed by card - 1
+    """
+    shoe = np.full(NUM_RANKS, 4 * state.deck_nums, dtype=np.int64)
+    for card, amount in state.discarded.items():
+        shoe[card - 1] -= amount
+    for card, amount in state.hand.items():
+        shoe[card - 1] -= amount
+    return shoe
+
+
+def _as_counts(cards: Union[Counter, Sequence[int], np.ndarray]) -> Tuple[int, ...]:
+    if isinstance(cards, Counter):
+        return tuple(cards.get(card, 0) for card in Card)
+    return tuple(int(amount) for amount in cards)
+
+
+def _to_values(pool: Pool) -> Pool:
+    values = [0] * NUM_VALUES
+    for rank_idx, amount in enumerate(pool):
+        values[RANK_TO_VALUE_IDX[rank_idx]] += amount
+    return tuple(values)
+
+
+def _remove(pool: Pool, idx: int) -> Pool:
+    return pool[:idx] + (pool[idx] - 1,) + pool[idx + 1 :]
+
+
+def _accumulate(result: list, weight: float, distribution: Tuple[float, ...]) -> None:
+    for idx, prob in enumerate(distribution):
+        result[idx] += weight * prob
+
+
+def _dealer_value(hard_total: int, has_ace: bool, num_cards: int) -> int:
+    return hand_lookup.get_hand_value(hard_total, has_ace, num_cards)
+
+
+class ProbabilityEngine:
+    def __init__(self, max_cache_size: Optional[int] = 1 << 20, min_stand_value: int = 16):
+        """
+        max_cache_size bounds every memo table, None for unbounded
+        """
+        self.min_stand_value = min_stand_value
+        self._dealer_final = lru_cache(maxsize=max_cache_size)(self._dealer_final_uncached)
+        self._dealer_start = lru_cache(maxsize=max_cache_size)(self._dealer_start_uncached)
+        self._player_best = lru_cache(maxsize=max_cache_size)(self._player_best_uncached)
+        self._player_hit = lru_cache(maxsize=max_cache_size)(self._player_hit_uncached)
+
+    def cache_info(self) -> dict:
+        return {
+            "dealer_final": self._dealer_final.cache_info(),
+            "dealer_start": self._dealer_start.cache_info(),
+            "player_best": self._player_best.cache_info(),
+            "player_hit": self._player_hit.cache_info(),
+        }
+
+    def cache_clear(self) -> None:
+        for cached in (self._dealer_final, self._dealer_start, self._player_best, self._player_hit):
+            cached.cache_clear()
+
+    # dealer
+
+    def _dealer_final_uncached(self, hard_total: int, has_ace: bool, num_cards: int, pool: Pool) -> Tuple[float, ...]:
+        """
+        Final total distribution of a dealer hand that keeps drawing from pool (card values)
+        """
+        value = _dealer_value(hard_total, has_ace, num_cards)
+        if value >= 17:
+            result = [0.0] * len(DEALER_OUTCOMES)
+            result[min(value, 22) - 17] = 1.0
+            return tuple(result)
+
+        total = sum(pool)
+        result = [0.0] * len(DEALER_OUTCOMES)
+        for value_idx, amount in enumerate(pool):
+            if amount:
+                _accumulate(
+                    result,
+                    amount / total,
+                    self._dealer_final(
+                        hard_total + value_idx + 1,
+                        has_ace or value_idx == _ACE,
+                        min(num_cards + 1, 3),
+                        _remove(pool, value_idx),
+                    ),
+                )
+        return tuple(result)
+
+    def _dealer_start_uncached(self, pool: Pool, upcard: Optional[int]) -> Tuple[Tuple[float, ...], float]:
+        """
+        Final total distribution given that the dealer has no natural blackjack,
+        and the probability of that, for a dealer whose unknown cards come from pool (card values)
+        """
+        total = sum(pool)
+        result = [0.0] * len(DEALER_OUTCOMES)
+        no_natural = 0.0
+        firsts = [(upcard, 1.0, pool)] if upcard is not None else [
+            (idx, amount / total, _remove(pool, idx)) for idx, amount in enumerate(pool) if amount
+        ]
+        for first, first_prob, first_pool in firsts:
+            first_total = sum(first_pool)
+            for second, amount in enumerate(first_pool):
+                if not amount:
+                    continue
+                hard_total = first + second + 2
+                has_ace = _ACE in (first, second)
+                if _dealer_value(hard_total, has_ace, 2) == 21:
+                    continue
+                prob = first_prob * amount / first_total
+                no_natural += prob
+                _accumulate(
+                    result, prob, self._dealer_final(hard_total, has_ace, 2, _remove(first_pool, second))
+                )
+        if no_natural == 0:
+            return tuple(result), 0.0
+        return tuple(prob / no_natural for prob in result), no_natural
+
+    def dealer_distribution(self, shoe, upcard: Optional[Card] = None) -> np.ndarray:
+        """
+        Probabilities of the dealer ending on 17, 18, 19, 20, 21 or busting, given no dealer natural.
+        shoe holds the rank counts of all cards the player has not seen, upcard excluded.
+        """
+        distribution, _ = self._dealer_start(_to_values(_as_counts(shoe)), _upcard_value(upcard))
+        return np.array(distribution)
+
+    # player
+
+    def _stand_ev(self, value: int, rank_mask: int, dealer: Tuple[float, ...]) -> float:
+        if value > 21:
+            return -1.0
+        if value == 21 and bin(rank_mask).count("1") == 2:
+            # BlackjackWrapper pays this as a natural blackjack
+            return 2.0
+        ev = dealer[-1]
+        for dealer_total, prob in zip(DEALER_OUTCOMES[:-1], dealer[:-1]):
+            if dealer_total < value:
+                ev += prob
+            elif dealer_total > value:
+                ev -= prob
+        return ev
+
+    def _player_hit_uncached(
+        self, hard_total: int, has_ace: bool, num_cards: int, rank_mask: int, pool: Pool, dealer: Tuple[float, ...]
+    ) -> float:
+        total = sum(pool)
+        ev = 0.0
+        for rank_idx, amount in enumerate(pool):
+            if amount:
+                ev += amount / total * self._player_best(
+                    hard_total + RANK_TO_VALUE_IDX[rank_idx] + 1,
+                    has_ace or rank_idx == _ACE,
+                    min(num_cards + 1, 3),
+                    rank_mask | (1 << rank_idx),
+                    _remove(pool, rank_idx),
+                    dealer,
+                )
+        return ev
+
+    def _player_best_uncached(
+        self, hard_total: int, has_ace: bool, num_cards: int, rank_mask: int, pool: Pool, dealer: Tuple[float, ...]
+    ) -> float:
+        value = hand_lookup.get_hand_value(hard_total, has_ace, num_cards)
+        if value > 21:
+            return -1.0
+        hit = self._player_hit(hard_total, has_ace, num_cards, rank_mask, pool, dealer)
+        if value < self.min_stand_value:
+            return hit
+        return max(self._stand_ev(value, rank_mask, dealer), hit)
+
+    def _player_key(self, hand, shoe, upcard: Optional[Card]):
+        counts = _as_counts(hand)
+        pool = _as_counts(shoe)
+        hard_total = sum((RANK_TO_VALUE_IDX[idx] + 1) * amount for idx, amount in enumerate(counts))
+        rank_mask = sum(1 << idx for idx, amount in enumerate(counts) if amount)
+        # the dealer is played out once, on the shoe at decision time
+        dealer, _ = self._dealer_start(_to_values(pool), _upcard_value(upcard))
+        return hard_total, counts[_ACE] > 0, min(sum(counts), 3), rank_mask, pool, dealer
+
+    def stand_ev(self, hand, shoe, upcard: Optional[Card] = None) -> float:
+        """
+        Expected value of standing, in bets. hand and shoe are rank counts (Counter or 13 values).
+        Does not apply min_stand_value, BlackjackWrapper would give a -1 penalty instead.
+        """
+        hard_total, has_ace, num_cards, rank_mask, _, dealer = self._player_key(hand, shoe, upcard)
+        value = hand_lookup.get_hand_value(hard_total, has_ace, num_cards)
+        return self._stand_ev(value, rank_mask, dealer)
+
+    def hit_ev(self, hand, shoe, upcard: Optional[Card] = None) -> float:
+        """
+        Expected value of taking one card and then playing optimally, in bets
+        """
+        return self._player_hit(*self._player_key(hand, shoe, upcard))
+
+    def evaluate_state(self, state, upcard: Optional[Card] = None) -> Tuple[float, float]:
+        """
+        (stand EV, hit EV) of the player in a GameState
+        """
+        shoe = shoe_from_state(state)
+        if upcard is not None:
+            shoe[upcard - 1] -= 1
+        return self.stand_ev(state.hand, shoe, upcard), self.hit_ev(state.hand, shoe, upcard)
+
+
+def _upcard_value(upcard: Optional[Card]) -> Optional[int]:
+    return None if upcard is None else RANK_TO_VALUE_IDX[upcard - 1]
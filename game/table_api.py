@@ -0,0 +1,303 @@
+"""
+A table of several seats playing against one dealer from one shared shoe
+
+Unlike VectorBlackjackEnv, where every table has its own shoe, the seats of a BlackjackTable
+draw from the same Deck, so cards dealt to one seat are gone for the others and the discarded counts
+are the same for every seat, as at a real table.
+
+Cards are dealt in table order: one card to every seat, one to the dealer, a second card to every seat,
+then the dealer's second card. On a card_step the seats that hit draw one card each in seat order.
+Every seat sees only its own hand, so deciding all seats at once takes the same decisions as letting
+them play one after the other, and the shoe being shuffled, every seat gets the same distribution of cards.
+The dealer plays once, after the last seat has finished, and settles every seat that is still standing.
+
+With a single seat the table plays exactly like BlackjackWrapper given the same rng,
+until the seat runs out of cash: the table then only refills the seat's cash and keeps its shoe.
+
+The shoe is only reshuffled at a reset, once the penetration is reached, so with many seats and few decks
+it can run dry in the middle of a round. The discards are then put back and shuffled, as a dealer would:
+every card but the ones on the table returns to the shoe and the running counts start over.
+
+    table = BlackjackTable(num_seats=5, initial_cash=10000, deck_nums=8)
+    table.reset()
+    outcome = table.bet_step(model.get_bet_percents(table.get_state().flatten()).actions.numpy())
+    while not outcome.terminated.all():
+        outcome = table.card_step(model.get_card_actions(outcome.new_state.flatten()).actions.numpy())
+"""
+from collections import Counter
+from typing import Optional
+
+import numpy as np
+
+from game.models.constant import Card, PlayerType
+from game.models.counting import HI_LO_WEIGHTS, KO_WEIGHTS, CardCount, ko_initial_count
+from game.models.deck import Deck
+from game.models.hand import batch_count_values
+from game.models.model import GameState
+from game.models.streams import HandStreams
+from game.vector_api import VectorActionOutcome, VectorGameState
+
+NUM_RANKS = len(Card)
+
+
+class BlackjackTable:
+    """
+    num_seats players against one dealer, see BlackjackWrapper for the rules of a single seat.
+
+    A round is reset -> bet_step -> card_step until every seat has terminated.
+    in_play marks the seats whose card action is still needed, card_step ignores the action of every other seat.
+    A seat that stands waits for the dealer: it is not in play but not terminated either,
+    and its reward arrives, with terminated, on the card_step in which the dealer plays.
+    """
+
+    def __init__(
+        self,
+        num_seats: int,
+        initial_cash: int = 100,
+        deck_nums: int = 4,
+        min_bet: int = 10,
+        rng=None,
+        penetration: float = 0.5,
+        streams: Optional[HandStreams] = None,
+    ):
+        """
+        rng and penetration are passed on to the shared deck, see Deck.
+        streams replaces rng to shuffle every hand with its own stream, as in BlackjackWrapper
+        """
+        if num_seats < 1:
+            raise ValueError("num_seats has to be >= 1")
+        if rng is not None and streams is not None:
+            raise ValueError("pass either rng or streams, not both")
+
+        self.num_seats: int = num_seats
+        self.initial_cash: int = initial_cash
+        self.min_bet: int = min_bet
+        self.deck_nums: int = deck_nums
+        self.rng = rng
+        self.penetration: float = penetration
+        self.streams = streams
+        # incremented by every reset
+        self.hand_index: int = 0
+
+        deck_rng = rng if streams is None else streams.generator
+        self.deck = Deck(deck_nums=deck_nums, rng=deck_rng, penetration=penetration)
+        self._shuffle()
+        self.discarded: Counter[Card] = Counter()
+        self.discarded_counts = np.zeros(NUM_RANKS, dtype=np.int64)
+
+        self.hands = np.zeros((num_seats, NUM_RANKS), dtype=np.int64)
+        self.dealer_hand = np.zeros(NUM_RANKS, dtype=np.int64)
+        self.remaining_cash = np.full(num_seats, initial_cash, dtype=np.int64)
+        self.max_attained_cash = np.full(num_seats, initial_cash, dtype=np.int64)
+        self.player_bet_percent = np.zeros(num_seats, dtype=np.float64)
+        # seats whose card action is still needed, and seats that stood and wait for the dealer
+        self.in_play = np.zeros(num_seats, dtype=bool)
+        self.standing = np.zeros(num_seats, dtype=bool)
+        # running counts: the deck's at the start of the round, which every seat has seen,
+        # plus each seat's own cards, see game.models.counting
+        self.round_hi_lo = self.deck.hi_lo_count
+        self.round_ko = self.deck.ko_count
+        self.seat_hi_lo = np.zeros(num_seats, dtype=np.int64)
+        self.seat_ko = np.zeros(num_seats, dtype=np.int64)
+
+    def _shuffle(self) -> None:
+        if self.streams is not None:
+            self.deck.sort()
+            self.streams.hand(self.hand_index)
+        self.deck.shuffle()
+
+    def _restore_discards(self) -> None:
+        """
+        Puts every card that is not on the table back into the shoe and shuffles it
+        """
+        on_table = self.hands.sum(axis=0) + self.dealer_hand
+        self.deck.set_remaining_counts(4 * self.deck_nums - on_table)
+        self.deck.shuffle()
+        # the discards are back in the shoe, only the seats' own cards are still seen
+        self.discarded_counts = np.zeros(NUM_RANKS, dtype=np.int64)
+        self.discarded = Counter()
+        self.round_hi_lo = 0
+        self.round_ko = ko_initial_count(self.deck_nums)
+
+    def _draw(self, hand: np.ndarray) -> int:
+        if self.deck.get_remaining_cards() == 0:
+            self._restore_discards()
+        card = self.deck.draw() - 1
+        hand[card] += 1
+        return card
+
+    def _see(self, seat: int, card: int) -> None:
+        self.seat_hi_lo[seat] += HI_LO_WEIGHTS[card]
+        self.seat_ko[seat] += KO_WEIGHTS[card]
+
+    def _reward(self, seats: np.ndarray) -> np.ndarray:
+        cash = self.remaining_cash[seats]
+        return (
+            np.where(cash >= self.min_bet, cash, -self.max_attained_cash[seats])
+            / self.initial_cash
+        )
+
+    def _bet_amounts(self) -> np.ndarray:
+        return np.maximum(
+            np.trunc(self.remaining_cash * self.player_bet_percent).astype(np.int64),
+            self.min_bet,
+        )
+
+    def reset(self) -> "BlackjackTable":
+        """
+        Next round for every seat, see BlackjackWrapper.reset.
+        A seat that ran out of cash starts again with initial_cash, the shoe is kept.
+        """
+        self.hand_index += 1
+        broke = self.remaining_cash < self.min_bet
+        self.remaining_cash[broke] = self.initial_cash
+        self.max_attained_cash[broke] = self.initial_cash
+
+        self.hands[:] = 0
+        self.dealer_hand[:] = 0
+        self.player_bet_percent[:] = 0
+        self.in_play[:] = False
+        self.standing[:] = False
+
+        if self.deck.needs_reshuffle():
+            # used more than the penetration of the deck, recollect all cards
+            self.deck.restore()
+
+        # every card dealt from the shoe has been discarded at this point, the counter is shared by all seats
+        self.discarded_counts = self.deck.get_dealt_counts().astype(np.int64)
+        self.discarded = Counter(
+            {card: int(amount) for card, amount in zip(Card, self.discarded_counts) if amount}
+        )
+        self.round_hi_lo = self.deck.hi_lo_count
+        self.round_ko = self.deck.ko_count
+        self.seat_hi_lo[:] = 0
+        self.seat_ko[:] = 0
+
+        self._shuffle()
+        return self
+
+    def get_state(self) -> VectorGameState:
+        """
+        States of all seats, row i belongs to seat i
+        """
+        return VectorGameState(
+            deck_nums=self.deck_nums,
+            initial_cash=self.initial_cash,
+            hand=self.hands.copy(),
+            discarded=np.broadcast_to(self.discarded_counts, self.hands.shape),
+            bet_percent=self.player_bet_percent.copy(),
+            remaining_cash=self.remaining_cash.copy(),
+            hi_lo=self.round_hi_lo + self.seat_hi_lo,
+            ko=self.round_ko + self.seat_ko,
+            remaining_cards=np.full(self.num_seats, self.deck.get_remaining_cards()),
+        )
+
+    def get_seat_state(self, seat: int) -> GameState:
+        """
+        State of one seat, as BlackjackWrapper.get_state would return it
+        """
+        unseen = tuple((4 * self.deck_nums - self.discarded_counts - self.hands[seat]).tolist())
+        return GameState(
+            deck_nums=self.deck_nums,
+            initial_cash=self.initial_cash,
+            turn=PlayerType.player,
+            hand=Counter({Card(i + 1): int(n) for i, n in enumerate(self.hands[seat]) if n}),
+            discarded=self.discarded,
+            bet_percent=float(self.player_bet_percent[seat]),
+            remaining_cash=int(self.remaining_cash[seat]),
+            card_count=CardCount(
+                hi_lo=int(self.round_hi_lo + self.seat_hi_lo[seat]),
+                ko=int(self.round_ko + self.seat_ko[seat]),
+                unseen=unseen,
+                num_unseen=sum(unseen),
+                remaining_cards=self.deck.get_remaining_cards(),
+            ),
+        )
+
+    def bet_step(self, bet_percent) -> VectorActionOutcome:
+        """
+        Must call this first at the start of each round, bet_percent is a scalar or one value per seat
+        """
+        self.player_bet_percent[:] = bet_percent
+        reward = np.zeros(self.num_seats)
+
+        # one card to each seat then the dealer, twice
+        num_cards = 2 * (self.num_seats + 1)
+        if self.deck.get_remaining_cards() < num_cards:
+            self._restore_discards()
+        cards = self.deck.draw_many(num_cards) - 1
+        for first, second, hand in zip(cards, cards[self.num_seats + 1 :], self.hands):
+            hand[first] += 1
+            hand[second] += 1
+        first, second = cards[: self.num_seats], cards[self.num_seats + 1 : -1]
+        self.seat_hi_lo += HI_LO_WEIGHTS[first] + HI_LO_WEIGHTS[second]
+        self.seat_ko += KO_WEIGHTS[first] + KO_WEIGHTS[second]
+        self.dealer_hand[cards[self.num_seats]] += 1
+        self.dealer_hand[cards[-1]] += 1
+
+        # a natural blackjack for the dealer ends the round for every seat,
+        # it is a push for the seats that also have one
+        dealer_natural = bool(batch_count_values(self.dealer_hand) == 21)
+        terminated = np.full(self.num_seats, dealer_natural)
+        if dealer_natural:
+            losers = np.flatnonzero(batch_count_values(self.hands) != 21)
+            self.remaining_cash[losers] -= self._bet_amounts()[losers]
+            reward[losers] = self._reward(losers)
+
+        self.in_play[:] = not dealer_natural
+        return VectorActionOutcome(new_state=self.get_state(), reward=reward, terminated=terminated)
+
+    def card_step(self, take_card) -> VectorActionOutcome:
+        """
+        take_card is a scalar or one value per seat, only seats in play act, see BlackjackWrapper.card_step
+        """
+        take_card = np.broadcast_to(np.asarray(take_card, dtype=bool), (self.num_seats,))
+        reward = np.zeros(self.num_seats)
+        live = self.in_play | self.standing
+        terminated = ~live
+        bet_amounts = self._bet_amounts()
+
+        # hit in seat order, lose immediately on bust
+        hit = np.flatnonzero(self.in_play & take_card)
+        for seat in hit:
+            self._see(seat, self._draw(self.hands[seat]))
+        bust = hit[batch_count_values(self.hands[hit]) > 21]
+        self.remaining_cash[bust] -= bet_amounts[bust]
+        terminated[bust] = True
+
+        # stand, the seat's turn ends
+        stand = np.flatnonzero(self.in_play & ~take_card)
+        player_scores = batch_count_values(self.hands)
+        # Penalize invalid action when the seat tries to stand with score < 16
+        invalid = stand[player_scores[stand] < 16]
+        reward[invalid] = -1.0
+        stand = stand[player_scores[stand] >= 16]
+
+        # natural blackjack is settled immediately and wins 2 times the bet,
+        # counted on the number of distinct ranks as in BlackjackWrapper
+        is_natural = (player_scores[stand] == 21) & ((self.hands[stand] > 0).sum(axis=1) == 2)
+        natural = stand[is_natural]
+        self.remaining_cash[natural] += 2 * bet_amounts[natural]
+        terminated[natural] = True
+        self.standing[stand[~is_natural]] = True
+        self.in_play[bust] = False
+        self.in_play[stand] = False
+
+        if not self.in_play.any() and self.standing.any():
+            # every seat is done, the dealer draws until 17 or more (house rules) and settles the standing seats
+            while batch_count_values(self.dealer_hand) < 17:
+                self._draw(self.dealer_hand)
+            dealer_score = batch_count_values(self.dealer_hand)
+            showdown = np.flatnonzero(self.standing)
+            scores = player_scores[showdown]
+            wins = showdown[(dealer_score > 21) | (dealer_score < scores)]
+            losses = showdown[(dealer_score <= 21) & (dealer_score > scores)]
+            self.remaining_cash[wins] += bet_amounts[wins]
+            self.remaining_cash[losses] -= bet_amounts[losses]
+            terminated[showdown] = True
+            self.standing[:] = False
+
+        np.maximum(self.max_attained_cash, self.remaining_cash, out=self.max_attained_cash)
+        ended = np.flatnonzero(terminated & live)
+        reward[ended] = self._reward(ended)
+        return VectorActionOutcome(new_state=self.get_state(), reward=reward, terminated=terminated)
@@ -0,0 +1,371 @@
+"""
+Batched version of BlackjackWrapper
+
+N independent tables are held as arrays and stepped together, so a training loop
+can act on all of them with a single (N, state_size) forward pass.
+
+Table i follows exactly the same rules as BlackjackWrapper and, given the same rng,
+produces exactly the same cards, rewards and states, e.g.
+    rngs = make_table_rngs(seed, num_envs)
+    BlackjackWrapper(initial_cash, deck_nums, min_bet, rng=rngs[i])
+matches table i of
+    VectorBlackjackEnv(num_envs, initial_cash, deck_nums, min_bet, seed=seed)
+and with hand_streams=True, table i matches
+    BlackjackWrapper(initial_cash, deck_nums, min_bet, streams=HandStreams(seed, i))
+"""
+from collections import Counter
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from game.models.constant import Card, PlayerType
+from game.models.counting import HI_LO_WEIGHTS, KO_WEIGHTS, CardCount, ko_initial_count
+from game.models.features import write_batch_features
+from game.models.hand import batch_count_values
+from game.models.model import GameState
+from game.models.streams import make_hand_streams
+
+NUM_RANKS = len(Card)
+
+
+def make_table_rngs(seed: Optional[int], num_tables: int) -> List[np.random.Generator]:
+    """
+    Independent random streams, one per table
+    """
+    return [
+        np.random.default_rng(child)
+        for child in np.random.SeedSequence(seed).spawn(num_tables)
+    ]
+
+
+class VectorGameState:
+    """
+    States of all tables, row i belongs to table i.
+    hi_lo, ko and remaining_cards are the running counts and shoe sizes of card_count, one per table,
+    the unseen cards follow from discarded and hand.
+    """
+
+    def __init__(
+        self,
+        deck_nums: int,
+        initial_cash: int,
+        hand: np.ndarray,
+        discarded: np.ndarray,
+        bet_percent: np.ndarray,
+        remaining_cash: np.ndarray,
+        hi_lo: Optional[np.ndarray] = None,
+        ko: Optional[np.ndarray] = None,
+        remaining_cards: Optional[np.ndarray] = None,
+    ):
+        self.deck_nums = deck_nums
+        self.initial_cash = initial_cash
+        self.turn = PlayerType.player
+        self.hand = hand
+        self.discarded = discarded
+        self.bet_percent = bet_percent
+        self.remaining_cash = remaining_cash
+        self.hi_lo = hi_lo
+        self.ko = ko
+        self.remaining_cards = remaining_cards
+
+    def __len__(self) -> int:
+        return len(self.remaining_cash)
+
+    @property
+    def card_count(self) -> Optional[CardCount]:
+        """
+        Counts of every table as arrays, built on demand
+        """
+        if self.hi_lo is None:
+            return None
+        unseen = 4 * self.deck_nums - self.discarded - self.hand
+        return CardCount(
+            hi_lo=self.hi_lo,
+            ko=self.ko,
+            unseen=unseen,
+            num_unseen=unseen.sum(axis=1),
+            remaining_cards=self.remaining_cards,
+        )
+
+    def __getitem__(self, idx: int) -> GameState:
+        """
+        State of a single table, as BlackjackWrapper.get_state would return it
+        """
+        card_count = None
+        if self.hi_lo is not None:
+            unseen = tuple((4 * self.deck_nums - self.discarded[idx] - self.hand[idx]).tolist())
+            card_count = CardCount(
+                hi_lo=int(self.hi_lo[idx]),
+                ko=int(self.ko[idx]),
+                unseen=unseen,
+                num_unseen=sum(unseen),
+                remaining_cards=int(self.remaining_cards[idx]),
+            )
+        return GameState(
+            deck_nums=self.deck_nums,
+            initial_cash=self.initial_cash,
+            turn=self.turn,
+            hand=Counter({Card(i + 1): int(n) for i, n in enumerate(self.hand[idx]) if n}),
+            discarded=Counter(
+                {Card(i + 1): int(n) for i, n in enumerate(self.discarded[idx]) if n}
+            ),
+            bet_percent=float(self.bet_percent[idx]),
+            remaining_cash=int(self.remaining_cash[idx]),
+            card_count=card_count,
+        )
+
+    def flatten(
+        self, include_discarded: bool = True, step_num: Optional[float] = None, count_blocks: Sequence[str] = ()
+    ) -> np.ndarray:
+        """
+        Same features as GameState.flatten, one row per table
+        """
+        size = GameState.get_state_size(add_steps=step_num is not None, count_blocks=count_blocks)
+        return write_batch_features(
+            self,
+            np.empty((len(self), size)),
+            include_discarded=include_discarded,
+            step_num=step_num,
+            count_blocks=count_blocks,
+        )
+
+
+class VectorActionOutcome:
+    def __init__(self, new_state: VectorGameState, reward: np.ndarray, terminated: np.ndarray):
+        self.new_state = new_state
+        self.reward = reward
+        self.terminated = terminated
+
+
+class VectorBlackjackEnv:
+    """
+    num_envs BlackjackWrapper tables stepped in lockstep
+
+    A round is reset -> bet_step -> card_step until every table has terminated.
+    Tables that have already terminated ignore card_step and report reward 0.
+    With hand_streams=True every hand of table i is shuffled with its own counter based stream,
+    see game.models.streams, so any hand can be replayed from (seed, i, hand_indices[i]).
+    """
+
+    def __init__(
+        self,
+        num_envs: int,
+        initial_cash: int = 100,
+        deck_nums: int = 4,
+        min_bet: int = 10,
+        seed: Optional[int] = None,
+        penetration: float = 0.5,
+        hand_streams: bool = False,
+    ):
+        if deck_nums < 1:
+            raise ValueError("deck_nums has to be >= 1")
+        if not 0 < penetration <= 1:
+            raise ValueError("penetration has to be in (0, 1]")
+
+        self.num_envs: int = num_envs
+        self.initial_cash: int = initial_cash
+        self.min_bet: int = min_bet
+        self.deck_nums: int = deck_nums
+        self.deck_size: int = deck_nums * NUM_RANKS * 4
+        # same rule as Deck.needs_reshuffle
+        self.reshuffle_at: int = int(self.deck_size * (1 - penetration))
+        self.streams = make_hand_streams(seed, num_envs) if hand_streams else None
+        if self.streams is not None:
+            self.rngs = [streams.generator for streams in self.streams]
+        else:
+            self.rngs = make_table_rngs(seed, num_envs)
+        # incremented for every table by every reset
+        self.hand_indices = np.zeros(num_envs, dtype=np.int64)
+
+        # same card order as a freshly built Deck, before shuffling
+        self._ranks = np.arange(1, NUM_RANKS + 1, dtype=np.int8)
+        self._ordered_shoe = np.tile(self._ranks, 4 * deck_nums)
+        # cards are drawn from the end of each row, shoe_sizes[i] cards are left in row i
+        self.shoes = np.empty((num_envs, self.deck_size), dtype=np.int8)
+        self.shoe_sizes = np.empty(num_envs, dtype=np.int64)
+
+        self.hands = np.zeros((num_envs, NUM_RANKS), dtype=np.int64)
+        self.dealer_hands = np.zeros((num_envs, NUM_RANKS), dtype=np.int64)
+        self.discarded = np.zeros((num_envs, NUM_RANKS), dtype=np.int64)
+        self.remaining_cash = np.empty(num_envs, dtype=np.int64)
+        self.max_attained_cash = np.empty(num_envs, dtype=np.int64)
+        self.player_bet_percent = np.zeros(num_envs, dtype=np.float64)
+        # tables whose round is still waiting for card actions
+        self.in_play = np.zeros(num_envs, dtype=bool)
+        # running counts over the cards each player has seen, see game.models.counting
+        self.hi_lo = np.zeros(num_envs, dtype=np.int64)
+        self.ko = np.zeros(num_envs, dtype=np.int64)
+
+        self._arange = np.arange(num_envs)
+        for idx in range(num_envs):
+            self._restart(idx)
+
+    def _new_shoe(self, idx: int) -> None:
+        self.shoes[idx] = self._ordered_shoe
+        self.shoe_sizes[idx] = self.deck_size
+        self.hi_lo[idx] = 0
+        self.ko[idx] = ko_initial_count(self.deck_nums)
+        self._shuffle(idx)
+
+    def _shuffle(self, idx: int) -> None:
+        if self.streams is not None:
+            # same as Deck.sort, the shoe of the hand only depends on the cards left and the stream of the hand
+            remaining = 4 * self.deck_nums - self.discarded[idx] - self.hands[idx] - self.dealer_hands[idx]
+            self.shoes[idx, : self.shoe_sizes[idx]] = np.repeat(self._ranks, remaining)
+            self.streams[idx].hand(self.hand_indices[idx])
+        self.rngs[idx].shuffle(self.shoes[idx, : self.shoe_sizes[idx]])
+
+    def _restart(self, idx: int) -> None:
+        """
+        Equivalent of constructing a new BlackjackWrapper for one table
+        """
+        self.remaining_cash[idx] = self.initial_cash
+        self.max_attained_cash[idx] = self.initial_cash
+        self.player_bet_percent[idx] = 0
+        self.hands[idx] = 0
+        self.dealer_hands[idx] = 0
+        self.discarded[idx] = 0
+        self.in_play[idx] = False
+        self._new_shoe(idx)
+        self._shuffle(idx)
+
+    def _draw(self, hands: np.ndarray, rows: np.ndarray) -> None:
+        """
+        Draw one card from the shoe of each table in rows into hands
+        """
+        self.shoe_sizes[rows] -= 1
+        cards = self.shoes[rows, self.shoe_sizes[rows]]
+        hands[rows, cards - 1] += 1
+        if hands is self.hands:
+            # the player sees its own cards
+            self.hi_lo[rows] += HI_LO_WEIGHTS[cards - 1]
+            self.ko[rows] += KO_WEIGHTS[cards - 1]
+
+    def _reward(self, rows: np.ndarray) -> np.ndarray:
+        cash = self.remaining_cash[rows]
+        return (
+            np.where(cash >= self.min_bet, cash, -self.max_attained_cash[rows])
+            / self.initial_cash
+        )
+
+    def _bet_amounts(self) -> np.ndarray:
+        return np.maximum(
+            np.trunc(self.remaining_cash * self.player_bet_percent).astype(np.int64),
+            self.min_bet,
+        )
+
+    def reset(self) -> "VectorBlackjackEnv":
+        """
+        Next round for every table, see BlackjackWrapper.reset
+        """
+        self.in_play[:] = False
+        self.hand_indices += 1
+        broke = self.remaining_cash < self.min_bet
+        self.discarded += self.hands + self.dealer_hands
+        # the dealer's cards are seen once discarded
+        self.hi_lo += self.dealer_hands @ HI_LO_WEIGHTS
+        self.ko += self.dealer_hands @ KO_WEIGHTS
+        self.hands[:] = 0
+        self.dealer_hands[:] = 0
+        self.player_bet_percent[:] = 0
+
+        low_shoe = self.shoe_sizes < self.reshuffle_at
+        self.discarded[low_shoe] = 0
+        for idx in range(self.num_envs):
+            if broke[idx]:
+                self._restart(idx)
+                continue
+            if low_shoe[idx]:
+                self._new_shoe(idx)
+            self._shuffle(idx)
+        return self
+
+    def get_state(self) -> VectorGameState:
+        return VectorGameState(
+            deck_nums=self.deck_nums,
+            initial_cash=self.initial_cash,
+            hand=self.hands.copy(),
+            discarded=self.discarded.copy(),
+            bet_percent=self.player_bet_percent.copy(),
+            remaining_cash=self.remaining_cash.copy(),
+            hi_lo=self.hi_lo.copy(),
+            ko=self.ko.copy(),
+            remaining_cards=self.shoe_sizes.copy(),
+        )
+
+    def bet_step(self, bet_percent) -> VectorActionOutcome:
+        """
+        Must call this first at the start of each round, bet_percent is a scalar or one value per table
+        """
+        self.player_bet_percent[:] = bet_percent
+        reward = np.zeros(self.num_envs)
+
+        # draw 2 cards for each player and dealer, sequence matters
+        self._draw(self.hands, self._arange)
+        self._draw(self.dealer_hands, self._arange)
+        self._draw(self.hands, self._arange)
+        self._draw(self.dealer_hands, self._arange)
+
+        # a natural blackjack for the dealer ends the round, it is a push if the player also has one
+        dealer_natural = batch_count_values(self.dealer_hands) == 21
+        player_natural = batch_count_values(self.hands) == 21
+        dealer_wins = np.flatnonzero(dealer_natural & ~player_natural)
+        self.remaining_cash[dealer_wins] -= self._bet_amounts()[dealer_wins]
+        reward[dealer_wins] = self._reward(dealer_wins)
+
+        self.in_play[:] = ~dealer_natural
+        return VectorActionOutcome(
+            new_state=self.get_state(), reward=reward, terminated=dealer_natural.copy()
+        )
+
+    def card_step(self, take_card) -> VectorActionOutcome:
+        """
+        take_card is a scalar or one value per table, see BlackjackWrapper.card_step
+        """
+        take_card = np.broadcast_to(np.asarray(take_card, dtype=bool), (self.num_envs,))
+        reward = np.zeros(self.num_envs)
+        terminated = ~self.in_play
+        bet_amounts = self._bet_amounts()
+
+        # hit, lose immediately on bust
+        hit = np.flatnonzero(self.in_play & take_card)
+        self._draw(self.hands, hit)
+        bust = hit[batch_count_values(self.hands[hit]) > 21]
+        self.remaining_cash[bust] -= bet_amounts[bust]
+        terminated[bust] = True
+
+        # stand, players turn ends
+        stand = np.flatnonzero(self.in_play & ~take_card)
+        player_scores = batch_count_values(self.hands)
+        # Penalize invalid action when the player tries to stand with score < 16
+        invalid = stand[player_scores[stand] < 16]
+        reward[invalid] = -1.0
+        stand = stand[player_scores[stand] >= 16]
+        terminated[stand] = True
+
+        # Player has natural blackjack, outcome is immediate and wins 2 times the bet
+        # BlackjackWrapper checks len(hand) of the Counter, i.e. the number of distinct ranks
+        natural = (player_scores[stand] == 21) & ((self.hands[stand] > 0).sum(axis=1) == 2)
+        self.remaining_cash[stand[natural]] += 2 * bet_amounts[stand[natural]]
+        showdown = stand[~natural]
+
+        # Draw card until score is greater than or equal to 17 for dealer (house rules)
+        drawing = showdown
+        while len(drawing) > 0:
+            drawing = drawing[batch_count_values(self.dealer_hands[drawing]) < 17]
+            self._draw(self.dealer_hands, drawing)
+
+        dealer_scores = batch_count_values(self.dealer_hands[showdown])
+        wins = (dealer_scores > 21) | (dealer_scores < player_scores[showdown])
+        losses = (dealer_scores <= 21) & (dealer_scores > player_scores[showdown])
+        self.remaining_cash[showdown[wins]] += bet_amounts[showdown[wins]]
+        self.remaining_cash[showdown[losses]] -= bet_amounts[showdown[losses]]
+
+        np.maximum(self.max_attained_cash, self.remaining_cash, out=self.max_attained_cash)
+        ended = np.flatnonzero(terminated & self.in_play)
+        reward[ended] = self._reward(ended)
+        self.in_play &= ~terminated
+
+        return VectorActionOutcome(
+            new_state=self.get_state(), reward=reward, terminated=terminated
+        )
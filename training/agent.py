@@ -1,10 +1,45 @@
 import random
-from typing import Tuple, List
+from typing import NamedTuple, Optional, Tuple, List
 
+import numpy as np
 import torch
 from torch import nn
 
 
+class BatchedActions(NamedTuple):
+    """
+    Actions chosen for a batch of N states
+    """
+    # chosen action of each state, bet percentages or take card booleans
+    actions: torch.Tensor
+    # index of each action in the model output, as used for the replay buffer
+    indices: torch.Tensor
+    # output values of the head that chose the action, shape (N, number of choices)
+    values: torch.Tensor
+    # mask over the concatenated output of the chosen head, shape (N, number of outputs),
+    # an expanded view of the model's constant mask, copy it before modifying it
+    masks: torch.Tensor
+
+
+def _explore(epsilon: float, num_choices: int, rng: Optional[np.random.Generator]) -> Optional[int]:
+    """
+    Random action index with probability epsilon, None otherwise.
+    Draws from rng, or from the random module when rng is None.
+    """
+    if rng is None:
+        return random.randint(0, num_choices - 1) if random.random() < epsilon else None
+    return int(rng.integers(num_choices)) if rng.random() < epsilon else None
+
+
+def _as_batch(normalized_states, device) -> torch.Tensor:
+    """
+    Accepts a (N, state_size) numpy array or tensor
+    """
+    if isinstance(normalized_states, np.ndarray):
+        normalized_states = torch.from_numpy(normalized_states)
+    return normalized_states.to(device=device, dtype=torch.float32)
+
+
 class BlackjackPolicyModel(nn.Module):
     """
     Model that accepts a flattened state and outputs 2 values:
@@ -61,13 +96,33 @@ class BlackjackPolicyModel(nn.Module):
 
     def get_bet_percent(self, normalized_state) -> torch.Tensor:
         state = torch.from_numpy(normalized_state).float().unsqueeze(0).to(self.device)
-        bet_percent, _ = self.forward(state)
-        return bet_percent.cpu()
+        return self.bet_layers(self.init_layers(state)).cpu()
 
     def get_card_action(self, normalized_state) -> torch.Tensor:
         state = torch.from_numpy(normalized_state).float().unsqueeze(0).to(self.device)
-        _, card_prob = self.forward(state)
-        return card_prob.cpu()
+        return self.card_layers(self.init_layers(state)).cpu()
+
+    def get_bet_percents(self, normalized_states) -> torch.Tensor:
+        """
+        Bet percentages of a (N, state_size) batch, shape (N, 1), kept on the model device
+        """
+        return self.bet_layers(self.init_layers(_as_batch(normalized_states, self.device)))
+
+    def get_card_probs(self, normalized_states) -> torch.Tensor:
+        """
+        Probabilities of taking a card for a (N, state_size) batch, shape (N, 1), kept on the model device
+        """
+        return self.card_layers(self.init_layers(_as_batch(normalized_states, self.device)))
+
+    def get_card_actions(
+        self, normalized_states, generator: Optional[torch.Generator] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Samples take card actions of a (N, state_size) batch, returns (N,) booleans and the (N, 1) probabilities
+        """
+        card_probs = self.get_card_probs(normalized_states)
+        draws = torch.rand(card_probs.shape[0], device=card_probs.device, generator=generator)
+        return card_probs.detach().squeeze(-1) > draws, card_probs
 
 
 class BlackjackDQN(nn.Module):
@@ -131,6 +186,20 @@ class BlackjackDQN(nn.Module):
             nn.LeakyReLU(),
             nn.Linear(8, len(card_choices)),
         )
+        # constant action masks and choices, not saved in the state dict but moved with the model
+        num_bets, num_cards = len(bet_choices), len(card_choices)
+        self.register_buffer(
+            "bet_mask", torch.tensor([num_bets * [1] + num_cards * [0]]), persistent=False
+        )
+        self.register_buffer(
+            "card_mask", torch.tensor([num_bets * [0] + num_cards * [1]]), persistent=False
+        )
+        self.register_buffer(
+            "bet_choices_tensor", torch.tensor(bet_choices, dtype=torch.float32), persistent=False
+        )
+        self.register_buffer(
+            "card_choices_tensor", torch.tensor(card_choices, dtype=torch.bool), persistent=False
+        )
 
     def forward(self, x) -> Tuple[torch.Tensor, torch.Tensor]:
         x = self.init_layers(x)
@@ -144,38 +213,107 @@ class BlackjackDQN(nn.Module):
         x2 = self.card_layers(x)
         return torch.cat((x1, x2), dim=-1)
 
+    def get_epsilon(self, num_steps: int) -> float:
+        return max(self.epsilon ** num_steps, self.min_epsilon)
+
+    @torch.no_grad()
     def get_bet_percent(
-        self, normalized_state, allow_explore: bool, num_steps: int
+        self, normalized_state, allow_explore: bool, num_steps: int, rng: Optional[np.random.Generator] = None
     ) -> Tuple[float, int, torch.Tensor]:
-        bet_values, card_values = self.forward(normalized_state)
-        if allow_explore and random.random() < max(
-            self.epsilon ** num_steps, self.min_epsilon
-        ):
-            # explore
-            idx = random.randint(0, len(self.bet_choices) - 1)
-        else:
+        """
+        Epsilon-greedy bet, exploration draws from rng, or from the random module when rng is None
+        """
+        bet_values = self.bet_layers(self.init_layers(normalized_state))
+        # explore
+        idx = _explore(self.get_epsilon(num_steps), len(self.bet_choices), rng) if allow_explore else None
+        if idx is None:
             # exploit
             idx = bet_values.argmax().item()
         action = self.bet_choices[idx]
-        mask = torch.tensor(
-            len(self.bet_choices) * [1] + len(self.card_choices) * [0]
-        ).unsqueeze(0)
-        return action, idx, mask
+        # a fresh cpu copy, the buffer is shared by every call
+        return action, idx, self.bet_mask.to("cpu", copy=True)
 
+    @torch.no_grad()
     def get_card_action(
-        self, normalized_state, allow_explore: bool, num_steps: int
+        self, normalized_state, allow_explore: bool, num_steps: int, rng: Optional[np.random.Generator] = None
     ) -> Tuple[bool, int, torch.Tensor]:
-        bet_values, card_values = self.forward(normalized_state)
-        if allow_explore and random.random() < max(
-            self.epsilon ** num_steps, self.min_epsilon
-        ):
-            # explore
-            idx = random.randint(0, len(self.card_choices) - 1)
-        else:
+        """
+        Epsilon-greedy card action, exploration draws from rng, or from the random module when rng is None
+        """
+        card_values = self.card_layers(self.init_layers(normalized_state))
+        # explore
+        idx = _explore(self.get_epsilon(num_steps), len(self.card_choices), rng) if allow_explore else None
+        if idx is None:
             # exploit
             idx = card_values.argmax().item()
         action = self.card_choices[idx]
-        mask = torch.tensor(
-            len(self.bet_choices) * [0] + len(self.card_choices) * [1]
-        ).unsqueeze(0)
-        return action, idx + len(self.bet_choices), mask
+        return action, idx + len(self.bet_choices), self.card_mask.to("cpu", copy=True)
+
+    def _select_batch(
+        self,
+        values: torch.Tensor,
+        choices: torch.Tensor,
+        mask: torch.Tensor,
+        offset: int,
+        allow_explore: bool,
+        num_steps: int,
+        generator: Optional[torch.Generator],
+    ) -> BatchedActions:
+        idx = values.argmax(dim=-1)
+        if allow_explore:
+            # epsilon-greedy per state
+            num_states, num_choices = values.shape
+            explore = (
+                torch.rand(num_states, device=values.device, generator=generator)
+                < self.get_epsilon(num_steps)
+            )
+            random_idx = torch.randint(
+                num_choices, (num_states,), device=values.device, generator=generator
+            )
+            idx = torch.where(explore, random_idx, idx)
+        return BatchedActions(
+            actions=choices[idx],
+            indices=idx + offset,
+            values=values,
+            masks=mask.expand(values.shape[0], -1),
+        )
+
+    @torch.no_grad()
+    def get_bet_percents(
+        self,
+        normalized_states,
+        allow_explore: bool,
+        num_steps: int,
+        generator: Optional[torch.Generator] = None,
+    ) -> BatchedActions:
+        """
+        Batched get_bet_percent over a (N, state_size) numpy array or tensor, only the bet head is evaluated
+        """
+        states = _as_batch(normalized_states, self.bet_mask.device)
+        bet_values = self.bet_layers(self.init_layers(states))
+        return self._select_batch(
+            bet_values, self.bet_choices_tensor, self.bet_mask, 0, allow_explore, num_steps, generator
+        )
+
+    @torch.no_grad()
+    def get_card_actions(
+        self,
+        normalized_states,
+        allow_explore: bool,
+        num_steps: int,
+        generator: Optional[torch.Generator] = None,
+    ) -> BatchedActions:
+        """
+        Batched get_card_action over a (N, state_size) numpy array or tensor, only the card head is evaluated
+        """
+        states = _as_batch(normalized_states, self.card_mask.device)
+        card_values = self.card_layers(self.init_layers(states))
+        return self._select_batch(
+            card_values,
+            self.card_choices_tensor,
+            self.card_mask,
+            len(self.bet_choices),
+            allow_explore,
+            num_steps,
+            generator,
+        )
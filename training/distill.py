@@ -0,0 +1,326 @@
+"""
+Distills a trained BlackjackDQN or BlackjackPolicyModel into a training.lookup_table.PolicyTable
+
+States are sampled by playing VectorBlackjackEnv tables with the model itself, with some random actions
+mixed in so that states off the model's own path are covered too. The model is queried in large batches,
+its outputs are aggregated per table cell (majority vote for the DQN, mean for the policy model)
+and a held out part of the samples measures how often the table and the network disagree.
+
+    python -m training.distill models/policy_steps policy_steps.npz --agent policy
+"""
+import argparse
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import torch
+
+from game.models.features import FeatureBuffer
+from game.models.model import GameState
+from game.vector_api import VectorBlackjackEnv
+from training import registry
+from training.agent import BlackjackDQN, BlackjackPolicyModel
+from training.lookup_table import DEFAULT_CASH_EDGES, DEFAULT_COUNT_LIMIT, DQN, POLICY, PolicyTable
+
+DEFAULT_BET_CHOICES = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+BET_TOLERANCE = 0.01
+
+
+def _kind(model: torch.nn.Module) -> str:
+    if isinstance(model, BlackjackDQN):
+        return DQN
+    if isinstance(model, BlackjackPolicyModel):
+        return POLICY
+    raise TypeError(f"unsupported model type {type(model).__name__}")
+
+
+@torch.no_grad()
+def model_outputs(model: torch.nn.Module, features: np.ndarray, bet: bool, batch_size: int = 1 << 14) -> np.ndarray:
+    """
+    Raw decision of the model for every row, in the form the table stores it:
+    bet index or take card flag for the DQN, bet percent or take card probability for the policy model
+    """
+    kind = _kind(model)
+    outputs = []
+    for start in range(0, len(features), batch_size):
+        batch = features[start : start + batch_size]
+        if kind == DQN:
+            chosen = (model.get_bet_percents if bet else model.get_card_actions)(batch, False, 0)
+            outputs.append((chosen.indices if bet else chosen.actions).cpu().numpy())
+        else:
+            values = model.get_bet_percents(batch) if bet else model.get_card_probs(batch)
+            outputs.append(values.squeeze(-1).cpu().numpy())
+    if not outputs:
+        return np.zeros(0)
+    return np.concatenate(outputs)
+
+
+def sample_states(
+    model: torch.nn.Module,
+    num_rounds: int,
+    num_envs: int = 1024,
+    initial_cash: int = 10000,
+    deck_nums: int = 8,
+    min_bet: int = 10,
+    max_steps: int = 10,
+    add_steps: bool = True,
+    add_card_counting: bool = True,
+    explore_prob: float = 0.1,
+    seed: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Plays num_rounds rounds on each of num_envs tables, returns the features of every bet decision
+    and of every card decision that was met
+    """
+    kind = _kind(model)
+    rng = np.random.default_rng(seed)
+    env = VectorBlackjackEnv(num_envs, initial_cash, deck_nums, min_bet, seed=seed)
+    features = FeatureBuffer(num_envs, add_steps=add_steps, include_discarded=add_card_counting)
+    bet_choices = np.array(model.bet_choices if kind == DQN else DEFAULT_BET_CHOICES)
+    bet_rows, card_rows = [], []
+
+    for _ in range(num_rounds):
+        env.reset()
+        batch = features.write_batch(env.get_state(), step_num=0.0 if add_steps else None)
+        bet_rows.append(batch.copy())
+        bet_outputs = model_outputs(model, batch, bet=True)
+        bet_percents = bet_choices[bet_outputs] if kind == DQN else bet_outputs
+        explore = rng.random(num_envs) < explore_prob
+        bet_percents = np.where(explore, rng.choice(bet_choices, num_envs), bet_percents)
+        outcome = env.bet_step(bet_percents)
+
+        for i_step in range(1, max_steps):
+            active = np.flatnonzero(~outcome.terminated)
+            if not len(active):
+                break
+            step_num = i_step / max_steps if add_steps else None
+            batch = features.write_batch(outcome.new_state, step_num=step_num)
+            card_rows.append(batch[active].copy())
+            take_card = np.zeros(num_envs, dtype=bool)
+            card_outputs = model_outputs(model, batch[active], bet=False)
+            if kind == DQN:
+                take_card[active] = card_outputs
+            else:
+                take_card[active] = card_outputs > rng.random(len(active))
+            explore = rng.random(num_envs) < explore_prob
+            take_card = np.where(explore, rng.random(num_envs) < 0.5, take_card)
+            outcome = env.card_step(take_card)
+
+    state_size = features.state_size
+    return (
+        np.concatenate(bet_rows) if bet_rows else np.zeros((0, state_size), dtype=np.float32),
+        np.concatenate(card_rows) if card_rows else np.zeros((0, state_size), dtype=np.float32),
+    )
+
+
+def _aggregate(keys: Tuple[np.ndarray, ...], outputs: np.ndarray, shape: Tuple[int, ...], kind: str, num_choices: int):
+    """
+    Table of the per cell majority (DQN) or mean (policy model) of outputs.
+    Cells without samples fall back to the same over the first axis only (hand value for the card table),
+    then over every sample.
+    """
+    flat = np.ravel_multi_index(keys, shape)
+    coarse = keys[0]
+    num_cells = int(np.prod(shape))
+    if kind == DQN:
+        outputs = outputs.astype(np.int64)
+        votes = np.bincount(flat * num_choices + outputs, minlength=num_cells * num_choices)
+        votes = votes.reshape(num_cells, num_choices)
+        coarse_votes = np.bincount(coarse * num_choices + outputs, minlength=shape[0] * num_choices)
+        coarse_votes = coarse_votes.reshape(shape[0], num_choices)
+        global_votes = np.bincount(outputs, minlength=num_choices)
+        cell_value = votes.argmax(axis=1)
+        coarse_value = np.where(coarse_votes.sum(axis=1) > 0, coarse_votes.argmax(axis=1), global_votes.argmax())
+    else:
+        counts = np.bincount(flat, minlength=num_cells)
+        sums = np.bincount(flat, weights=outputs, minlength=num_cells)
+        coarse_counts = np.bincount(coarse, minlength=shape[0])
+        coarse_sums = np.bincount(coarse, weights=outputs, minlength=shape[0])
+        global_mean = outputs.mean() if len(outputs) else 0.5
+        cell_value = np.rint(sums / np.maximum(counts, 1) * 255)
+        coarse_value = np.rint(
+            np.where(coarse_counts > 0, coarse_sums / np.maximum(coarse_counts, 1), global_mean) * 255
+        )
+        votes = counts[:, None]
+
+    visited = votes.sum(axis=1) > 0
+    first_axis = np.unravel_index(np.arange(num_cells), shape)[0]
+    table = np.where(visited, cell_value, coarse_value[first_axis])
+    return table.reshape(shape), visited.mean()
+
+
+def build_table(
+    model: torch.nn.Module,
+    deck_nums: int,
+    bet_features: np.ndarray,
+    card_features: np.ndarray,
+    count_limit: int = DEFAULT_COUNT_LIMIT,
+    cash_edges=DEFAULT_CASH_EDGES,
+    max_steps: int = 10,
+) -> Tuple[PolicyTable, Dict[str, float]]:
+    kind = _kind(model)
+    bet_choices = list(model.bet_choices) if kind == DQN else None
+    bet_shape, card_shape = PolicyTable.table_shapes(count_limit, len(cash_edges), max_steps)
+    table = PolicyTable(
+        kind,
+        deck_nums,
+        np.zeros(bet_shape),
+        np.zeros(card_shape),
+        bet_choices=bet_choices,
+        count_limit=count_limit,
+        cash_edges=cash_edges,
+        max_steps=max_steps,
+    )
+    bet_key, _ = table.state_keys(bet_features)
+    _, card_key = table.state_keys(card_features)
+    bet_outputs = model_outputs(model, bet_features, bet=True)
+    card_outputs = model_outputs(model, card_features, bet=False)
+    num_bet_choices = len(bet_choices) if kind == DQN else 1
+    table.bet_table[...], bet_coverage = _aggregate(bet_key, bet_outputs, bet_shape, kind, num_bet_choices)
+    table.card_table[...], card_coverage = _aggregate(card_key, card_outputs, card_shape, kind, 2)
+    return table, {"bet_coverage": float(bet_coverage), "card_coverage": float(card_coverage)}
+
+
+def disagreement_report(
+    table: PolicyTable, model: torch.nn.Module, bet_features: np.ndarray, card_features: np.ndarray
+) -> Dict[str, float]:
+    """
+    How often the table and the network choose a different action on the given states.
+    For the policy model, bets disagree when more than BET_TOLERANCE apart and probabilities are compared as
+    decisions at 0.5, the mean absolute bet difference is also reported.
+    """
+    bet_model = model_outputs(model, bet_features, bet=True)
+    card_model = model_outputs(model, card_features, bet=False)
+    bet_table = table.bet_outputs(bet_features)
+    card_table = table.card_outputs(card_features)
+    report = {"bet_states": len(bet_features), "card_states": len(card_features)}
+    if table.kind == DQN:
+        report["bet_disagreement"] = float(np.mean(bet_model != bet_table)) if len(bet_model) else 0.0
+        report["card_disagreement"] = float(np.mean(card_model != card_table)) if len(card_model) else 0.0
+    else:
+        # more than a percentage point apart
+        report["bet_disagreement"] = (
+            float(np.mean(np.abs(bet_model - bet_table) > BET_TOLERANCE)) if len(bet_model) else 0.0
+        )
+        report["bet_mean_abs_diff"] = float(np.mean(np.abs(bet_model - bet_table))) if len(bet_model) else 0.0
+        report["card_disagreement"] = (
+            float(np.mean((card_model > 0.5) != (card_table > 0.5))) if len(card_model) else 0.0
+        )
+    return report
+
+
+def distill(
+    model: torch.nn.Module,
+    num_rounds: int,
+    num_envs: int = 1024,
+    holdout: float = 0.2,
+    initial_cash: int = 10000,
+    deck_nums: int = 8,
+    min_bet: int = 10,
+    max_steps: int = 10,
+    add_steps: bool = True,
+    add_card_counting: bool = True,
+    explore_prob: float = 0.1,
+    count_limit: int = DEFAULT_COUNT_LIMIT,
+    cash_edges=DEFAULT_CASH_EDGES,
+    seed: Optional[int] = None,
+) -> Tuple[PolicyTable, Dict[str, float]]:
+    """
+    Samples states, builds the table from 1 - holdout of them and reports disagreement on the rest
+    """
+    model.eval()
+    start = time.perf_counter()
+    bet_features, card_features = sample_states(
+        model,
+        num_rounds,
+        num_envs=num_envs,
+        initial_cash=initial_cash,
+        deck_nums=deck_nums,
+        min_bet=min_bet,
+        max_steps=max_steps,
+        add_steps=add_steps,
+        add_card_counting=add_card_counting,
+        explore_prob=explore_prob,
+        seed=seed,
+    )
+    rng = np.random.default_rng(seed)
+    bet_holdout = rng.random(len(bet_features)) < holdout
+    card_holdout = rng.random(len(card_features)) < holdout
+
+    table, report = build_table(
+        model,
+        deck_nums,
+        bet_features[~bet_holdout],
+        card_features[~card_holdout],
+        count_limit=count_limit,
+        cash_edges=cash_edges,
+        max_steps=max_steps,
+    )
+    report.update(disagreement_report(table, model, bet_features[bet_holdout], card_features[card_holdout]))
+    report["seconds"] = time.perf_counter() - start
+    return table, report
+
+
+def format_report(report: Dict[str, float]) -> str:
+    lines = [
+        f"Held out states: {report['bet_states']} bet, {report['card_states']} card",
+        f"Cells visited: {report['bet_coverage']:.1%} bet, {report['card_coverage']:.1%} card",
+        f"Disagreement: {report['bet_disagreement']:.2%} bet, {report['card_disagreement']:.2%} card",
+    ]
+    if "bet_mean_abs_diff" in report:
+        lines.append(f"Mean absolute bet percent difference: {report['bet_mean_abs_diff']:.4f}")
+    lines.append(f"Took {report['seconds']:.1f}s")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("checkpoint", help="portable checkpoint or torch.save state_dict, e.g. models/policy_steps.bjm")
+    parser.add_argument("output", help="path of the .npz table")
+    parser.add_argument("--agent", choices=(DQN, POLICY), default=POLICY, help="only used for torch.save checkpoints")
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--envs", type=int, default=1024)
+    parser.add_argument("--holdout", type=float, default=0.2)
+    parser.add_argument("--initial-cash", type=int, default=10000)
+    parser.add_argument("--deck-nums", type=int, default=8)
+    parser.add_argument("--min-bet", type=int, default=10)
+    parser.add_argument("--max-steps", type=int, default=10)
+    parser.add_argument("--explore", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.checkpoint.endswith(registry.SUFFIX):
+        model = registry.load_model(args.checkpoint)
+        header = registry.read_header(args.checkpoint)
+        add_steps, add_card_counting = header["add_steps"], header["add_card_counting"]
+    else:
+        # same naming convention as the test notebooks
+        add_steps = "steps" in args.checkpoint
+        add_card_counting = "no_counting" not in args.checkpoint
+        in_features = GameState.get_state_size(add_steps=add_steps)
+        if args.agent == DQN:
+            model = BlackjackDQN(in_features, DEFAULT_BET_CHOICES, [True, False], epsilon=0, min_epsilon=0)
+        else:
+            model = BlackjackPolicyModel(in_features, device="cpu")
+        model.load_state_dict(torch.load(args.checkpoint, map_location="cpu"))
+
+    table, report = distill(
+        model,
+        args.rounds,
+        num_envs=args.envs,
+        holdout=args.holdout,
+        initial_cash=args.initial_cash,
+        deck_nums=args.deck_nums,
+        min_bet=args.min_bet,
+        max_steps=args.max_steps,
+        add_steps=add_steps,
+        add_card_counting=add_card_counting,
+        explore_prob=args.explore,
+        seed=args.seed,
+    )
+    table.save(args.output)
+    print(format_report(report))
+
+
+if __name__ == "__main__":
+    main()
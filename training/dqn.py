@@ -0,0 +1,66 @@
+import torch
+from torch import nn, optim
+
+from game.instrumentation import stage
+from training.agent import BlackjackDQN
+from training.replay_buffer import ReplayBuffer
+
+
+def train(
+    dqn_model: BlackjackDQN,
+    target_model: BlackjackDQN,
+    optimizer: optim.Optimizer,
+    replay_buffer: ReplayBuffer,
+    batch_size: int,
+    gamma: float,
+):
+    """
+    One optimization step of dqn_model on a batch sampled from replay_buffer
+    """
+    if len(replay_buffer) < batch_size:
+        return
+    with stage("dqn.train"):
+        batch = replay_buffer.sample(batch_size)
+
+        with stage("dqn.train.forward"):
+            # Mask of non-final states
+            # (a final state would've been the one after which simulation ended)
+            non_final_mask = ~batch.done
+            non_final_next_states = batch.next_state[non_final_mask]
+            state_batch = batch.state
+            action_batch = batch.action.unsqueeze(-1)
+            reward_batch = batch.reward
+            mask_batch = batch.mask
+
+            # Compute Q(s_t, a) - the model computes Q(s_t), then we select the
+            # columns of actions taken. These are the actions which would've been taken
+            # for each batch state according to policy_net
+            q_batch = dqn_model.batched_forward_with_concat(state_batch)
+            masked_q_batch = q_batch * mask_batch
+            state_action_values = masked_q_batch.gather(dim=1, index=action_batch)
+
+            # Compute V(s_{t+1}) for all next states.
+            # Expected values of actions for non_final_next_states are computed based
+            # on the "older" target_net; selecting their best reward with max(1)[0].
+            # This is merged based on the mask, such that we'll have either the expected
+            # state value or 0 in case the state was final.
+            next_state_values = torch.zeros(batch_size, device=reward_batch.device)
+            with torch.no_grad():
+                next_state_q_batch = target_model.batched_forward_with_concat(non_final_next_states)
+                masked_next_state_q_batch = next_state_q_batch * mask_batch[non_final_mask]
+                next_state_values[non_final_mask] = masked_next_state_q_batch.max(dim=1)[0]
+            # Compute the expected Q values
+            expected_state_action_values = (next_state_values * gamma) + reward_batch
+
+            # Compute Huber loss
+            criterion = nn.SmoothL1Loss()
+            loss = criterion(state_action_values, expected_state_action_values.unsqueeze(1))
+
+        # Optimize the model
+        with stage("dqn.train.backward"):
+            optimizer.zero_grad()
+            loss.backward()
+        with stage("dqn.train.optimizer"):
+            # In-place gradient clipping
+            torch.nn.utils.clip_grad_value_(dqn_model.parameters(), 100)
+            optimizer.step()
@@ -0,0 +1,413 @@
+"""
+Parallel evaluation of a trained BlackjackDQN or BlackjackPolicyModel
+
+Episodes are split over num_shards shards, each a VectorBlackjackEnv of tables_per_shard tables with its own
+random streams spawned from one SeedSequence, played with one batched forward pass per step.
+Shards are spread over worker processes and report one summary per block of block_rounds rounds.
+Blocks are consumed in a fixed (block, shard) order, so for a given seed, num_shards, tables_per_shard and
+block_rounds the result does not depend on the number of workers or on timing, early stopping included.
+
+An episode is one round, as in the evaluate_agent functions of the notebooks, its score is the sum of its rewards.
+Cash carries over between rounds of a table, so consecutive episodes are correlated: the confidence interval
+is a bootstrap over block means rather than over single episodes.
+A table is ruined when a round leaves it with less than min_bet, it then restarts with initial_cash.
+
+    python -m training.evaluate models/policy_steps.bjm --episodes 1000000 --ci-width 0.01 --workers 8
+"""
+import argparse
+import math
+import queue as queue_module
+import time
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from game.models.features import FeatureBuffer
+from game.vector_api import VectorBlackjackEnv
+from training import registry
+
+
+class EvaluationConfig(NamedTuple):
+    header: dict  # registry header of the model
+    tables_per_shard: int
+    block_rounds: int
+    initial_cash: int
+    deck_nums: int
+    min_bet: int
+    max_steps: int
+    add_steps: bool
+    add_card_counting: bool
+    sample_policy: bool
+
+
+# seconds between checks that the workers are alive, and without any summary before giving up
+POLL_SECONDS = 0.5
+STALL_SECONDS = 600
+
+
+class BlockSummary(NamedTuple):
+    shard: int
+    block: int
+    count: int
+    mean: float
+    # sum of squared deviations from mean
+    m2: float
+    ruins: int
+
+
+class EvaluationResult(NamedTuple):
+    episodes: int
+    mean: float
+    std: float
+    ci_low: float
+    ci_high: float
+    ci_level: float
+    ruin_probability: float
+    ruins: int
+    blocks: int
+    stopped_early: bool
+    seconds: float
+
+    @property
+    def ci_width(self) -> float:
+        return self.ci_high - self.ci_low
+
+    def format(self) -> str:
+        return (
+            f"{self.episodes} episodes in {self.seconds:.1f}s ({self.episodes / max(self.seconds, 1e-9):.0f}/s)"
+            f"{', stopped early' if self.stopped_early else ''}\n"
+            f"Mean: {self.mean:.4f} +/- {self.std:.4f}, "
+            f"{self.ci_level:.0%} CI [{self.ci_low:.4f}, {self.ci_high:.4f}]\n"
+            f"Ruin probability per round: {self.ruin_probability:.5f} ({self.ruins} ruins)"
+        )
+
+
+class RunningStats:
+    """
+    Count, mean and variance merged block by block (Chan et al. parallel update),
+    plus the block means for the bootstrap
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.ruins = 0
+        self.block_means: List[float] = []
+
+    def update(self, block: BlockSummary) -> None:
+        count = self.count + block.count
+        delta = block.mean - self.mean
+        self.mean += delta * block.count / count
+        self.m2 += block.m2 + delta ** 2 * self.count * block.count / count
+        self.count = count
+        self.ruins += block.ruins
+        self.block_means.append(block.mean)
+
+    @property
+    def variance(self) -> float:
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def bootstrap_ci(self, level: float, num_resamples: int, rng: np.random.Generator) -> Tuple[float, float]:
+        """
+        Percentile bootstrap of the mean over block means, all blocks hold the same number of episodes
+        """
+        block_means = np.array(self.block_means)
+        if len(block_means) < 2:
+            return -math.inf, math.inf
+        resampled = block_means[rng.integers(len(block_means), size=(num_resamples, len(block_means)))].mean(axis=1)
+        low, high = np.quantile(resampled, [(1 - level) / 2, (1 + level) / 2])
+        return float(low), float(high)
+
+
+class _Shard:
+    """
+    Tables of one shard and the random stream used to sample policy model actions
+    """
+
+    def __init__(self, shard: int, config: EvaluationConfig, seed_seq: np.random.SeedSequence):
+        env_seq, action_seq = seed_seq.spawn(2)
+        self.shard = shard
+        self.config = config
+        self.env = VectorBlackjackEnv(
+            config.tables_per_shard,
+            config.initial_cash,
+            config.deck_nums,
+            config.min_bet,
+            seed=int(env_seq.generate_state(1)[0]),
+        )
+        self.rng = np.random.default_rng(action_seq)
+        self.features = FeatureBuffer(
+            config.tables_per_shard, add_steps=config.add_steps, include_discarded=config.add_card_counting
+        )
+        self.is_dqn = config.header["architecture"] == "dqn"
+        self.block = 0
+
+    def _step_num(self, i_step: int) -> Optional[float]:
+        return i_step / self.config.max_steps if self.config.add_steps else None
+
+    def _bet_percents(self, model, batch: np.ndarray) -> np.ndarray:
+        if self.is_dqn:
+            return model.get_bet_percents(batch, False, 0).actions.cpu().numpy()
+        return model.get_bet_percents(batch).squeeze(-1).cpu().numpy()
+
+    def _card_actions(self, model, batch: np.ndarray) -> np.ndarray:
+        if self.is_dqn:
+            return model.get_card_actions(batch, False, 0).actions.cpu().numpy()
+        probs = model.get_card_probs(batch).squeeze(-1).cpu().numpy()
+        if self.config.sample_policy:
+            return probs > self.rng.random(len(probs))
+        return probs > 0.5
+
+    @torch.no_grad()
+    def play_round(self, model) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        One round on every table, returns the episode scores and which tables were ruined
+        """
+        env = self.env.reset()
+        batch = self.features.write_batch(env.get_state(), step_num=self._step_num(0))
+        outcome = env.bet_step(self._bet_percents(model, batch))
+        scores = outcome.reward.copy()
+        active = ~outcome.terminated
+        for i_step in range(1, self.config.max_steps):
+            rows = np.flatnonzero(active)
+            if not len(rows):
+                break
+            batch = self.features.write_batch(outcome.new_state, step_num=self._step_num(i_step))
+            take_card = np.zeros(len(active), dtype=bool)
+            take_card[rows] = self._card_actions(model, batch[rows])
+            outcome = env.card_step(take_card)
+            scores += outcome.reward
+            active &= ~outcome.terminated
+        return scores, env.remaining_cash < self.config.min_bet
+
+    def play_block(self, model) -> BlockSummary:
+        scores = []
+        ruins = 0
+        for _ in range(self.config.block_rounds):
+            round_scores, ruined = self.play_round(model)
+            scores.append(round_scores)
+            ruins += int(ruined.sum())
+        scores = np.concatenate(scores)
+        mean = scores.mean()
+        summary = BlockSummary(
+            shard=self.shard,
+            block=self.block,
+            count=len(scores),
+            mean=float(mean),
+            m2=float(((scores - mean) ** 2).sum()),
+            ruins=ruins,
+        )
+        self.block += 1
+        return summary
+
+
+def _worker_loop(
+    shards: List[int],
+    config: EvaluationConfig,
+    seed_seqs: List[np.random.SeedSequence],
+    state_dict: dict,
+    max_blocks: int,
+    queue,
+    stop_event,
+) -> None:
+    torch.set_num_threads(1)
+    model = registry.build_model(config.header)
+    model.load_state_dict(state_dict)
+    model.eval()
+    players = [_Shard(shard, config, seed_seq) for shard, seed_seq in zip(shards, seed_seqs)]
+    for _ in range(max_blocks):
+        for player in players:
+            if stop_event.is_set():
+                return
+            queue.put(player.play_block(model))
+
+
+def _check_workers(workers) -> None:
+    for worker in workers:
+        if worker.exitcode not in (None, 0):
+            raise RuntimeError(f"evaluation worker {worker.name} exited with code {worker.exitcode}")
+
+
+def _next_summary(queue, workers) -> BlockSummary:
+    """
+    Next summary from the workers, raises as soon as one of them died
+    """
+    deadline = time.monotonic() + STALL_SECONDS
+    while True:
+        _check_workers(workers)
+        try:
+            return queue.get(timeout=POLL_SECONDS)
+        except queue_module.Empty:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"no evaluation block finished in {STALL_SECONDS}s")
+
+
+def evaluate(
+    model: torch.nn.Module,
+    num_episodes: int = 1_000_000,
+    ci_width: Optional[float] = None,
+    ci_level: float = 0.95,
+    min_blocks: int = 20,
+    num_workers: int = 0,
+    num_shards: int = 16,
+    tables_per_shard: int = 256,
+    block_rounds: int = 8,
+    initial_cash: int = 10000,
+    deck_nums: int = 8,
+    min_bet: int = 10,
+    max_steps: int = 10,
+    add_steps: Optional[bool] = None,
+    add_card_counting: bool = True,
+    sample_policy: bool = True,
+    num_resamples: int = 1000,
+    seed: Optional[int] = 0,
+    start_method: str = "spawn",
+) -> EvaluationResult:
+    """
+    Plays up to num_episodes episodes, rounded up to a whole number of block rows: a block row is one block
+    of every shard, num_shards * tables_per_shard * block_rounds episodes (32768 with the defaults).
+    Stops as soon as the ci_level bootstrap interval of the mean is narrower than ci_width (checked once every
+    shard has delivered the same number of blocks, and only from min_blocks blocks on).
+    min_blocks only gates early stopping, the final interval is computed from any 2 or more blocks.
+    num_workers=0 plays every shard in this process.
+    Policy model card actions are sampled like in training unless sample_policy is False, then thresholded at 0.5.
+    """
+    header = registry.model_metadata(model, add_card_counting)
+    config = EvaluationConfig(
+        header=header,
+        tables_per_shard=tables_per_shard,
+        block_rounds=block_rounds,
+        initial_cash=initial_cash,
+        deck_nums=deck_nums,
+        min_bet=min_bet,
+        max_steps=max_steps,
+        add_steps=header["add_steps"] if add_steps is None else add_steps,
+        add_card_counting=add_card_counting,
+        sample_policy=sample_policy,
+    )
+    block_size = tables_per_shard * block_rounds
+    max_blocks = max(1, -(-num_episodes // (block_size * num_shards)))
+    *shard_seqs, bootstrap_seq = np.random.SeedSequence(seed).spawn(num_shards + 1)
+    bootstrap_rng = np.random.default_rng(bootstrap_seq)
+
+    stats = RunningStats()
+    ci = (-math.inf, math.inf)
+    stopped_early = False
+    start = time.perf_counter()
+
+    def done() -> bool:
+        nonlocal ci
+        if len(stats.block_means) < min_blocks:
+            return False
+        ci = stats.bootstrap_ci(ci_level, num_resamples, bootstrap_rng)
+        return ci_width is not None and ci[1] - ci[0] <= ci_width
+
+    if num_workers == 0:
+        model.eval()
+        players = [_Shard(shard, config, seed_seq) for shard, seed_seq in enumerate(shard_seqs)]
+        for block in range(max_blocks):
+            for player in players:
+                stats.update(player.play_block(model))
+            if block < max_blocks - 1 and done():
+                stopped_early = True
+                break
+    else:
+        ctx = mp.get_context(start_method)
+        queue = ctx.Queue()
+        stop_event = ctx.Event()
+        # clones, file backed storages of memory mapped checkpoints cannot be shared with workers
+        state_dict = {key: value.detach().cpu().clone() for key, value in model.state_dict().items()}
+        workers = []
+        for worker_id in range(num_workers):
+            shards = list(range(worker_id, num_shards, num_workers))
+            worker = ctx.Process(
+                target=_worker_loop,
+                args=(shards, config, [shard_seqs[s] for s in shards], state_dict, max_blocks, queue, stop_event),
+                daemon=True,
+            )
+            worker.start()
+            workers.append(worker)
+        try:
+            # summaries that arrived ahead of their turn, by (block, shard)
+            pending = {}
+            for block in range(max_blocks):
+                for shard in range(num_shards):
+                    while (block, shard) not in pending:
+                        summary = _next_summary(queue, workers)
+                        pending[summary.block, summary.shard] = summary
+                    stats.update(pending.pop((block, shard)))
+                if block < max_blocks - 1 and done():
+                    stopped_early = True
+                    break
+        finally:
+            stop_event.set()
+            for worker in workers:
+                worker.join(timeout=10)
+                if worker.is_alive():
+                    worker.terminate()
+
+    if not stopped_early:
+        ci = stats.bootstrap_ci(ci_level, num_resamples, bootstrap_rng)
+    return EvaluationResult(
+        episodes=stats.count,
+        mean=stats.mean,
+        std=math.sqrt(stats.variance),
+        ci_low=ci[0],
+        ci_high=ci[1],
+        ci_level=ci_level,
+        ruin_probability=stats.ruins / stats.count if stats.count else 0.0,
+        ruins=stats.ruins,
+        blocks=len(stats.block_means),
+        stopped_early=stopped_early,
+        seconds=time.perf_counter() - start,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("checkpoint", help="portable checkpoint, see training.registry")
+    parser.add_argument(
+        "--episodes", type=int, default=1_000_000, help="rounded up to whole blocks of every shard"
+    )
+    parser.add_argument("--ci-width", type=float, default=None)
+    parser.add_argument("--ci-level", type=float, default=0.95)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--shards", type=int, default=16)
+    parser.add_argument("--tables", type=int, default=256, help="tables per shard")
+    parser.add_argument("--block-rounds", type=int, default=8)
+    parser.add_argument("--initial-cash", type=int, default=10000)
+    parser.add_argument("--deck-nums", type=int, default=8)
+    parser.add_argument("--min-bet", type=int, default=10)
+    parser.add_argument("--no-counting", action="store_true", help="evaluate without card counting features")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    header = registry.read_header(args.checkpoint)
+    result = evaluate(
+        registry.load_model(args.checkpoint),
+        num_episodes=args.episodes,
+        ci_width=args.ci_width,
+        ci_level=args.ci_level,
+        num_workers=args.workers,
+        num_shards=args.shards,
+        tables_per_shard=args.tables,
+        block_rounds=args.block_rounds,
+        initial_cash=args.initial_cash,
+        deck_nums=args.deck_nums,
+        min_bet=args.min_bet,
+        add_card_counting=header["add_card_counting"] and not args.no_counting,
+        seed=args.seed,
+    )
+    if not result.stopped_early and result.episodes > args.episodes:
+        print(
+            f"{args.episodes} episodes rounded up to {result.episodes}, whole blocks of "
+            f"{args.shards} shards x {args.tables} tables x {args.block_rounds} rounds"
+        )
+    print(result.format())
+
+
+if __name__ == "__main__":
+    main()
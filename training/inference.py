@@ -0,0 +1,427 @@
+"""
+Frozen CPU inference for trained BlackjackDQN and BlackjackPolicyModel
+
+export turns a trained model into an inference only object with the same get_bet_percent / get_card_action
+contract, and the batched get_bet_percents / get_card_probs / get_card_actions, as the original:
+- "numpy": float32 NumPy kernel. Every Linear and the activation after it are one fused step, a matmul
+  followed by the bias add and the activation in place on its output, with no autograd or module dispatch.
+  Weights are stored transposed and contiguous, x @ weight is then a plain row major matmul.
+- "int8": torch dynamic quantization, Linear weights are int8 per output channel and activations are
+  quantized on the fly per batch. The result is a quantized copy of the model itself.
+
+report compares a frozen model against the float model on a fixed, seeded corpus of game states:
+output and action deltas, and the latency of single state and batched calls.
+
+    frozen = export(registry.load_model("models/policy_steps.bjm"), backend="numpy")
+    python -m training.inference models/policy_steps.bjm --backend numpy int8
+"""
+import argparse
+import copy
+import itertools
+import json
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from torch import nn
+
+from benchmarks.timing import measure
+from game.api import BlackjackWrapper
+from training import registry
+from training.agent import BatchedActions, BlackjackDQN, BlackjackPolicyModel, _explore
+
+NUMPY, INT8 = "numpy", "int8"
+BACKENDS = (NUMPY, INT8)
+LEAKY_RELU, SIGMOID, IDENTITY = "leaky_relu", "sigmoid", "identity"
+# nn.LeakyReLU default, used by both models
+NEGATIVE_SLOPE = 0.01
+DEFAULT_BATCH_SIZES = (1, 64, 1024)
+
+
+class FusedLayer(NamedTuple):
+    # (in_features, out_features) contiguous float32, the transpose of nn.Linear.weight
+    weight: np.ndarray
+    bias: np.ndarray
+    activation: str
+
+
+def fused_layers(arrays: Dict[str, np.ndarray], prefix: str, last_activation: str) -> List[FusedLayer]:
+    """
+    Layers of the nn.Sequential saved under prefix, every Linear but the last is followed by a LeakyReLU
+    """
+    indices = sorted(
+        int(name.split(".")[1]) for name in arrays if name.startswith(f"{prefix}.") and name.endswith(".weight")
+    )
+    return [
+        FusedLayer(
+            weight=np.ascontiguousarray(arrays[f"{prefix}.{idx}.weight"].T, dtype=np.float32),
+            bias=np.asarray(arrays[f"{prefix}.{idx}.bias"], dtype=np.float32),
+            activation=last_activation if idx == indices[-1] else LEAKY_RELU,
+        )
+        for idx in indices
+    ]
+
+
+def run_layers(layers: Sequence[FusedLayer], x: np.ndarray) -> np.ndarray:
+    for layer in layers:
+        x = x @ layer.weight
+        x += layer.bias
+        if layer.activation == LEAKY_RELU:
+            np.maximum(x, x * NEGATIVE_SLOPE, out=x)
+        elif layer.activation == SIGMOID:
+            # (1 + tanh(x / 2)) / 2 in place, does not overflow like 1 / (1 + exp(-x))
+            x *= 0.5
+            np.tanh(x, out=x)
+            x += 1
+            x *= 0.5
+    return x
+
+
+def _as_array(normalized_states) -> np.ndarray:
+    """
+    (N, state_size) float32 array from a numpy array or tensor, a single state becomes 1 row
+    """
+    if isinstance(normalized_states, torch.Tensor):
+        normalized_states = normalized_states.detach().cpu().numpy()
+    return np.atleast_2d(np.asarray(normalized_states, dtype=np.float32))
+
+
+class FrozenModel:
+    """
+    Shared layers and both heads as NumPy layers
+    """
+
+    def __init__(self, header: dict, arrays: Dict[str, np.ndarray], head_activation: str):
+        self.header = header
+        self.in_features = header["in_features"]
+        self.device = torch.device("cpu")
+        self.init_layers = fused_layers(arrays, "init_layers", LEAKY_RELU)
+        self.bet_layers = fused_layers(arrays, "bet_layers", head_activation)
+        self.card_layers = fused_layers(arrays, "card_layers", head_activation)
+
+    def forward(self, normalized_states) -> Tuple[np.ndarray, np.ndarray]:
+        shared = run_layers(self.init_layers, _as_array(normalized_states))
+        return run_layers(self.bet_layers, shared), run_layers(self.card_layers, shared)
+
+    def bet_outputs(self, normalized_states) -> np.ndarray:
+        return run_layers(self.bet_layers, run_layers(self.init_layers, _as_array(normalized_states)))
+
+    def card_outputs(self, normalized_states) -> np.ndarray:
+        return run_layers(self.card_layers, run_layers(self.init_layers, _as_array(normalized_states)))
+
+    def logits(self, normalized_states) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Outputs of both heads before their final activation
+        """
+        shared = run_layers(self.init_layers, _as_array(normalized_states))
+        return tuple(
+            run_layers([*layers[:-1], layers[-1]._replace(activation=IDENTITY)], shared)
+            for layers in (self.bet_layers, self.card_layers)
+        )
+
+    def eval(self) -> "FrozenModel":
+        return self
+
+
+class FrozenPolicyModel(FrozenModel):
+    """
+    Inference only BlackjackPolicyModel, outputs are cpu tensors as the original returns them
+    """
+
+    # samples from get_card_probs exactly as the original does
+    get_card_actions = BlackjackPolicyModel.get_card_actions
+
+    def __init__(self, header: dict, arrays: Dict[str, np.ndarray]):
+        super().__init__(header, arrays, SIGMOID)
+
+    def get_bet_percent(self, normalized_state) -> torch.Tensor:
+        return torch.from_numpy(self.bet_outputs(normalized_state))
+
+    def get_card_action(self, normalized_state) -> torch.Tensor:
+        return torch.from_numpy(self.card_outputs(normalized_state))
+
+    def get_bet_percents(self, normalized_states) -> torch.Tensor:
+        return torch.from_numpy(self.bet_outputs(normalized_states))
+
+    def get_card_probs(self, normalized_states) -> torch.Tensor:
+        return torch.from_numpy(self.card_outputs(normalized_states))
+
+
+class FrozenDQN(FrozenModel):
+    """
+    Inference only BlackjackDQN, with the same epsilon-greedy selection as the original
+    """
+
+    get_epsilon = BlackjackDQN.get_epsilon
+    _select_batch = BlackjackDQN._select_batch
+
+    def __init__(self, header: dict, arrays: Dict[str, np.ndarray]):
+        super().__init__(header, arrays, IDENTITY)
+        self.bet_choices = list(header["bet_choices"])
+        self.card_choices = list(header["card_choices"])
+        self.epsilon = header["epsilon"]
+        self.min_epsilon = header["min_epsilon"]
+        num_bets, num_cards = len(self.bet_choices), len(self.card_choices)
+        self.bet_mask = torch.tensor([num_bets * [1] + num_cards * [0]])
+        self.card_mask = torch.tensor([num_bets * [0] + num_cards * [1]])
+        self.bet_choices_tensor = torch.tensor(self.bet_choices, dtype=torch.float32)
+        self.card_choices_tensor = torch.tensor(self.card_choices, dtype=torch.bool)
+
+    def _select(
+        self,
+        values: np.ndarray,
+        num_choices: int,
+        allow_explore: bool,
+        num_steps: int,
+        rng: Optional[np.random.Generator],
+    ) -> int:
+        # same draws as BlackjackDQN, so seeded runs take the same actions
+        idx = _explore(self.get_epsilon(num_steps), num_choices, rng) if allow_explore else None
+        return int(values.argmax()) if idx is None else idx
+
+    def get_bet_percent(
+        self, normalized_state, allow_explore: bool, num_steps: int, rng: Optional[np.random.Generator] = None
+    ) -> Tuple[float, int, torch.Tensor]:
+        values = self.bet_outputs(normalized_state)
+        idx = self._select(values, len(self.bet_choices), allow_explore, num_steps, rng)
+        return self.bet_choices[idx], idx, self.bet_mask.clone()
+
+    def get_card_action(
+        self, normalized_state, allow_explore: bool, num_steps: int, rng: Optional[np.random.Generator] = None
+    ) -> Tuple[bool, int, torch.Tensor]:
+        values = self.card_outputs(normalized_state)
+        idx = self._select(values, len(self.card_choices), allow_explore, num_steps, rng)
+        return self.card_choices[idx], idx + len(self.bet_choices), self.card_mask.clone()
+
+    def get_bet_percents(
+        self, normalized_states, allow_explore: bool, num_steps: int, generator: Optional[torch.Generator] = None
+    ) -> BatchedActions:
+        values = torch.from_numpy(self.bet_outputs(normalized_states))
+        return self._select_batch(
+            values, self.bet_choices_tensor, self.bet_mask, 0, allow_explore, num_steps, generator
+        )
+
+    def get_card_actions(
+        self, normalized_states, allow_explore: bool, num_steps: int, generator: Optional[torch.Generator] = None
+    ) -> BatchedActions:
+        values = torch.from_numpy(self.card_outputs(normalized_states))
+        return self._select_batch(
+            values,
+            self.card_choices_tensor,
+            self.card_mask,
+            len(self.bet_choices),
+            allow_explore,
+            num_steps,
+            generator,
+        )
+
+
+def export(model, backend: str = NUMPY):
+    """
+    Inference only copy of a trained BlackjackDQN or BlackjackPolicyModel, the model itself is not changed
+    """
+    if backend == NUMPY:
+        arrays = {name: value.detach().cpu().numpy() for name, value in model.state_dict().items()}
+        return _frozen(registry.model_metadata(model), arrays)
+    if backend == INT8:
+        quantized = torch.ao.quantization.quantize_dynamic(
+            copy.deepcopy(model).cpu().eval(), {nn.Linear}, dtype=torch.qint8
+        )
+        if isinstance(quantized, BlackjackPolicyModel):
+            quantized.device = torch.device("cpu")
+        return quantized
+    raise ValueError(f"backend has to be one of {BACKENDS}")
+
+
+def load_frozen(path):
+    """
+    NumPy frozen model straight from a portable checkpoint, without building the torch model
+    """
+    return _frozen(*registry.load_arrays(path))
+
+
+def _frozen(header: dict, arrays: Dict[str, np.ndarray]):
+    if header["architecture"] == "dqn":
+        return FrozenDQN(header, arrays)
+    if header["architecture"] == "policy":
+        return FrozenPolicyModel(header, arrays)
+    raise ValueError(f"architecture has to be one of {registry.ARCHITECTURES}")
+
+
+def state_corpus(
+    num_states: int,
+    add_steps: bool,
+    add_card_counting: bool = True,
+    seed: int = 0,
+    deck_nums: int = 8,
+    max_steps: int = 10,
+) -> np.ndarray:
+    """
+    (num_states, state_size) features of the states of seeded hands, hitting below 16
+    """
+    wrapper = BlackjackWrapper(10000, deck_nums, rng=np.random.default_rng(seed))
+    rows = []
+    while len(rows) < num_states:
+        wrapper = wrapper.reset()
+        outcome = wrapper.bet_step(0.2)
+        i_step = 1
+        while True:
+            step_num = i_step / max_steps if add_steps else None
+            rows.append(outcome.new_state.flatten(include_discarded=add_card_counting, step_num=step_num))
+            if outcome.terminated or len(rows) == num_states:
+                break
+            outcome = wrapper.card_step(take_card=wrapper.player.get_hand_value() < 16)
+            i_step += 1
+    return np.stack(rows).astype(np.float32)
+
+
+def head_outputs(model, normalized_states: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Raw (N, outputs) values of the bet and card heads of a torch or frozen model
+    """
+    if isinstance(model, FrozenModel):
+        return model.forward(normalized_states)
+    with torch.no_grad():
+        bet_values, card_values = model(torch.from_numpy(normalized_states))
+    return bet_values.numpy(), card_values.numpy()
+
+
+def head_logits(model, normalized_states: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (N, outputs) values of the bet and card heads before a final sigmoid, the same as head_outputs for the DQN
+    """
+    if isinstance(model, FrozenModel):
+        return model.logits(normalized_states)
+    with torch.no_grad():
+        shared = model.init_layers(torch.from_numpy(normalized_states))
+        return tuple(
+            (layers[:-1] if isinstance(layers[-1], nn.Sigmoid) else layers)(shared).numpy()
+            for layers in (model.bet_layers, model.card_layers)
+        )
+
+
+def accuracy(reference, candidate, corpus: np.ndarray) -> Dict[str, float]:
+    """
+    Output deltas of candidate against reference and how often both take the same action.
+    For the policy model the deltas before the sigmoid are reported too, absolute and relative to the
+    largest logit: a saturated sigmoid hides any error of the layers below it.
+    """
+    result = {}
+    is_dqn = isinstance(reference, BlackjackDQN)
+    outputs = zip(("bet", "card"), head_outputs(reference, corpus), head_outputs(candidate, corpus))
+    for head, expected, actual in outputs:
+        delta = np.abs(actual.astype(np.float64) - expected)
+        result[f"{head}_max_abs"] = float(delta.max())
+        result[f"{head}_mean_abs"] = float(delta.mean())
+        if is_dqn:
+            result[f"{head}_agreement"] = float(np.mean(actual.argmax(axis=-1) == expected.argmax(axis=-1)))
+        elif head == "card":
+            # take a card when more likely than not
+            result[f"{head}_agreement"] = float(np.mean((actual > 0.5) == (expected > 0.5)))
+    if not is_dqn:
+        logits = zip(("bet", "card"), head_logits(reference, corpus), head_logits(candidate, corpus))
+        for head, expected, actual in logits:
+            delta = np.abs(actual.astype(np.float64) - expected)
+            result[f"{head}_logit_max_abs"] = float(delta.max())
+            result[f"{head}_logit_mean_abs"] = float(delta.mean())
+            # relative to the largest logit, trained heads can saturate with logits far from 0
+            result[f"{head}_logit_max_rel"] = float(delta.max() / max(np.abs(expected).max(), 1e-12))
+    return result
+
+
+def latency(
+    model, corpus: np.ndarray, batch_sizes: Sequence[int] = DEFAULT_BATCH_SIZES, repeat: int = 200
+) -> Dict[str, dict]:
+    """
+    Timings of single state get_bet_percent / get_card_action calls on the inputs the game loops pass
+    (a tensor row for the DQN, a numpy row for the policy model) and of the batched calls per batch size
+    """
+    is_dqn = isinstance(model, (BlackjackDQN, FrozenDQN))
+    if is_dqn:
+        rows = itertools.cycle([torch.from_numpy(row[None]) for row in corpus[:256]])
+        single = dict(
+            bet=lambda: model.get_bet_percent(next(rows), False, 0),
+            card=lambda: model.get_card_action(next(rows), False, 0),
+        )
+    else:
+        rows = itertools.cycle(corpus[:256])
+        single = dict(bet=lambda: model.get_bet_percent(next(rows)), card=lambda: model.get_card_action(next(rows)))
+
+    result = {}
+    with torch.no_grad():
+        for head, fn in single.items():
+            result[f"single_{head}"] = measure(fn, repeat=repeat, inner=10)
+        for batch_size in batch_sizes:
+            states = np.resize(corpus, (batch_size, corpus.shape[1]))
+            if is_dqn:
+                batched = dict(
+                    bet=lambda: model.get_bet_percents(states, False, 0),
+                    card=lambda: model.get_card_actions(states, False, 0),
+                )
+            else:
+                batched = dict(bet=lambda: model.get_bet_percents(states), card=lambda: model.get_card_probs(states))
+            for head, fn in batched.items():
+                result[f"batch_{head}[batch_size={batch_size}]"] = measure(fn, repeat=repeat, items=batch_size)
+    return result
+
+
+def report(
+    model,
+    corpus: np.ndarray,
+    backends: Sequence[str] = BACKENDS,
+    batch_sizes: Sequence[int] = DEFAULT_BATCH_SIZES,
+    repeat: int = 200,
+) -> Dict[str, dict]:
+    """
+    Latency of the float model and of every backend, with the accuracy of each backend against the float model
+    """
+    model = model.cpu().eval()
+    results = {"float": dict(latency=latency(model, corpus, batch_sizes, repeat))}
+    for backend in backends:
+        frozen = export(model, backend)
+        results[backend] = dict(
+            accuracy=accuracy(model, frozen, corpus), latency=latency(frozen, corpus, batch_sizes, repeat)
+        )
+    return results
+
+
+def format_report(results: Dict[str, dict]) -> str:
+    backends = [name for name in results if name != "float"]
+    header = "".join(f"{name + ' p50 us':>14}{'speedup':>9}" for name in backends)
+    lines = [f"{'call':<32}{'float p50 us':>14}{header}"]
+    for call, timing in results["float"]["latency"].items():
+        line = f"{call:<32}{timing['p50_ns'] / 1e3:>14.2f}"
+        for name in backends:
+            p50 = results[name]["latency"][call]["p50_ns"]
+            line += f"{p50 / 1e3:>14.2f}{timing['p50_ns'] / p50:>8.1f}x"
+        lines.append(line)
+    for name in backends:
+        lines.append("")
+        lines.append(f"{name} against float:")
+        lines.extend(f"  {key:<20}{value:.3g}" for key, value in results[name]["accuracy"].items())
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("checkpoint", help="portable .bjm checkpoint")
+    parser.add_argument("--backend", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("--num-states", type=int, default=4096, help="size of the state corpus")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=list(DEFAULT_BATCH_SIZES))
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the report to this json file")
+    args = parser.parse_args()
+
+    header = registry.read_header(args.checkpoint)
+    corpus = state_corpus(args.num_states, header["add_steps"], header["add_card_counting"], seed=args.seed)
+    results = report(registry.load_model(args.checkpoint), corpus, args.backend, args.batch_sizes, args.repeat)
+    print(format_report(results))
+    if args.output:
+        with open(args.output, "w") as f:
+            metadata = dict(checkpoint=args.checkpoint, num_states=args.num_states, seed=args.seed)
+            json.dump(dict(metadata, results=results), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Lookup table policy distilled from a trained model, see training.distill
+
+The table reads the same flattened features as the models (GameState.flatten layout)
+and maps them to a small key:
+- bet decisions: (true count bucket, cash bucket)
+- card decisions: (hand value, soft, 2 cards, true count bucket, cash bucket, step)
+Actions are stored quantized as uint8. Loading and querying only needs numpy, not torch.
+"""
+import bisect
+import json
+from typing import Optional, Sequence
+
+import numpy as np
+
+from game.models import hand as hand_lookup
+from game.models.counting import CARDS_PER_DECK, HI_LO_WEIGHTS
+from game.models.features import DISCARDED_OFFSET, NUM_RANKS, REMAINING_CASH_IDX, STEP_NUM_IDX
+
+_HI_LO_WEIGHTS = HI_LO_WEIGHTS.tolist()
+_RANK_VALUES = hand_lookup.RANK_VALUES.tolist()
+DEFAULT_COUNT_LIMIT = 4
+DEFAULT_CASH_EDGES = (0.25, 0.5, 0.75, 1.0, 1.25, 1.5, 2.0)
+# hand values 0 to 21, and 22 for any bust
+NUM_HAND_VALUES = hand_lookup.BUST_TOTAL + 1
+# kinds of table
+DQN, POLICY = "dqn", "policy"
+
+
+class PolicyTable:
+    """
+    For a DQN table, bet_table holds the index into bet_choices and card_table holds 1 to take a card.
+    For a policy model table, both hold the model output quantized to 0..255.
+    """
+
+    def __init__(
+        self,
+        kind: str,
+        deck_nums: int,
+        bet_table: np.ndarray,
+        card_table: np.ndarray,
+        bet_choices: Optional[Sequence[float]] = None,
+        count_limit: int = DEFAULT_COUNT_LIMIT,
+        cash_edges: Sequence[float] = DEFAULT_CASH_EDGES,
+        max_steps: int = 1,
+    ):
+        if kind not in (DQN, POLICY):
+            raise ValueError(f"kind has to be {DQN} or {POLICY}")
+        self.kind = kind
+        self.deck_nums = deck_nums
+        self.bet_table = bet_table.astype(np.uint8)
+        self.card_table = card_table.astype(np.uint8)
+        self.bet_choices = np.array(bet_choices if bet_choices is not None else [], dtype=np.float64)
+        self.count_limit = count_limit
+        self.cash_edges = np.array(cash_edges, dtype=np.float64)
+        self.max_steps = max_steps
+        self._cash_edges = self.cash_edges.tolist()
+
+    @staticmethod
+    def table_shapes(count_limit: int, num_cash_edges: int, max_steps: int):
+        num_counts = 2 * count_limit + 1
+        num_cash = num_cash_edges + 1
+        return (num_counts, num_cash), (NUM_HAND_VALUES, 2, 2, num_counts, num_cash, max_steps)
+
+    def state_keys(self, features: np.ndarray):
+        """
+        Bet and card table indices of a (N, state_size) feature matrix
+        """
+        features = np.atleast_2d(features)
+        hand = np.rint(features[:, :NUM_RANKS] * self.deck_nums).astype(np.int64)
+        discarded = features[:, DISCARDED_OFFSET : DISCARDED_OFFSET + NUM_RANKS]
+        discarded = np.rint(discarded * self.deck_nums).astype(np.int64)
+
+        # Hi-Lo true count over the cards the player has not seen
+        unseen = self.deck_nums * CARDS_PER_DECK - discarded.sum(axis=1) - hand.sum(axis=1)
+        true_count = (discarded @ HI_LO_WEIGHTS) / np.maximum(unseen / CARDS_PER_DECK, 0.5)
+        count_idx = np.clip(np.rint(true_count), -self.count_limit, self.count_limit).astype(np.int64) + self.count_limit
+        cash_idx = np.searchsorted(self.cash_edges, features[:, REMAINING_CASH_IDX], side="right")
+
+        values, soft, _, _ = hand_lookup.batch_score_hands(*hand_lookup.hand_summary(hand))
+        num_cards = hand.sum(axis=1)
+        if features.shape[1] > STEP_NUM_IDX:
+            step_idx = np.rint(features[:, STEP_NUM_IDX] * self.max_steps).astype(np.int64)
+            step_idx = np.clip(step_idx, 0, self.max_steps - 1)
+        else:
+            step_idx = np.zeros(len(features), dtype=np.int64)
+        bet_key = (count_idx, cash_idx)
+        card_key = (
+            np.minimum(values, NUM_HAND_VALUES - 1),
+            soft.astype(np.int64),
+            (num_cards == 2).astype(np.int64),
+            count_idx,
+            cash_idx,
+            step_idx,
+        )
+        return bet_key, card_key
+
+    def _row_keys(self, normalized_state: np.ndarray):
+        """
+        Same as state_keys for a single row, in plain python which is much faster than numpy for one state
+        """
+        values = np.ravel(normalized_state).tolist()
+        deck_nums = self.deck_nums
+        hand = [round(value * deck_nums) for value in values[:NUM_RANKS]]
+        discarded = [round(value * deck_nums) for value in values[DISCARDED_OFFSET : DISCARDED_OFFSET + NUM_RANKS]]
+        num_cards = sum(hand)
+
+        unseen = deck_nums * CARDS_PER_DECK - sum(discarded) - num_cards
+        running_count = sum(weight * amount for weight, amount in zip(_HI_LO_WEIGHTS, discarded))
+        true_count = running_count / max(unseen / CARDS_PER_DECK, 0.5)
+        count_idx = min(max(round(true_count), -self.count_limit), self.count_limit) + self.count_limit
+        cash_idx = bisect.bisect_right(self._cash_edges, values[REMAINING_CASH_IDX])
+
+        hard_total = sum(value * amount for value, amount in zip(_RANK_VALUES, hand))
+        value = hand_lookup.get_hand_value(hard_total, hand[0], num_cards)
+        soft = hand_lookup.is_soft(hard_total, hand[0], num_cards)
+        if len(values) > STEP_NUM_IDX:
+            step_idx = min(max(round(values[STEP_NUM_IDX] * self.max_steps), 0), self.max_steps - 1)
+        else:
+            step_idx = 0
+        card_key = (min(value, NUM_HAND_VALUES - 1), int(soft), int(num_cards == 2), count_idx, cash_idx, step_idx)
+        return (count_idx, cash_idx), card_key
+
+    def bet_outputs(self, features: np.ndarray) -> np.ndarray:
+        """
+        Bet index (DQN) or bet percent (policy model) of each row
+        """
+        bet_key, _ = self.state_keys(features)
+        stored = self.bet_table[bet_key]
+        if self.kind == DQN:
+            return stored.astype(np.int64)
+        return stored / 255
+
+    def card_outputs(self, features: np.ndarray) -> np.ndarray:
+        """
+        Take card flag (DQN) or probability of taking a card (policy model) of each row
+        """
+        _, card_key = self.state_keys(features)
+        stored = self.card_table[card_key]
+        if self.kind == DQN:
+            return stored.astype(bool)
+        return stored / 255
+
+    def get_bet_percents(self, features: np.ndarray) -> np.ndarray:
+        outputs = self.bet_outputs(features)
+        return self.bet_choices[outputs] if self.kind == DQN else outputs
+
+    def get_card_actions(self, features: np.ndarray, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+        """
+        Take card decisions, policy model probabilities are sampled with rng or thresholded at 0.5 without one
+        """
+        outputs = self.card_outputs(features)
+        if self.kind == DQN:
+            return outputs
+        draws = rng.random(len(outputs)) if rng is not None else 0.5
+        return outputs > draws
+
+    def get_bet_percent(self, normalized_state: np.ndarray) -> float:
+        bet_key, _ = self._row_keys(normalized_state)
+        stored = int(self.bet_table[bet_key])
+        return float(self.bet_choices[stored]) if self.kind == DQN else stored / 255
+
+    def get_card_action(self, normalized_state: np.ndarray, rng: Optional[np.random.Generator] = None) -> bool:
+        _, card_key = self._row_keys(normalized_state)
+        stored = int(self.card_table[card_key])
+        if self.kind == DQN:
+            return bool(stored)
+        return stored / 255 > (rng.random() if rng is not None else 0.5)
+
+    def save(self, path: str) -> None:
+        metadata = dict(
+            kind=self.kind,
+            deck_nums=self.deck_nums,
+            bet_choices=self.bet_choices.tolist(),
+            count_limit=self.count_limit,
+            cash_edges=self.cash_edges.tolist(),
+            max_steps=self.max_steps,
+        )
+        with open(path, "wb") as f:
+            np.savez_compressed(
+                f,
+                bet_table=self.bet_table,
+                card_table=self.card_table,
+                metadata=np.array(json.dumps(metadata)),
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "PolicyTable":
+        with np.load(path) as data:
+            metadata = json.loads(str(data["metadata"]))
+            return cls(bet_table=data["bet_table"], card_table=data["card_table"], **metadata)
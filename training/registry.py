@@ -0,0 +1,239 @@
+"""
+Portable checkpoint format for BlackjackDQN and BlackjackPolicyModel
+
+A checkpoint file is
+    magic (8 bytes) | header length (uint64 little endian) | json header | padding | tensor data
+where every tensor is stored as raw little endian bytes at a 64 byte aligned offset of the data section.
+The header records the architecture, in_features, add_steps, add_card_counting, the DQN choices
+and the name, dtype, shape and offset of every tensor.
+
+Loading memory maps the file, so the weights are never copied on the CPU and stay shared between
+processes loading the same file. Headers and raw arrays can be read without torch.
+
+    python -m training.registry convert models
+    model = load_model("models/policy_steps.bjm")
+"""
+import argparse
+import json
+import struct
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+MAGIC = b"BJCKPT\x00\x01"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+SUFFIX = ".bjm"
+ARCHITECTURES = ("dqn", "policy")
+# used by the DQN notebooks, the original pickles do not record them
+DEFAULT_BET_CHOICES = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+DEFAULT_CARD_CHOICES = [True, False]
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _read_prefix(f) -> Tuple[dict, int]:
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"{f.name} is not a {SUFFIX} checkpoint")
+    (header_size,) = struct.unpack("<Q", f.read(8))
+    header = json.loads(f.read(header_size))
+    if header["format_version"] > FORMAT_VERSION:
+        raise ValueError(f"{f.name} has format version {header['format_version']}, newest supported is {FORMAT_VERSION}")
+    return header, _align(len(MAGIC) + 8 + header_size)
+
+
+def read_header(path) -> dict:
+    """
+    Metadata of a checkpoint without reading the weights
+    """
+    with open(path, "rb") as f:
+        header, _ = _read_prefix(f)
+    return header
+
+
+def load_arrays(path) -> Tuple[dict, Dict[str, np.ndarray]]:
+    """
+    Header and read only numpy views of every tensor, memory mapped from the file
+    """
+    with open(path, "rb") as f:
+        header, data_offset = _read_prefix(f)
+    buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {}
+    for tensor in header["tensors"]:
+        dtype = np.dtype(tensor["dtype"]).newbyteorder("<")
+        count = int(np.prod(tensor["shape"], dtype=np.int64))
+        start = data_offset + tensor["offset"]
+        arrays[tensor["name"]] = np.frombuffer(buffer, dtype=dtype, count=count, offset=start).reshape(tensor["shape"])
+    return header, arrays
+
+
+def write_checkpoint(path, metadata: dict, arrays: Dict[str, np.ndarray]) -> None:
+    """
+    Writes arrays with metadata merged into the header
+    """
+    tensors = []
+    offset = 0
+    for name, array in arrays.items():
+        tensors.append(dict(name=name, dtype=array.dtype.newbyteorder("<").str, shape=list(array.shape), offset=offset))
+        offset = _align(offset + array.nbytes)
+    header = dict(metadata, format_version=FORMAT_VERSION, tensors=tensors)
+    header_bytes = json.dumps(header).encode()
+    prefix_size = len(MAGIC) + 8 + len(header_bytes)
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        f.write(b"\x00" * (_align(prefix_size) - prefix_size))
+        for tensor, array in zip(tensors, arrays.values()):
+            f.write(np.ascontiguousarray(array, dtype=tensor["dtype"]).tobytes())
+            f.write(b"\x00" * (_align(array.nbytes) - array.nbytes))
+
+
+def model_metadata(model, add_card_counting: bool = True) -> dict:
+    from game.models.model import GameState
+    from training.agent import BlackjackDQN, BlackjackPolicyModel
+
+    in_features = model.init_layers[0].in_features
+    metadata = dict(
+        in_features=in_features,
+        add_steps=in_features == GameState.get_state_size(add_steps=True),
+        add_card_counting=add_card_counting,
+    )
+    if isinstance(model, BlackjackDQN):
+        return dict(
+            metadata,
+            architecture="dqn",
+            bet_choices=list(model.bet_choices),
+            card_choices=list(model.card_choices),
+            epsilon=model.epsilon,
+            min_epsilon=model.min_epsilon,
+        )
+    if isinstance(model, BlackjackPolicyModel):
+        return dict(metadata, architecture="policy")
+    raise TypeError(f"unsupported model type {type(model).__name__}")
+
+
+def save_model(model, path, add_card_counting: bool = True) -> None:
+    """
+    Saves the weights of model, on any device, in the portable format
+    """
+    arrays = {name: value.detach().cpu().numpy() for name, value in model.state_dict().items()}
+    write_checkpoint(path, model_metadata(model, add_card_counting), arrays)
+
+
+def build_model(header: dict, device="cpu"):
+    """
+    Untrained model with the architecture described by a header
+    """
+    from training.agent import BlackjackDQN, BlackjackPolicyModel
+
+    if header["architecture"] == "dqn":
+        return BlackjackDQN(
+            in_features=header["in_features"],
+            bet_choices=header["bet_choices"],
+            card_choices=header["card_choices"],
+            epsilon=header["epsilon"],
+            min_epsilon=header["min_epsilon"],
+        ).to(device)
+    if header["architecture"] == "policy":
+        return BlackjackPolicyModel(in_features=header["in_features"], device=device).to(device)
+    raise ValueError(f"architecture has to be one of {ARCHITECTURES}")
+
+
+def load_model(path, device="cpu"):
+    """
+    Model in eval mode. On the CPU its parameters are views of the memory mapped file (copy on write),
+    on other devices they are copied once.
+    """
+    import torch
+
+    with open(path, "rb") as f:
+        header, data_offset = _read_prefix(f)
+    storage = torch.from_file(str(path), shared=False, size=Path(path).stat().st_size, dtype=torch.uint8)
+    state_dict = {}
+    for tensor in header["tensors"]:
+        dtype = getattr(torch, np.dtype(tensor["dtype"]).name)
+        start = data_offset + tensor["offset"]
+        nbytes = int(np.prod(tensor["shape"], dtype=np.int64)) * np.dtype(tensor["dtype"]).itemsize
+        state_dict[tensor["name"]] = storage[start : start + nbytes].view(dtype).view(tensor["shape"])
+
+    model = build_model(header, device)
+    if str(device) == "cpu":
+        model.load_state_dict(state_dict, assign=True)
+    else:
+        model.load_state_dict(state_dict)
+    return model.eval()
+
+
+def convert_checkpoint(
+    src,
+    dst=None,
+    architecture: Optional[str] = None,
+    add_card_counting: Optional[bool] = None,
+    bet_choices: List[float] = DEFAULT_BET_CHOICES,
+    card_choices: List[bool] = DEFAULT_CARD_CHOICES,
+) -> Path:
+    """
+    Converts a torch.save state_dict, e.g. from models/, saved on any device.
+    architecture and add_card_counting default to the naming convention of models/:
+    names starting with "dqn" are DQNs and names containing "no_counting" were trained without counting.
+    """
+    import torch
+
+    src = Path(src)
+    dst = Path(dst) if dst is not None else src.with_name(src.name + SUFFIX)
+    if architecture is None:
+        architecture = "dqn" if src.name.startswith("dqn") else "policy"
+    if add_card_counting is None:
+        add_card_counting = "no_counting" not in src.name
+
+    state_dict = torch.load(src, map_location="cpu")
+    in_features = state_dict["init_layers.0.weight"].shape[1]
+    header = dict(architecture=architecture, in_features=in_features)
+    if architecture == "dqn":
+        header.update(bet_choices=bet_choices, card_choices=card_choices, epsilon=0.0, min_epsilon=0.0)
+    # round trip through the model so that missing or unexpected keys are caught
+    model = build_model(header)
+    model.load_state_dict(state_dict)
+    save_model(model, dst, add_card_counting=add_card_counting)
+    return dst
+
+
+def list_models(model_dir="models") -> Dict[str, dict]:
+    """
+    Headers of every portable checkpoint in model_dir, by name without suffix
+    """
+    return {path.stem: read_header(path) for path in sorted(Path(model_dir).glob(f"*{SUFFIX}"))}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    convert = commands.add_parser("convert", help="convert torch.save checkpoints, a directory converts every one in it")
+    convert.add_argument("paths", nargs="+")
+    commands.add_parser("list", help="show the portable checkpoints of a directory").add_argument(
+        "model_dir", nargs="?", default="models"
+    )
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        for path in map(Path, args.paths):
+            sources = [path] if path.is_file() else [
+                src for src in sorted(path.iterdir()) if src.is_file() and not src.suffix
+            ]
+            for src in sources:
+                print(f"{src} -> {convert_checkpoint(src)}")
+    else:
+        for name, header in list_models(args.model_dir).items():
+            print(
+                f"{name}: {header['architecture']}, in_features={header['in_features']}, "
+                f"add_steps={header['add_steps']}, add_card_counting={header['add_card_counting']}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Batched REINFORCE for BlackjackPolicyModel
+
+Every update plays one round on each table of a VectorBlackjackEnv in lockstep, so a batch of
+num_envs episodes costs max_steps forward passes instead of one per step of every episode.
+Episodes are kept as zero padded (episodes, steps) arrays with a mask of the valid steps:
+discounted returns are a single matrix product and the loss of the whole batch is one forward
+pass over the valid steps followed by one masked sum.
+
+The objective is the one of the original per episode loop:
+    loss = -sum over valid steps of normalized return * log(output + 1e-8)
+where output is the bet percent on step 0 and the probability of taking a card on later steps,
+and returns are normalized over all valid steps of the batch.
+
+    env = VectorBlackjackEnv(batch_size, initial_cash, deck_nums, min_bet)
+    scores = reinforce(env, model, optimizer, scheduler, scheduler_step_every, num_updates, gamma)
+"""
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+import torch
+from torch import optim
+from tqdm.auto import tqdm, trange
+
+from game.instrumentation import stage
+from game.models.features import write_batch_features
+from game.models.model import GameState
+from game.vector_api import VectorBlackjackEnv
+from training.agent import BlackjackPolicyModel
+from training.score_log import ScoreLogWriter
+
+
+class EpisodeBatch(NamedTuple):
+    """
+    One round of every table, padded to max_steps
+    """
+    # (episodes, steps, state_size) features each action was taken on
+    features: np.ndarray
+    # (episodes, steps) reward of each step, 0 after the episode ended
+    rewards: np.ndarray
+    # (episodes, steps) True for the steps that were played
+    mask: np.ndarray
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return self.mask.sum(axis=1)
+
+
+def discount_matrix(num_steps: int, gamma: float) -> np.ndarray:
+    """
+    Upper triangular (steps, steps) matrix with gamma ** (k - t) in row t, column k >= t
+    """
+    steps = np.arange(num_steps)
+    exponents = steps[None, :] - steps[:, None]
+    return np.where(exponents >= 0, gamma ** np.maximum(exponents, 0), 0.0)
+
+
+def discounted_returns(rewards: np.ndarray, gamma: float) -> np.ndarray:
+    """
+    Discounted return of every step of zero padded (episodes, steps) rewards,
+    G[e, t] = sum over k >= t of gamma ** (k - t) * rewards[e, k]
+    """
+    return rewards @ discount_matrix(rewards.shape[1], gamma).T
+
+
+def play_episodes(
+    env: VectorBlackjackEnv,
+    policy_model: BlackjackPolicyModel,
+    max_steps: int = 10,
+    add_step: bool = False,
+    add_card_counting: bool = True,
+    rng: Optional[np.random.Generator] = None,
+) -> EpisodeBatch:
+    """
+    Plays the next round of every table of env, at most max_steps steps each.
+    Card actions are sampled as in the original loop: take a card if its probability > a uniform draw.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    num_envs = env.num_envs
+    state_size = GameState.get_state_size(add_steps=add_step)
+    features = np.zeros((num_envs, max_steps, state_size), dtype=np.float32)
+    rewards = np.zeros((num_envs, max_steps))
+    mask = np.zeros((num_envs, max_steps), dtype=bool)
+
+    env.reset()
+    state = env.get_state()
+    active = np.ones(num_envs, dtype=bool)
+    with torch.no_grad():
+        for i_step in range(max_steps):
+            step_num = i_step / max_steps if add_step else None
+            step_features = write_batch_features(
+                state, features[:, i_step], include_discarded=add_card_counting, step_num=step_num
+            )
+            mask[:, i_step] = active
+            if i_step == 0:
+                bet_percents = policy_model.get_bet_percents(step_features).squeeze(-1).cpu().numpy()
+                outcome = env.bet_step(bet_percents)
+            else:
+                rows = np.flatnonzero(active)
+                card_probs = policy_model.get_card_probs(step_features[rows]).squeeze(-1).cpu().numpy()
+                take_card = np.zeros(num_envs, dtype=bool)
+                take_card[rows] = card_probs > rng.random(len(rows))
+                outcome = env.card_step(take_card)
+            rewards[:, i_step] = np.where(active, outcome.reward, 0.0)
+            active &= ~outcome.terminated
+            state = outcome.new_state
+            if not active.any():
+                break
+    return EpisodeBatch(features=features, rewards=rewards, mask=mask)
+
+
+def policy_loss(
+    policy_model: BlackjackPolicyModel, episodes: EpisodeBatch, gamma: float
+) -> torch.Tensor:
+    """
+    REINFORCE loss of a batch of episodes, the outputs of all valid steps are recomputed in one forward pass
+    """
+    returns = discounted_returns(episodes.rewards, gamma)[episodes.mask]
+    returns = (returns - returns.mean()) / (returns.std() + 1e-8)
+    returns = torch.from_numpy(returns).to(device=policy_model.device, dtype=torch.float32)
+
+    device = policy_model.device
+    features = torch.from_numpy(episodes.features[episodes.mask]).to(device)
+    # the valid steps are taken row by row, so step 0 of each episode is a bet
+    is_bet = torch.from_numpy(np.nonzero(episodes.mask)[1] == 0).to(device)
+    shared = policy_model.init_layers(features)
+    outputs = torch.where(
+        is_bet, policy_model.bet_layers(shared).squeeze(-1), policy_model.card_layers(shared).squeeze(-1)
+    )
+    return -(returns * (outputs + 1e-8).log()).sum()
+
+
+def reinforce(
+    env: VectorBlackjackEnv,
+    policy_model: BlackjackPolicyModel,
+    optimizer: optim.Optimizer,
+    scheduler: optim.lr_scheduler._LRScheduler,
+    scheduler_step_every: int,
+    num_updates: int,
+    gamma: float,
+    max_steps: int = 10,
+    add_step: bool = False,
+    add_card_counting: bool = True,
+    log_every: int = 10,
+    score_log: Optional[ScoreLogWriter] = None,
+    seed: Optional[int] = None,
+) -> List[float]:
+    """
+    num_updates policy gradient steps on batches of env.num_envs episodes,
+    returns the total reward of every episode played
+    """
+    print("Starting RL training process...")
+    rng = np.random.default_rng(seed)
+    eps_scores: List[float] = []
+    last_logged_eps_scores: List[float] = []
+
+    for i_update in trange(num_updates):
+        with stage("reinforce.rollout"):
+            episodes = play_episodes(
+                env,
+                policy_model,
+                max_steps=max_steps,
+                add_step=add_step,
+                add_card_counting=add_card_counting,
+                rng=rng,
+            )
+        if score_log is not None:
+            score_log.append_padded(episodes.rewards, episodes.lengths)
+        batch_scores = episodes.rewards.sum(axis=1).tolist()
+        eps_scores.extend(batch_scores)
+        last_logged_eps_scores.extend(batch_scores)
+
+        with stage("reinforce.train"):
+            loss = policy_loss(policy_model, episodes, gamma)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+        if i_update % scheduler_step_every == 0:
+            scheduler.step()
+
+        if i_update % log_every == 0:
+            tqdm.write(
+                f"Episode {i_update}"
+                f"\t\tLast Logged Average Score: {round(np.mean(last_logged_eps_scores).item(), 3)}"
+                f"\t\tRunning Average Score: {round(np.mean(eps_scores).item(), 3)}"
+            )
+            last_logged_eps_scores = []
+
+    return eps_scores
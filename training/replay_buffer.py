@@ -0,0 +1,202 @@
+from typing import NamedTuple, Optional
+
+import numpy as np
+import torch
+
+PRIORITY_MODES = ("uniform", "reward", "td")
+
+
+class SumTree:
+    """
+    Binary tree where each node holds the sum of its two children and leaves hold priorities.
+    Updates and prefix sum searches take O(log n) and are vectorized over a batch of leaves.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.num_leaves = 1 << max(capacity - 1, 0).bit_length()
+        # node 1 is the root, the children of node i are 2i and 2i + 1
+        self.tree = np.zeros(2 * self.num_leaves)
+
+    def total(self) -> float:
+        return self.tree[1]
+
+    def get(self, indices: np.ndarray) -> np.ndarray:
+        return self.tree[self.num_leaves + indices]
+
+    def update(self, indices: np.ndarray, priorities: np.ndarray) -> None:
+        nodes = np.asarray(indices) + self.num_leaves
+        self.tree[nodes] = priorities
+        # all leaves are on the same level, so the parents are too
+        while nodes[0] > 1:
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values: np.ndarray) -> np.ndarray:
+        """
+        Index of the leaf where the running sum of priorities passes each value
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        while nodes[0] < self.num_leaves:
+            left = 2 * nodes
+            left_sums = self.tree[left]
+            # never walk into an empty subtree, e.g. because of rounding at the upper end
+            go_right = (values >= left_sums) & (self.tree[left + 1] > 0)
+            values -= left_sums * go_right
+            nodes = left + go_right
+        return nodes - self.num_leaves
+
+
+class ReplayBatch(NamedTuple):
+    state: torch.Tensor
+    action: torch.Tensor
+    next_state: torch.Tensor
+    reward: torch.Tensor
+    mask: torch.Tensor
+    done: torch.Tensor
+    # importance sampling weights, all ones when sampled with beta=0
+    weights: torch.Tensor
+    # positions in the buffer, to be passed back to update_priorities
+    indices: np.ndarray
+
+
+class ReplayBuffer:
+    """
+    Fixed capacity replay buffer with preallocated tensors for every field
+    and proportional prioritized sampling through a SumTree.
+
+    priority_mode decides the priority of new transitions:
+    - "uniform": every transition has the same priority
+    - "reward": max(|reward|, |mean reward in buffer|), the weighting previously used by dqn.ipynb.
+      The mean is taken when the transition is pushed, older priorities are not rescaled.
+    - "td": the highest priority seen so far, to be refined with update_priorities after each train step
+    Priorities are raised to the power alpha before being stored.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        state_size: int,
+        mask_size: int,
+        device="cpu",
+        priority_mode: str = "reward",
+        alpha: float = 1.0,
+        eps: float = 1e-6,
+        seed: Optional[int] = None,
+    ):
+        if priority_mode not in PRIORITY_MODES:
+            raise ValueError(f"priority_mode has to be one of {PRIORITY_MODES}")
+
+        self.capacity = capacity
+        self.device = device
+        self.priority_mode = priority_mode
+        self.alpha = alpha
+        self.eps = eps
+        self.rng = np.random.default_rng(seed)
+
+        self.states = torch.zeros((capacity, state_size), dtype=torch.float32, device=device)
+        self.actions = torch.zeros(capacity, dtype=torch.int64, device=device)
+        self.next_states = torch.zeros((capacity, state_size), dtype=torch.float32, device=device)
+        self.rewards = torch.zeros(capacity, dtype=torch.float32, device=device)
+        self.masks = torch.zeros((capacity, mask_size), dtype=torch.float32, device=device)
+        self.dones = torch.zeros(capacity, dtype=torch.bool, device=device)
+        # host copy of rewards, so that priorities never need a device sync
+        self.host_rewards = np.zeros(capacity)
+
+        self.tree = SumTree(capacity)
+        self.position = 0
+        self.size = 0
+        # number of transitions pushed since creation, transition i is stored at i % capacity
+        self.num_pushed = 0
+        # set once priorities of stored transitions have been changed, see training.snapshot
+        self.priorities_updated = False
+        self.reward_sum = 0.0
+        self.max_priority = 1.0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def push(self, state, action, next_state, reward, mask, done=False) -> None:
+        """
+        Stores a single transition, state and next_state may have a leading batch dimension of 1
+        """
+        self.push_batch(state, [action], next_state, [reward], mask, [done])
+
+    def push_batch(self, states, actions, next_states, rewards, masks, dones) -> None:
+        """
+        Stores len(rewards) transitions, overwriting the oldest ones once the buffer is full.
+        Each field may be a numpy array, a tensor on any device or a list.
+        """
+        host_rewards = np.asarray(
+            rewards.cpu() if isinstance(rewards, torch.Tensor) else rewards, dtype=np.float64
+        ).reshape(-1)
+        num = len(host_rewards)
+        # of more than capacity transitions only the last capacity ones would be kept,
+        # the others are skipped so that no slot is written twice
+        skip = max(num - self.capacity, 0)
+        host_rewards = host_rewards[skip:]
+        indices = (self.position + skip + np.arange(num - skip)) % self.capacity
+        idx = torch.from_numpy(indices).to(self.device)
+
+        self.states[idx] = self._as_tensor(states, torch.float32).reshape(num, -1)[skip:]
+        self.actions[idx] = self._as_tensor(actions, torch.int64).reshape(num)[skip:]
+        self.next_states[idx] = self._as_tensor(next_states, torch.float32).reshape(num, -1)[skip:]
+        self.rewards[idx] = self._as_tensor(host_rewards, torch.float32)
+        self.masks[idx] = self._as_tensor(masks, torch.float32).reshape(num, -1)[skip:]
+        self.dones[idx] = self._as_tensor(dones, torch.bool).reshape(num)[skip:]
+
+        self.reward_sum += host_rewards.sum() - self.host_rewards[indices].sum()
+        self.host_rewards[indices] = host_rewards
+        self.position = (self.position + num) % self.capacity
+        self.num_pushed += num
+        self.size = min(self.size + num, self.capacity)
+        self.tree.update(indices, self._initial_priorities(host_rewards))
+
+    def _as_tensor(self, values, dtype) -> torch.Tensor:
+        return torch.as_tensor(values, dtype=dtype, device=self.device)
+
+    def _initial_priorities(self, rewards: np.ndarray) -> np.ndarray:
+        if self.priority_mode == "uniform":
+            return np.ones(len(rewards))
+        if self.priority_mode == "td":
+            return np.full(len(rewards), self.max_priority)
+        mean_reward = abs(self.reward_sum / self.size)
+        return (np.maximum(np.abs(rewards), mean_reward) + self.eps) ** self.alpha
+
+    def sample(self, batch_size: int, beta: float = 0.0) -> ReplayBatch:
+        """
+        Samples batch_size transitions with probability proportional to their priority.
+        The total priority is split in batch_size equal segments with one sample drawn from each,
+        which keeps duplicates rare without the cost of sampling without replacement.
+        """
+        total = self.tree.total()
+        values = (np.arange(batch_size) + self.rng.random(batch_size)) * (total / batch_size)
+        indices = np.minimum(self.tree.find(values), self.size - 1)
+
+        probs = self.tree.get(indices) / total
+        weights = (self.size * probs) ** -beta
+        weights /= weights.max()
+
+        idx = torch.from_numpy(indices).to(self.device)
+        return ReplayBatch(
+            state=self.states[idx],
+            action=self.actions[idx],
+            next_state=self.next_states[idx],
+            reward=self.rewards[idx],
+            mask=self.masks[idx],
+            done=self.dones[idx],
+            weights=self._as_tensor(weights, torch.float32),
+            indices=indices,
+        )
+
+    def update_priorities(self, indices: np.ndarray, td_errors) -> None:
+        """
+        Sets the priorities of sampled transitions from their absolute TD errors
+        """
+        if isinstance(td_errors, torch.Tensor):
+            td_errors = td_errors.detach().cpu().numpy()
+        priorities = (np.abs(td_errors).reshape(-1) + self.eps) ** self.alpha
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.tree.update(indices, priorities)
+        self.priorities_updated = True
@@ -0,0 +1,478 @@
+"""
+Parallel rollout collection
+
+Every worker process owns its own BlackjackWrapper tables and random streams, plays them in lockstep
+with a CPU copy of the model and writes transitions into a shared memory ring buffer.
+The learner copies transitions out of the rings without any pickling and periodically broadcasts
+new weights through a CPU model kept in shared memory.
+
+    with RolloutPool(dqn_model, num_workers=8, seed=0) as pool:
+        for _ in range(num_updates):
+            pool.push_to(replay_buffer)
+            train(...)
+            pool.broadcast(dqn_model)
+        print(pool.format_report())
+"""
+import random
+import time
+from multiprocessing import shared_memory
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from game.api import BlackjackWrapper
+from game.models.features import FeatureBuffer
+from game.models.model import GameState
+from game.vector_api import make_table_rngs
+from training.agent import BlackjackDQN, BlackjackPolicyModel
+
+# header of every ring, one int64 each
+WRITE_COUNT, READ_COUNT, HANDS_PLAYED = range(3)
+HEADER_SIZE = 3
+
+
+class Transitions(NamedTuple):
+    """
+    Transitions copied out of the rings, one row each.
+    For the DQN action is the index in the model output,
+    for the policy model it is 0 for a bet and 1 for a card action.
+    action_value is the bet percent, or 1.0 / 0.0 for taking a card or not.
+    """
+    state: np.ndarray
+    action: np.ndarray
+    action_value: np.ndarray
+    next_state: np.ndarray
+    reward: np.ndarray
+    mask: np.ndarray
+    done: np.ndarray
+    # unique per worker and round, to group transitions into episodes
+    episode_id: np.ndarray
+    worker_id: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.reward)
+
+
+RING_FIELDS = ("state", "action", "action_value", "next_state", "reward", "mask", "done", "episode_id")
+
+
+def _ring_fields(state_size: int, mask_size: int) -> List[Tuple[str, np.dtype, Tuple[int, ...]]]:
+    return [
+        ("state", np.float32, (state_size,)),
+        ("action", np.int64, ()),
+        ("action_value", np.float32, ()),
+        ("next_state", np.float32, (state_size,)),
+        ("reward", np.float32, ()),
+        ("mask", np.float32, (mask_size,)),
+        ("done", np.bool_, ()),
+        ("episode_id", np.int64, ()),
+    ]
+
+
+class SharedTransitionRing:
+    """
+    Single producer, single consumer ring of transitions in shared memory.
+    The producer only advances WRITE_COUNT after the rows are written and never gets more than
+    capacity rows ahead of READ_COUNT, so the consumer never sees torn rows.
+    """
+
+    def __init__(self, capacity: int, state_size: int, mask_size: int, name: Optional[str] = None):
+        self.capacity = capacity
+        self.state_size = state_size
+        self.mask_size = mask_size
+        fields = _ring_fields(state_size, mask_size)
+        sizes = [np.dtype(dtype).itemsize * capacity * int(np.prod(shape)) for _, dtype, shape in fields]
+        # keep every field 8 byte aligned
+        sizes = [-(-size // 8) * 8 for size in sizes]
+        total = HEADER_SIZE * 8 + sum(sizes)
+
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=total)
+        self.header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=self.shm.buf)
+        if self.owner:
+            self.header[:] = 0
+        self.arrays: Dict[str, np.ndarray] = {}
+        offset = HEADER_SIZE * 8
+        for (field, dtype, shape), size in zip(fields, sizes):
+            self.arrays[field] = np.ndarray((capacity, *shape), dtype=dtype, buffer=self.shm.buf, offset=offset)
+            offset += size
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def free_space(self) -> int:
+        return self.capacity - int(self.header[WRITE_COUNT] - self.header[READ_COUNT])
+
+    def write(self, **rows: np.ndarray) -> None:
+        """
+        Producer side, the caller makes sure free_space() is large enough
+        """
+        num = len(rows["reward"])
+        write_count = int(self.header[WRITE_COUNT])
+        idx = (write_count + np.arange(num)) % self.capacity
+        for field, values in rows.items():
+            self.arrays[field][idx] = values
+        self.header[WRITE_COUNT] = write_count + num
+
+    def read(self) -> Dict[str, np.ndarray]:
+        """
+        Consumer side, copies out every row written since the last read
+        """
+        read_count = int(self.header[READ_COUNT])
+        write_count = int(self.header[WRITE_COUNT])
+        idx = (read_count + np.arange(write_count - read_count)) % self.capacity
+        rows = {field: array[idx] for field, array in self.arrays.items()}
+        self.header[READ_COUNT] = write_count
+        return rows
+
+    def close(self) -> None:
+        # views have to go before the buffer can be released
+        self.header = None
+        self.arrays = {}
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class RolloutConfig(NamedTuple):
+    agent: str  # "dqn" or "policy"
+    model_kwargs: dict
+    tables_per_worker: int
+    initial_cash: int
+    deck_nums: int
+    min_bet: int
+    max_steps: int
+    add_steps: bool
+    add_card_counting: bool
+    allow_explore: bool
+    sync_interval: int
+    torch_threads: int
+
+
+def _build_model(config: RolloutConfig) -> torch.nn.Module:
+    if config.agent == "dqn":
+        return BlackjackDQN(**config.model_kwargs)
+    return BlackjackPolicyModel(device="cpu", **config.model_kwargs)
+
+
+def _model_kwargs(model: torch.nn.Module) -> Tuple[str, dict]:
+    in_features = model.init_layers[0].in_features
+    if isinstance(model, BlackjackDQN):
+        return "dqn", dict(
+            in_features=in_features,
+            bet_choices=list(model.bet_choices),
+            card_choices=list(model.card_choices),
+            epsilon=model.epsilon,
+            min_epsilon=model.min_epsilon,
+        )
+    if isinstance(model, BlackjackPolicyModel):
+        return "policy", dict(in_features=in_features)
+    raise TypeError(f"unsupported model type {type(model).__name__}")
+
+
+def _worker_loop(
+    worker_id: int,
+    config: RolloutConfig,
+    seed_seq: np.random.SeedSequence,
+    shared_model: torch.nn.Module,
+    weights_lock,
+    weights_version,
+    total_steps,
+    ring_name: str,
+    ring_capacity: int,
+    stop_event,
+) -> None:
+    torch.set_num_threads(config.torch_threads)
+    table_seq, torch_seq, python_seq = seed_seq.spawn(3)
+    generator = torch.Generator().manual_seed(int(torch_seq.generate_state(1)[0]))
+    random.seed(int(python_seq.generate_state(1)[0]))
+
+    model = _build_model(config)
+    with weights_lock:
+        model.load_state_dict(shared_model.state_dict())
+        local_version = weights_version.value
+    model.eval()
+
+    is_dqn = config.agent == "dqn"
+    num_tables = config.tables_per_worker
+    wrappers = [
+        BlackjackWrapper(config.initial_cash, config.deck_nums, config.min_bet, rng=rng)
+        for rng in make_table_rngs(int(table_seq.generate_state(1)[0]), num_tables)
+    ]
+    features = FeatureBuffer(num_tables, add_steps=config.add_steps, include_discarded=config.add_card_counting)
+    next_features = FeatureBuffer(num_tables, add_steps=config.add_steps, include_discarded=config.add_card_counting)
+    mask_size = len(config.model_kwargs["bet_choices"]) + len(config.model_kwargs["card_choices"]) if is_dqn else 2
+    policy_masks = np.eye(2, dtype=np.float32)
+
+    ring = SharedTransitionRing(ring_capacity, features.state_size, mask_size, name=ring_name)
+    round_num = 0
+    try:
+        while not stop_event.is_set():
+            if round_num % config.sync_interval == 0 and weights_version.value != local_version:
+                with weights_lock:
+                    model.load_state_dict(shared_model.state_dict())
+                    local_version = weights_version.value
+
+            wrappers = [wrapper.reset() for wrapper in wrappers]
+            states = [wrapper.get_state() for wrapper in wrappers]
+            active = list(range(num_tables))
+            num_steps = total_steps.value
+            round_steps = 0
+            for i_step in range(config.max_steps):
+                step_num = i_step / config.max_steps if config.add_steps else None
+                next_step_num = (i_step + 1) / config.max_steps if config.add_steps else None
+                batch = features.write_batch([states[i] for i in active], step_num=step_num)
+
+                with torch.no_grad():
+                    if is_dqn and i_step == 0:
+                        chosen = model.get_bet_percents(batch, config.allow_explore, num_steps, generator)
+                        actions, action_values = chosen.indices.numpy(), chosen.actions.numpy()
+                        masks = chosen.masks.numpy()
+                    elif is_dqn:
+                        chosen = model.get_card_actions(batch, config.allow_explore, num_steps, generator)
+                        actions, action_values = chosen.indices.numpy(), chosen.actions.numpy()
+                        masks = chosen.masks.numpy()
+                    elif i_step == 0:
+                        action_values = model.get_bet_percents(batch).squeeze(-1).numpy()
+                        actions = np.zeros(len(active), dtype=np.int64)
+                        masks = policy_masks[actions]
+                    else:
+                        action_values = model.get_card_actions(batch, generator)[0].numpy()
+                        actions = np.ones(len(active), dtype=np.int64)
+                        masks = policy_masks[actions]
+
+                rewards = np.zeros(len(active), dtype=np.float32)
+                dones = np.zeros(len(active), dtype=bool)
+                for row, table in enumerate(active):
+                    if i_step == 0:
+                        outcome = wrappers[table].bet_step(float(action_values[row]))
+                    else:
+                        outcome = wrappers[table].card_step(take_card=bool(action_values[row]))
+                    states[table] = outcome.new_state
+                    rewards[row] = outcome.reward
+                    dones[row] = outcome.terminated
+                next_batch = next_features.write_batch([states[i] for i in active], step_num=next_step_num)
+
+                while ring.free_space() < len(active):
+                    if stop_event.is_set():
+                        return
+                    time.sleep(0.001)
+                ring.write(
+                    state=batch,
+                    action=actions,
+                    action_value=action_values.astype(np.float32),
+                    next_state=next_batch,
+                    reward=rewards,
+                    mask=masks,
+                    done=dones,
+                    episode_id=round_num * num_tables + np.asarray(active),
+                )
+                num_steps += len(active)
+                round_steps += len(active)
+                active = [table for table, done in zip(active, dones) if not done]
+                if not active:
+                    break
+
+            with total_steps.get_lock():
+                total_steps.value += round_steps
+            ring.header[HANDS_PLAYED] += num_tables
+            round_num += 1
+    finally:
+        ring.close()
+
+
+class RolloutPool:
+    """
+    num_workers processes collecting transitions with a CPU copy of model.
+    Workers reload the broadcast weights at most every sync_interval rounds,
+    a round being one hand on each of their tables_per_worker tables.
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        num_workers: int,
+        tables_per_worker: int = 16,
+        initial_cash: int = 1000,
+        deck_nums: int = 8,
+        min_bet: int = 10,
+        max_steps: int = 10,
+        add_steps: bool = True,
+        add_card_counting: bool = True,
+        allow_explore: bool = True,
+        sync_interval: int = 10,
+        ring_capacity: int = 1 << 16,
+        torch_threads: int = 1,
+        seed: Optional[int] = None,
+        start_method: str = "spawn",
+    ):
+        if ring_capacity < tables_per_worker:
+            # a step of every table is written at once, a smaller ring could never fit it
+            raise ValueError(
+                f"ring_capacity ({ring_capacity}) has to be at least tables_per_worker ({tables_per_worker})"
+            )
+        agent, model_kwargs = _model_kwargs(model)
+        self.config = RolloutConfig(
+            agent=agent,
+            model_kwargs=model_kwargs,
+            tables_per_worker=tables_per_worker,
+            initial_cash=initial_cash,
+            deck_nums=deck_nums,
+            min_bet=min_bet,
+            max_steps=max_steps,
+            add_steps=add_steps,
+            add_card_counting=add_card_counting,
+            allow_explore=allow_explore,
+            sync_interval=sync_interval,
+            torch_threads=torch_threads,
+        )
+        self.num_workers = num_workers
+        self.ring_capacity = ring_capacity
+        self.seed_seqs = np.random.SeedSequence(seed).spawn(num_workers)
+        self.ctx = mp.get_context(start_method)
+
+        self.shared_model = _build_model(self.config)
+        self.shared_model.load_state_dict(_cpu_state_dict(model))
+        self.shared_model.share_memory()
+        self.weights_lock = self.ctx.Lock()
+        self.weights_version = self.ctx.Value("q", 0, lock=False)
+        self.total_steps = self.ctx.Value("q", 0)
+        self.stop_event = self.ctx.Event()
+
+        state_size = GameState.get_state_size(add_steps=add_steps)
+        mask_size = len(model_kwargs["bet_choices"]) + len(model_kwargs["card_choices"]) if agent == "dqn" else 2
+        self.rings = [
+            SharedTransitionRing(ring_capacity, state_size, mask_size) for _ in range(num_workers)
+        ]
+        self.workers = []
+        self.transitions_collected = 0
+        self.start_time: Optional[float] = None
+
+    def start(self) -> "RolloutPool":
+        for worker_id, (ring, seed_seq) in enumerate(zip(self.rings, self.seed_seqs)):
+            worker = self.ctx.Process(
+                target=_worker_loop,
+                args=(
+                    worker_id,
+                    self.config,
+                    seed_seq,
+                    self.shared_model,
+                    self.weights_lock,
+                    self.weights_version,
+                    self.total_steps,
+                    ring.name,
+                    self.ring_capacity,
+                    self.stop_event,
+                ),
+                daemon=True,
+            )
+            worker.start()
+            self.workers.append(worker)
+        self.start_time = time.perf_counter()
+        return self
+
+    def broadcast(self, model: torch.nn.Module) -> None:
+        """
+        Publishes the weights of model, on any device, to every worker
+        """
+        state_dict = _cpu_state_dict(model)
+        with self.weights_lock:
+            self.shared_model.load_state_dict(state_dict)
+            self.weights_version.value += 1
+
+    def collect(self, min_transitions: int = 0, timeout: Optional[float] = None) -> Transitions:
+        """
+        Copies out every transition written so far, waiting until at least min_transitions are available
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        parts: List[Dict[str, np.ndarray]] = []
+        worker_ids = []
+        num = 0
+        while True:
+            for worker_id, ring in enumerate(self.rings):
+                rows = ring.read()
+                if len(rows["reward"]):
+                    parts.append(rows)
+                    worker_ids.append(np.full(len(rows["reward"]), worker_id))
+                    num += len(rows["reward"])
+            if num >= min_transitions or (deadline is not None and time.perf_counter() > deadline):
+                break
+            self._check_workers()
+            time.sleep(0.001)
+
+        self.transitions_collected += num
+        if not parts:
+            return Transitions(
+                **{field: self.rings[0].arrays[field][:0].copy() for field in RING_FIELDS},
+                worker_id=np.zeros(0, dtype=np.int64),
+            )
+        return Transitions(
+            **{field: np.concatenate([part[field] for part in parts]) for field in RING_FIELDS},
+            worker_id=np.concatenate(worker_ids),
+        )
+
+    def push_to(self, replay_buffer, min_transitions: int = 0) -> int:
+        """
+        Collects transitions into a training.replay_buffer.ReplayBuffer, returns how many were pushed
+        """
+        transitions = self.collect(min_transitions)
+        if len(transitions):
+            replay_buffer.push_batch(
+                transitions.state,
+                transitions.action,
+                transitions.next_state,
+                transitions.reward,
+                transitions.mask,
+                transitions.done,
+            )
+        return len(transitions)
+
+    def _check_workers(self) -> None:
+        for worker in self.workers:
+            if worker.exitcode not in (None, 0):
+                raise RuntimeError(f"rollout worker exited with code {worker.exitcode}")
+
+    def report(self) -> Dict[str, float]:
+        elapsed = time.perf_counter() - self.start_time if self.start_time else 0.0
+        hands = [int(ring.header[HANDS_PLAYED]) for ring in self.rings]
+        return {
+            "elapsed_seconds": elapsed,
+            "hands": sum(hands),
+            "hands_per_second": sum(hands) / elapsed if elapsed else 0.0,
+            "min_worker_hands_per_second": min(hands) / elapsed if elapsed else 0.0,
+            "transitions_collected": self.transitions_collected,
+            "transitions_per_second": self.transitions_collected / elapsed if elapsed else 0.0,
+        }
+
+    def format_report(self) -> str:
+        report = self.report()
+        return (
+            f"{self.num_workers} workers x {self.config.tables_per_worker} tables"
+            f"\t\tHands/s: {report['hands_per_second']:.0f}"
+            f"\t\tSlowest worker hands/s: {report['min_worker_hands_per_second']:.0f}"
+            f"\t\tTransitions/s: {report['transitions_per_second']:.0f}"
+        )
+
+    def close(self) -> None:
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+        for ring in self.rings:
+            ring.close()
+        self.rings = []
+
+    def __enter__(self) -> "RolloutPool":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def _cpu_state_dict(model: torch.nn.Module) -> dict:
+    return {key: value.detach().cpu() for key, value in model.state_dict().items()}
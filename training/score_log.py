@@ -0,0 +1,265 @@
+"""
+Columnar training score log, written episode by episode during training
+
+A log is a directory with two raw little endian files:
+- rewards: float64, the rewards of every step of every episode, back to back
+- offsets: int64, the end of each episode in rewards, episode i is rewards[offsets[i - 1]:offsets[i]]
+The rewards of an episode are always flushed before its offset, so after a crash the log still holds
+every episode whose offset was written, and the writer drops any rewards past the last offset on reopen.
+
+ScoreLog memory maps both files and computes statistics chunk by chunk, so a log never has to fit in memory
+and can be read while training is still appending to it.
+
+    python -m training.score_log import models/*_training_scores.txt
+    python -m training.score_log summary models/policy_steps_training_scores.scorelog --window 1000
+"""
+import argparse
+import os
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+SUFFIX = ".scorelog"
+REWARDS_FILE = "rewards"
+OFFSETS_FILE = "offsets"
+REWARD_DTYPE = np.dtype("<f8")
+OFFSET_DTYPE = np.dtype("<i8")
+DEFAULT_CHUNK_EPISODES = 1 << 16
+
+
+class ScoreLogWriter:
+    """
+    Appends episodes to a new or existing log, buffering flush_every episodes in memory.
+
+        with ScoreLogWriter(path) as score_log:
+            for i_episode in range(num_eps):
+                ...
+                score_log.append(rewards)
+    """
+
+    def __init__(self, path, flush_every: int = 100):
+        self.path = Path(path)
+        self.flush_every = flush_every
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.rewards_file = open(self.path / REWARDS_FILE, "ab")
+        self.offsets_file = open(self.path / OFFSETS_FILE, "ab")
+
+        self._pending_rewards: List[Sequence[float]] = []
+        self._pending_offsets: List[int] = []
+        # drop a partially written offset, then rewards of episodes whose offset never made it to disk
+        self.truncate(self.offsets_file.tell() // OFFSET_DTYPE.itemsize)
+
+    def __len__(self) -> int:
+        return self.num_episodes + len(self._pending_offsets)
+
+    def truncate(self, num_episodes: int) -> None:
+        """
+        Drops every episode after the first num_episodes, e.g. when training resumes from a snapshot
+        """
+        self.flush()
+        num_episodes = min(num_episodes, self.offsets_file.tell() // OFFSET_DTYPE.itemsize)
+        self.offsets_file.truncate(num_episodes * OFFSET_DTYPE.itemsize)
+        self.offsets_file.seek(0, os.SEEK_END)
+        self.num_rewards = 0
+        if num_episodes:
+            last_offset = (num_episodes - 1) * OFFSET_DTYPE.itemsize
+            self.num_rewards = int(np.fromfile(self.path / OFFSETS_FILE, dtype=OFFSET_DTYPE, offset=last_offset)[0])
+        self.rewards_file.truncate(self.num_rewards * REWARD_DTYPE.itemsize)
+        self.rewards_file.seek(0, os.SEEK_END)
+        self.num_episodes = num_episodes
+
+    def append(self, rewards: Sequence[float]) -> None:
+        """
+        Adds one episode, given as the reward of each of its steps
+        """
+        end = (self._pending_offsets[-1] if self._pending_offsets else self.num_rewards) + len(rewards)
+        self._pending_rewards.append(rewards)
+        self._pending_offsets.append(end)
+        if len(self._pending_offsets) >= self.flush_every:
+            self.flush()
+
+    def extend(self, episodes: Sequence[Sequence[float]]) -> None:
+        for rewards in episodes:
+            self.append(rewards)
+
+    def append_padded(self, rewards: np.ndarray, lengths: np.ndarray) -> None:
+        """
+        Adds a batch of episodes given as a zero padded (episodes, steps) array, episode i is rewards[i, :lengths[i]]
+        """
+        lengths = np.asarray(lengths)
+        start = self._pending_offsets[-1] if self._pending_offsets else self.num_rewards
+        # boolean indexing keeps row major order, i.e. episode after episode
+        self._pending_rewards.append(rewards[np.arange(rewards.shape[1]) < lengths[:, None]])
+        self._pending_offsets.extend((start + np.cumsum(lengths)).tolist())
+        if len(self._pending_offsets) >= self.flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._pending_offsets:
+            return
+        rewards = [np.asarray(rewards, dtype=REWARD_DTYPE) for rewards in self._pending_rewards]
+        self.rewards_file.write(np.concatenate(rewards).tobytes())
+        self.rewards_file.flush()
+        os.fsync(self.rewards_file.fileno())
+        # only now are the episodes visible to readers
+        self.offsets_file.write(np.array(self._pending_offsets, dtype=OFFSET_DTYPE).tobytes())
+        self.offsets_file.flush()
+
+        self.num_episodes += len(self._pending_offsets)
+        self.num_rewards = self._pending_offsets[-1]
+        self._pending_rewards = []
+        self._pending_offsets = []
+
+    def close(self) -> None:
+        self.flush()
+        self.rewards_file.close()
+        self.offsets_file.close()
+
+    def __enter__(self) -> "ScoreLogWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class RollingStats(NamedTuple):
+    # number of episodes up to and including the end of each window
+    episode: np.ndarray
+    mean: np.ndarray
+    # shape (number of windows, number of percentiles)
+    percentiles: np.ndarray
+
+
+class ScoreLog:
+    """
+    Read only view of a log, call refresh() to see episodes appended since it was opened
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.refresh()
+
+    def refresh(self) -> "ScoreLog":
+        self.offsets = self._map(OFFSETS_FILE, OFFSET_DTYPE)
+        self.rewards = self._map(REWARDS_FILE, REWARD_DTYPE)
+        return self
+
+    def _map(self, name: str, dtype: np.dtype) -> np.ndarray:
+        path = self.path / name
+        size = path.stat().st_size // dtype.itemsize
+        if size == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=(size,))
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def episode(self, idx: int) -> np.ndarray:
+        start = self.offsets[idx - 1] if idx > 0 else 0
+        return np.asarray(self.rewards[start : self.offsets[idx]])
+
+    def iter_chunks(
+        self, chunk_episodes: int = DEFAULT_CHUNK_EPISODES, start: int = 0, stop: Optional[int] = None
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        (episode lengths, rewards) of chunk_episodes episodes at a time
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        for chunk_start in range(start, stop, chunk_episodes):
+            chunk_stop = min(chunk_start + chunk_episodes, stop)
+            first = int(self.offsets[chunk_start - 1]) if chunk_start > 0 else 0
+            ends = np.asarray(self.offsets[chunk_start:chunk_stop])
+            lengths = np.diff(ends, prepend=first)
+            yield lengths, np.asarray(self.rewards[first : int(ends[-1])])
+
+    def iter_totals(self, chunk_episodes: int = DEFAULT_CHUNK_EPISODES, start: int = 0, stop: Optional[int] = None):
+        """
+        Total reward of each episode, chunk_episodes at a time
+        """
+        for lengths, rewards in self.iter_chunks(chunk_episodes, start, stop):
+            # the padding zero keeps the starts of trailing empty episodes in range,
+            # reduceat gives a single element for empty episodes so they are set to 0 afterwards
+            starts = np.cumsum(lengths) - lengths
+            totals = np.add.reduceat(np.append(rewards, 0.0), starts)
+            totals[lengths == 0] = 0
+            yield totals
+
+    def episode_totals(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        parts = list(self.iter_totals(start=start, stop=stop))
+        return np.concatenate(parts) if parts else np.zeros(0)
+
+    def rolling(
+        self,
+        window: int,
+        step: Optional[int] = None,
+        percentiles: Sequence[float] = (5, 50, 95),
+        chunk_episodes: int = DEFAULT_CHUNK_EPISODES,
+    ) -> RollingStats:
+        """
+        Mean and percentiles of episode totals over the last window episodes, every step episodes
+        (every window episodes by default). Only one chunk and one window are in memory at a time.
+        """
+        step = step or window
+        episodes, means, values = [], [], []
+        tail = np.zeros(0)
+        seen = 0
+        for totals in self.iter_totals(chunk_episodes):
+            buffer = np.concatenate((tail, totals))
+            seen += len(totals)
+            first = seen - len(buffer)
+            # window ends, as episode counts, that fall in this chunk
+            first_end = window + max(0, -(-(seen - len(totals) + 1 - window) // step)) * step
+            ends = np.arange(first_end, seen + 1, step)
+            if len(ends):
+                starts = ends - window - first
+                windows = buffer[starts[:, None] + np.arange(window)]
+                episodes.append(ends)
+                means.append(windows.mean(axis=1))
+                values.append(np.percentile(windows, percentiles, axis=1).T)
+            tail = buffer[-(window - 1) :] if window > 1 else buffer[:0]
+        if not episodes:
+            return RollingStats(np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros((0, len(percentiles))))
+        return RollingStats(np.concatenate(episodes), np.concatenate(means), np.concatenate(values))
+
+
+def import_text_log(src, dst=None, flush_every: int = 10000) -> Path:
+    """
+    Converts a *_training_scores.txt file, one episode per line as comma separated rewards
+    """
+    src = Path(src)
+    dst = Path(dst) if dst is not None else src.with_suffix(SUFFIX)
+    if dst.exists():
+        raise ValueError(f"{dst} already exists")
+    with open(src) as f, ScoreLogWriter(dst, flush_every=flush_every) as writer:
+        for line in f:
+            line = line.strip()
+            writer.append([float(x) for x in line.split(",")] if line else [])
+    return dst
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="convert text score logs")
+    import_parser.add_argument("paths", nargs="+")
+    summary_parser = commands.add_parser("summary", help="rolling statistics of a log")
+    summary_parser.add_argument("path")
+    summary_parser.add_argument("--window", type=int, default=1000)
+    summary_parser.add_argument("--step", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == "import":
+        for path in args.paths:
+            print(f"{path} -> {import_text_log(path)}")
+    else:
+        score_log = ScoreLog(args.path)
+        stats = score_log.rolling(args.window, args.step)
+        print(f"{len(score_log)} episodes, {len(score_log.rewards)} steps")
+        print(f"{'episode':>10}{'mean':>10}{'p5':>10}{'p50':>10}{'p95':>10}")
+        for episode, mean, (p5, p50, p95) in zip(stats.episode, stats.mean, stats.percentiles):
+            print(f"{episode:>10}{mean:>10.3f}{p5:>10.3f}{p50:>10.3f}{p95:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+"""
+Asyncio inference server that micro-batches decisions of many concurrent game sessions
+
+Sessions await get_bet_percent / get_card_action with their GameState. Requests are queued and a single
+batching task takes up to max_batch_size of them, waiting at most max_wait_ms after the first one for more
+to arrive, then runs one forward pass of the shared layers for the whole batch and the bet or card head
+for the rows that need it. The forward pass runs in a worker thread, so new requests keep being queued
+while a batch is computed.
+
+Decisions are greedy: the best DQN action, or for the policy model its bet percent and taking a card
+when its probability is above 0.5 (sampled instead with sample_policy=True).
+
+Everything runs in process, the load generator plays BlackjackWrapper sessions against the server:
+
+    python -m training.serving models/policy_steps.bjm --sessions 256 --rounds 20 --max-batch-size 64
+"""
+import argparse
+import asyncio
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+import torch
+
+from game.api import BlackjackWrapper
+from game.instrumentation import StageStats
+from game.models.features import FeatureBuffer
+from game.models.model import GameState
+from training import registry
+from training.agent import BlackjackDQN
+
+BET, CARD = "bet", "card"
+
+
+class _Request:
+    __slots__ = ("kind", "state", "step_num", "future", "queued_ns")
+
+    def __init__(self, kind: str, state: GameState, step_num: Optional[float], future: asyncio.Future):
+        self.kind = kind
+        self.state = state
+        self.step_num = step_num
+        self.future = future
+        self.queued_ns = time.perf_counter_ns()
+
+
+def _as_state(state) -> GameState:
+    """
+    Accepts a GameState, a GameStateSchema or its dict, e.g. decoded from json
+    """
+    if isinstance(state, GameState):
+        return state
+    from game.models.schema import GameStateSchema
+
+    if isinstance(state, dict):
+        state = GameStateSchema(**state)
+    return state.to_state()
+
+
+class InferenceServer:
+    """
+    Batches the decisions of a BlackjackDQN or BlackjackPolicyModel, see the module docstring.
+
+        async with InferenceServer(model, max_batch_size=64, max_wait_ms=2) as server:
+            bet_percent = await server.get_bet_percent(state, step_num=0.0)
+            take_card = await server.get_card_action(state, step_num=0.1)
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        max_batch_size: int = 64,
+        max_wait_ms: float = 2.0,
+        add_steps: Optional[bool] = None,
+        include_discarded: bool = True,
+        max_queue_size: int = 0,
+        sample_policy: bool = False,
+        seed: Optional[int] = None,
+    ):
+        """
+        add_steps defaults to what the input size of model expects.
+        With max_queue_size > 0 callers wait for room in the queue once it holds that many requests.
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size has to be >= 1")
+        if max_wait_ms < 0:
+            raise ValueError("max_wait_ms has to be >= 0")
+        self.model = model.eval()
+        self.is_dqn = isinstance(model, BlackjackDQN)
+        self.device = next(model.parameters()).device
+        if add_steps is None:
+            add_steps = model.init_layers[0].in_features == GameState.get_state_size(add_steps=True)
+        self.add_steps = add_steps
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1e3
+        self.max_queue_size = max_queue_size
+        self.sample_policy = sample_policy
+        self.rng = np.random.default_rng(seed)
+
+        self.features = FeatureBuffer(
+            max_batch_size, add_steps=add_steps, include_discarded=include_discarded, torch_tensor=True
+        )
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # one thread, so that batches, and the feature buffer they share, never overlap
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self.reset_metrics()
+
+    async def start(self) -> "InferenceServer":
+        self._queue = asyncio.Queue(self.max_queue_size)
+        self._task = asyncio.get_running_loop().create_task(self._batch_loop())
+        return self
+
+    async def stop(self) -> None:
+        """
+        Answers every queued request, then stops the batching task
+        """
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._executor.shutdown()
+
+    async def __aenter__(self) -> "InferenceServer":
+        return await self.start()
+
+    async def __aexit__(self, *exc) -> None:
+        await self.stop()
+
+    async def _submit(self, kind: str, state, step_num: Optional[float]):
+        if self._task is None:
+            raise RuntimeError("the server is not running, call start() first")
+        if self.add_steps and step_num is None:
+            raise ValueError("step_num is required, the model was trained with add_steps=True")
+        future = asyncio.get_running_loop().create_future()
+        request = _Request(kind, _as_state(state), step_num if self.add_steps else None, future)
+        await self._queue.put(request)
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return await request.future
+
+    async def get_bet_percent(self, state, step_num: Optional[float] = None) -> float:
+        return await self._submit(BET, state, step_num)
+
+    async def get_card_action(self, state, step_num: Optional[float] = None) -> bool:
+        return await self._submit(CARD, state, step_num)
+
+    async def _next_batch(self) -> List[_Request]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _batch_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            self.queue_depth.add(self._queue.qsize())
+            start_ns = time.perf_counter_ns()
+            for request in batch:
+                self.queue_wait.add(start_ns - request.queued_ns)
+            try:
+                actions = await loop.run_in_executor(self._executor, self._decide, batch)
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+            else:
+                done_ns = time.perf_counter_ns()
+                self.forward.add(done_ns - start_ns)
+                for request, action in zip(batch, actions):
+                    # the caller may have been cancelled in the meantime
+                    if not request.future.done():
+                        request.future.set_result(action)
+                    self.latency.add(done_ns - request.queued_ns)
+            self.batch_sizes[len(batch)] += 1
+            self.requests += len(batch)
+            self.batches += 1
+            for _ in batch:
+                self._queue.task_done()
+
+    @torch.no_grad()
+    def _decide(self, batch: List[_Request]) -> list:
+        """
+        One pass of the shared layers over the batch, then each head over its own rows
+        """
+        step_num = np.array([request.step_num for request in batch]) if self.add_steps else None
+        self.features.write_batch([request.state for request in batch], step_num=step_num)
+        shared = self.model.init_layers(self.features.tensor[: len(batch)].to(self.device))
+        bet_rows = [row for row, request in enumerate(batch) if request.kind == BET]
+        card_rows = [row for row, request in enumerate(batch) if request.kind == CARD]
+        actions: list = [None] * len(batch)
+
+        if bet_rows:
+            bet_outputs = self.model.bet_layers(shared[bet_rows]).cpu()
+            if self.is_dqn:
+                bets = [self.model.bet_choices[idx] for idx in bet_outputs.argmax(dim=-1).tolist()]
+            else:
+                bets = bet_outputs.squeeze(-1).tolist()
+            for row, bet in zip(bet_rows, bets):
+                actions[row] = bet
+        if card_rows:
+            card_outputs = self.model.card_layers(shared[card_rows]).cpu()
+            if self.is_dqn:
+                takes = [self.model.card_choices[idx] for idx in card_outputs.argmax(dim=-1).tolist()]
+            else:
+                probs = card_outputs.squeeze(-1).numpy()
+                draws = self.rng.random(len(probs)) if self.sample_policy else 0.5
+                takes = (probs > draws).tolist()
+            for row, take in zip(card_rows, takes):
+                actions[row] = bool(take)
+        return actions
+
+    def reset_metrics(self) -> None:
+        self.requests = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+        self.batch_sizes: Counter = Counter()
+        # requests left in the queue whenever a batch is taken
+        self.queue_depth = StageStats()
+        # queued until the batch started, forward pass of the batch, queued until answered
+        self.queue_wait = StageStats()
+        self.forward = StageStats()
+        self.latency = StageStats()
+
+    def metrics(self) -> dict:
+        def summary(stats: StageStats) -> dict:
+            return {key: value for key, value in stats.to_dict().items() if key != "buckets"}
+
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue_depth": self.max_queue_depth,
+            "queue_depth_at_batch": summary(self.queue_depth),
+            "queue_wait": summary(self.queue_wait),
+            "forward": summary(self.forward),
+            "latency": summary(self.latency),
+        }
+
+
+async def _session(
+    server: InferenceServer,
+    num_rounds: int,
+    max_steps: int,
+    initial_cash: int,
+    deck_nums: int,
+    seed: int,
+) -> int:
+    """
+    One client playing num_rounds rounds through the server, returns the number of decisions it asked for
+    """
+    wrapper = BlackjackWrapper(initial_cash, deck_nums, rng=np.random.default_rng(seed))
+    decisions = 0
+    for _ in range(num_rounds):
+        wrapper = wrapper.reset()
+        state = wrapper.get_state()
+        for i_step in range(max_steps):
+            step_num = i_step / max_steps
+            if i_step == 0:
+                outcome = wrapper.bet_step(await server.get_bet_percent(state, step_num))
+            else:
+                outcome = wrapper.card_step(await server.get_card_action(state, step_num))
+            decisions += 1
+            state = outcome.new_state
+            if outcome.terminated:
+                break
+    return decisions
+
+
+async def load_test(
+    server: InferenceServer,
+    num_sessions: int = 256,
+    num_rounds: int = 20,
+    max_steps: int = 10,
+    initial_cash: int = 10000,
+    deck_nums: int = 8,
+    seed: int = 0,
+) -> dict:
+    """
+    Plays num_sessions concurrent sessions against a started server, returns its metrics and the throughput
+    """
+    server.reset_metrics()
+    start = time.perf_counter()
+    decisions = await asyncio.gather(
+        *(
+            _session(server, num_rounds, max_steps, initial_cash, deck_nums, seed + session)
+            for session in range(num_sessions)
+        )
+    )
+    seconds = time.perf_counter() - start
+    return dict(
+        server.metrics(),
+        sessions=num_sessions,
+        decisions=sum(decisions),
+        seconds=seconds,
+        decisions_per_second=sum(decisions) / seconds,
+    )
+
+
+def format_report(report: dict) -> str:
+    latency, forward = report["latency"], report["forward"]
+    return (
+        f"{report['decisions']} decisions from {report['sessions']} sessions in {report['seconds']:.2f}s"
+        f" ({report['decisions_per_second']:.0f}/s)\n"
+        f"batches: {report['batches']}, mean size {report['mean_batch_size']:.1f},"
+        f" max queue depth {report['max_queue_depth']}\n"
+        f"latency us: p50 {latency['p50_ns'] / 1e3:.0f}, p90 {latency['p90_ns'] / 1e3:.0f},"
+        f" p99 {latency['p99_ns'] / 1e3:.0f}\n"
+        f"forward us: p50 {forward['p50_ns'] / 1e3:.0f}, p99 {forward['p99_ns'] / 1e3:.0f}"
+    )
+
+
+async def _serve_and_load(model, args, max_batch_size: int) -> dict:
+    server = InferenceServer(
+        model,
+        max_batch_size=max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        include_discarded=args.include_discarded,
+        seed=args.seed,
+    )
+    async with server:
+        return await load_test(
+            server, num_sessions=args.sessions, num_rounds=args.rounds, deck_nums=args.deck_nums, seed=args.seed
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("checkpoint", help="portable checkpoint, see training.registry")
+    parser.add_argument("--sessions", type=int, default=256)
+    parser.add_argument("--rounds", type=int, default=20, help="rounds played by every session")
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-wait-ms", type=float, default=2.0)
+    parser.add_argument("--deck-nums", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compare", action="store_true", help="also run unbatched, with a max batch size of 1")
+    args = parser.parse_args()
+
+    args.include_discarded = registry.read_header(args.checkpoint)["add_card_counting"]
+    model = registry.load_model(args.checkpoint)
+    batch_sizes = [args.max_batch_size] + ([1] if args.compare else [])
+    for max_batch_size in batch_sizes:
+        report = asyncio.run(_serve_and_load(model, args, max_batch_size))
+        print(f"max batch size {max_batch_size}\n{format_report(report)}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""
+Periodic snapshots of a training run, to resume it exactly where it stopped
+
+A snapshot holds the state dicts of the models, optimizers and schedulers, the python, numpy and torch
+random states, the replay buffer and any other picklable object of the training loop, such as the
+BlackjackWrapper with its shoe and the score lists. Restoring it and running the same loop gives the
+same results as never stopping.
+
+The replay buffer is written incrementally: every snapshot only writes the transitions pushed since
+the previous one as a new segment, and segments whose transitions have all been overwritten are deleted.
+Snapshots are written by a background thread: save() only copies what is needed in memory and returns,
+it waits only if the previous snapshot is still being written.
+
+Layout of a snapshot directory:
+    LATEST                        name of the newest complete snapshot
+    snapshot_<step>/manifest.json replay buffer bookkeeping and the segments the snapshot needs
+    snapshot_<step>/state.pt      state dicts and random states
+    snapshot_<step>/objects.pkl   pickled training loop objects
+    snapshot_<step>/priorities.npy all replay priorities, only once priorities were updated after push
+    replay/segment_<start>_<stop>.npz  transitions start to stop - 1, counted from the first push
+
+    snapshots = Snapshotter("runs/dqn")
+    latest = snapshots.latest()
+    if latest is not None:
+        objects = snapshots.restore(latest, stateful, replay_buffer)
+    ...
+    snapshots.save(i_episode, stateful, replay_buffer, objects)
+"""
+import json
+import os
+import pickle
+import random
+import shutil
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+from training.replay_buffer import ReplayBuffer
+
+LATEST_FILE = "LATEST"
+REPLAY_DIR = "replay"
+MANIFEST_FILE = "manifest.json"
+STATE_FILE = "state.pt"
+OBJECTS_FILE = "objects.pkl"
+PRIORITIES_FILE = "priorities.npy"
+# replay buffer tensors stored in every segment
+REPLAY_FIELDS = ("states", "actions", "next_states", "rewards", "masks", "dones")
+
+
+def _cpu_copy(value):
+    """
+    Copy of a state dict, tensors are cloned to the cpu so training can keep updating the originals
+    """
+    if isinstance(value, torch.Tensor):
+        return value.detach().to("cpu", copy=True)
+    if isinstance(value, dict):
+        return {key: _cpu_copy(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_cpu_copy(item) for item in value)
+    return value
+
+
+def rng_states() -> dict:
+    states = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states: dict) -> None:
+    random.setstate(states["python"])
+    np.random.set_state(states["numpy"])
+    torch.set_rng_state(states["torch"])
+    if "cuda" in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+def _segment_name(start: int, stop: int) -> str:
+    return f"segment_{start:012d}_{stop:012d}.npz"
+
+
+def _segment_range(name: str):
+    _, start, stop = Path(name).stem.split("_")
+    return int(start), int(stop)
+
+
+def _write_bytes(path: Path, data: bytes) -> None:
+    with open(path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class Snapshotter:
+    """
+    Writes and restores the snapshots of one run, keeping the newest keep snapshots
+    """
+
+    def __init__(self, directory, keep: int = 2):
+        if keep < 1:
+            raise ValueError("keep has to be >= 1")
+        self.directory = Path(directory)
+        self.keep = keep
+        (self.directory / REPLAY_DIR).mkdir(parents=True, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="snapshot")
+        self._pending: Optional[Future] = None
+        # replay segments on disk that the next snapshot builds on, and the number of pushes they cover
+        self._segments: List[str] = []
+        self._saved_pushes = 0
+
+    def latest(self) -> Optional[Path]:
+        latest = self.directory / LATEST_FILE
+        if not latest.exists():
+            return None
+        return self.directory / latest.read_text().strip()
+
+    def save(
+        self,
+        step: int,
+        stateful: Dict[str, object],
+        replay_buffer: Optional[ReplayBuffer] = None,
+        objects: Optional[dict] = None,
+    ) -> Future:
+        """
+        Snapshot after step (e.g. the number of finished episodes).
+        stateful maps names to objects with state_dict / load_state_dict, such as models, optimizers and schedulers,
+        objects is a dict of any other picklable objects, returned as is by restore.
+        Everything is copied before returning, the files are written in the background.
+        """
+        self.wait()
+        state = {
+            "step": step,
+            "state_dicts": {name: _cpu_copy(item.state_dict()) for name, item in stateful.items()},
+            "rng": rng_states(),
+        }
+        objects_bytes = pickle.dumps(objects or {}, protocol=pickle.HIGHEST_PROTOCOL)
+        manifest = {"step": step, "replay": None}
+        segment = priorities = None
+        if replay_buffer is not None:
+            manifest["replay"], segment, priorities = self._capture_replay(replay_buffer)
+        self._pending = self._executor.submit(self._write, step, state, objects_bytes, manifest, segment, priorities)
+        return self._pending
+
+    def _capture_replay(self, replay_buffer: ReplayBuffer):
+        num_pushed = replay_buffer.num_pushed
+        capacity = replay_buffer.capacity
+        start = max(self._saved_pushes, num_pushed - capacity)
+        segment = None
+        if num_pushed > start:
+            positions = np.arange(start, num_pushed) % capacity
+            idx = torch.from_numpy(positions).to(replay_buffer.device)
+            segment = {field: getattr(replay_buffer, field)[idx].cpu().numpy() for field in REPLAY_FIELDS}
+            segment["priorities"] = replay_buffer.tree.get(positions)
+            segment["host_rewards"] = replay_buffer.host_rewards[positions]
+            self._segments.append(_segment_name(start, num_pushed))
+            self._saved_pushes = num_pushed
+        # only segments with transitions still in the buffer are needed
+        self._segments = [name for name in self._segments if _segment_range(name)[1] > num_pushed - capacity]
+
+        priorities = None
+        if replay_buffer.priorities_updated:
+            # priorities of old transitions may have changed, so they can not be taken from the segments
+            leaves = replay_buffer.tree.num_leaves
+            priorities = replay_buffer.tree.tree[leaves : leaves + capacity].copy()
+        meta = {
+            "capacity": capacity,
+            "num_pushed": num_pushed,
+            "position": replay_buffer.position,
+            "size": replay_buffer.size,
+            "reward_sum": replay_buffer.reward_sum,
+            "max_priority": replay_buffer.max_priority,
+            "priorities_updated": replay_buffer.priorities_updated,
+            "rng": replay_buffer.rng.bit_generator.state,
+            "segments": list(self._segments),
+        }
+        return meta, segment, priorities
+
+    def _write(self, step: int, state: dict, objects_bytes: bytes, manifest: dict, segment, priorities) -> Path:
+        name = f"snapshot_{step:012d}"
+        final = self.directory / name
+        tmp = self.directory / f"{name}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir()
+
+        if segment is not None:
+            # the segment is complete on disk before any snapshot refers to it
+            segment_path = self.directory / REPLAY_DIR / manifest["replay"]["segments"][-1]
+            with open(segment_path.with_suffix(".tmp"), "wb") as f:
+                np.savez(f, **segment)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(segment_path.with_suffix(".tmp"), segment_path)
+        if priorities is not None:
+            with open(tmp / PRIORITIES_FILE, "wb") as f:
+                np.save(f, priorities)
+        with open(tmp / STATE_FILE, "wb") as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        _write_bytes(tmp / OBJECTS_FILE, objects_bytes)
+        _write_bytes(tmp / MANIFEST_FILE, json.dumps(manifest).encode())
+
+        shutil.rmtree(final, ignore_errors=True)
+        os.replace(tmp, final)
+        _write_bytes(self.directory / f"{LATEST_FILE}.tmp", name.encode())
+        os.replace(self.directory / f"{LATEST_FILE}.tmp", self.directory / LATEST_FILE)
+        self._remove_old()
+        return final
+
+    def _remove_old(self) -> None:
+        snapshots = sorted(path for path in self.directory.glob("snapshot_*") if path.suffix != ".tmp")
+        for path in snapshots[: -self.keep]:
+            shutil.rmtree(path)
+        needed = set()
+        for path in snapshots[-self.keep :]:
+            replay = json.loads((path / MANIFEST_FILE).read_text())["replay"]
+            if replay is not None:
+                needed.update(replay["segments"])
+        for path in (self.directory / REPLAY_DIR).glob("segment_*.npz"):
+            if path.name not in needed:
+                path.unlink()
+
+    def wait(self) -> None:
+        """
+        Blocks until the last snapshot is written, raising any error of the writer
+        """
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def restore(
+        self,
+        path,
+        stateful: Dict[str, object],
+        replay_buffer: Optional[ReplayBuffer] = None,
+    ) -> dict:
+        """
+        Loads a snapshot into stateful and replay_buffer, which have to be built as for the saved run,
+        sets the random states and returns the saved objects.
+        The random states are set last, so nothing done by restore changes them.
+        """
+        path = Path(path)
+        manifest = json.loads((path / MANIFEST_FILE).read_text())
+        state = torch.load(path / STATE_FILE, map_location="cpu", weights_only=False)
+        for name, item in stateful.items():
+            item.load_state_dict(state["state_dicts"][name])
+        with open(path / OBJECTS_FILE, "rb") as f:
+            objects = pickle.load(f)
+
+        if manifest["replay"] is not None:
+            if replay_buffer is None:
+                raise ValueError(f"{path} has a replay buffer, pass one to restore it")
+            self._restore_replay(path, manifest["replay"], replay_buffer)
+        set_rng_states(state["rng"])
+        return objects
+
+    def _restore_replay(self, path: Path, meta: dict, replay_buffer: ReplayBuffer) -> None:
+        capacity = replay_buffer.capacity
+        if capacity != meta["capacity"]:
+            raise ValueError(f"replay buffer capacity {capacity} does not match the snapshot {meta['capacity']}")
+        num_pushed = meta["num_pushed"]
+        leaves = replay_buffer.tree.num_leaves
+        priorities = np.zeros(replay_buffer.tree.num_leaves)
+        for name in meta["segments"]:
+            start, stop = _segment_range(name)
+            with np.load(self.directory / REPLAY_DIR / name) as segment:
+                # skip transitions that later pushes have overwritten
+                keep = slice(max(start, num_pushed - capacity) - start, stop - start)
+                positions = np.arange(start, stop)[keep] % capacity
+                idx = torch.from_numpy(positions).to(replay_buffer.device)
+                for field in REPLAY_FIELDS:
+                    getattr(replay_buffer, field)[idx] = torch.from_numpy(segment[field][keep]).to(replay_buffer.device)
+                priorities[positions] = segment["priorities"][keep]
+                replay_buffer.host_rewards[positions] = segment["host_rewards"][keep]
+        if meta["priorities_updated"]:
+            priorities[:capacity] = np.load(path / PRIORITIES_FILE)
+
+        # rebuild the sum tree level by level, each parent is the sum of its children as SumTree.update computes it
+        tree = replay_buffer.tree.tree
+        tree[:] = 0
+        tree[leaves:] = priorities
+        level = leaves
+        while level > 1:
+            tree[level // 2 : level] = tree[level : 2 * level : 2] + tree[level + 1 : 2 * level : 2]
+            level //= 2
+
+        replay_buffer.num_pushed = num_pushed
+        replay_buffer.position = meta["position"]
+        replay_buffer.size = meta["size"]
+        replay_buffer.reward_sum = meta["reward_sum"]
+        replay_buffer.max_priority = meta["max_priority"]
+        replay_buffer.priorities_updated = meta["priorities_updated"]
+        replay_buffer.rng.bit_generator.state = meta["rng"]
+        self._segments = list(meta["segments"])
+        self._saved_pushes = num_pushed
+
+    def close(self) -> None:
+        self.wait()
+        self._executor.shutdown()
+
+    def __enter__(self) -> "Snapshotter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()